@@ -7,10 +7,59 @@ For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+
+class CancelOnDisconnectMiddleware:
+    """
+    Django 4.2 не отслеживает отключение клиента после чтения тела запроса.
+    Middleware отменяет обработку запроса по http.disconnect, чтобы оборванный
+    SSE-поток или долгий запрос к OpenAI не продолжали работать впустую.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        body_received = asyncio.Event()
+        response_complete = False
+
+        async def wrapped_receive():
+            message = await receive()
+            if message['type'] == 'http.disconnect' or not message.get('more_body', False):
+                body_received.set()
+            return message
+
+        async def wrapped_send(message):
+            nonlocal response_complete
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                response_complete = True
+            await send(message)
+
+        app_task = asyncio.ensure_future(self.app(scope, wrapped_receive, wrapped_send))
+
+        async def watch_disconnect():
+            await body_received.wait()
+            message = await receive()
+            if message['type'] == 'http.disconnect' and not response_complete:
+                app_task.cancel()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not app_task.cancelled():
+                raise
+        finally:
+            watcher.cancel()
+
+
+application = CancelOnDisconnectMiddleware(get_asgi_application())
@@ -29,23 +29,37 @@ DEBUG = os.getenv('DEBUG', 'True').lower() == 'true'
 
 ALLOWED_HOSTS = os.getenv('ALLOWED_HOSTS', '*').split(',')
 
+# Профиль приложения: production не подключает админку, Swagger и браузерный рендерер DRF
+# (меньше импортов при старте воркера и памяти на воркер). Каждую часть можно включить отдельно
+COPILOT_PROFILE = os.getenv('COPILOT_PROFILE', 'development')
+_FULL_PROFILE = str(COPILOT_PROFILE != 'production')
+ADMIN_ENABLED = os.getenv('ADMIN_ENABLED', _FULL_PROFILE).lower() == 'true'
+API_DOCS_ENABLED = os.getenv('API_DOCS_ENABLED', _FULL_PROFILE).lower() == 'true'
+BROWSABLE_API_ENABLED = os.getenv('BROWSABLE_API_ENABLED', _FULL_PROFILE).lower() == 'true'
+# JSON ответов и тел запросов через orjson (без пакета orjson — стандартный json)
+FAST_JSON_ENABLED = os.getenv('FAST_JSON_ENABLED', 'True').lower() == 'true'
+# Пути API без состояния: для них не работают session, CSRF, auth, messages и X-Frame-Options middleware
+# (copilot/middleware.py). Пусто — полный набор middleware для всех путей
+STATELESS_API_PREFIXES = [prefix for prefix in os.getenv('STATELESS_API_PREFIXES', '/copilot/').split(',') if prefix]
+
 
 # Application definition
 
 INSTALLED_APPS = [
-    'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
-    'django.contrib.messages',
     'django.contrib.staticfiles',
     'rest_framework',
     'copilot',
-    'drf_spectacular',
     'corsheaders',  # Добавляем CORS
 ]
+if ADMIN_ENABLED:
+    INSTALLED_APPS[:0] = ['django.contrib.admin', 'django.contrib.messages']
+if API_DOCS_ENABLED:
+    INSTALLED_APPS.append('drf_spectacular')
+
 REST_FRAMEWORK = {
-    'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
@@ -53,13 +67,24 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.BrowsableAPIRenderer',
+        'copilot.renderers.FastJSONRenderer' if FAST_JSON_ENABLED else 'rest_framework.renderers.JSONRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'copilot.parsers.FastJSONParser' if FAST_JSON_ENABLED else 'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ],
     'DEFAULT_PAGINATION_CLASS': 'copilot.pagination.CustomPageNumberPagination',
     'PAGE_SIZE': 20,
     'EXCEPTION_HANDLER': 'copilot.exceptions.custom_exception_handler',
 }
+# Без документации схема не строится: базовый ViewInspector вместо AutoSchema.
+# None здесь не подходит — @api_view читает APIView.schema при объявлении функции-представления
+REST_FRAMEWORK['DEFAULT_SCHEMA_CLASS'] = (
+    'drf_spectacular.openapi.AutoSchema' if API_DOCS_ENABLED else 'rest_framework.schemas.inspectors.ViewInspector'
+)
+if BROWSABLE_API_ENABLED:
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].append('rest_framework.renderers.BrowsableAPIRenderer')
 
 SPECTACULAR_SETTINGS = {
     'TITLE': 'AI Copilot API',
@@ -69,15 +94,18 @@ SPECTACULAR_SETTINGS = {
 }
 
 MIDDLEWARE = [
+    'copilot.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    # Подклассы middleware Django, пропускающие пути STATELESS_API_PREFIXES
+    'copilot.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'copilot.middleware.CsrfViewMiddleware',
+    'copilot.middleware.AuthenticationMiddleware',
+    'copilot.middleware.XFrameOptionsMiddleware',
 ]
+if ADMIN_ENABLED:
+    MIDDLEWARE.insert(MIDDLEWARE.index('copilot.middleware.XFrameOptionsMiddleware'), 'copilot.middleware.MessageMiddleware')
 
 ROOT_URLCONF = 'backend.urls'
 
@@ -91,11 +119,12 @@ TEMPLATES = [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
-                'django.contrib.messages.context_processors.messages',
             ],
         },
     },
 ]
+if ADMIN_ENABLED:
+    TEMPLATES[0]['OPTIONS']['context_processors'].append('django.contrib.messages.context_processors.messages')
 
 WSGI_APPLICATION = 'backend.wsgi.application'
 
@@ -158,6 +187,177 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Другой OpenAI-совместимый адрес, например http://127.0.0.1:8100/v1 для нагрузочных тестов (пусто — api.openai.com)
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None
+# Общий клиент OpenAI: таймауты (сек), пул keep-alive соединений и политика повторов на 429/5xx
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5'))
+OPENAI_READ_TIMEOUT = float(os.getenv('OPENAI_READ_TIMEOUT', '60'))
+OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', '20'))
+OPENAI_ASYNC_POOL_SIZE = int(os.getenv('OPENAI_ASYNC_POOL_SIZE', '500'))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', '30'))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '3'))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv('OPENAI_RETRY_BASE_DELAY', '0.5'))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv('OPENAI_RETRY_MAX_DELAY', '8'))
+# Лимитер запросов к OpenAI (token bucket по запросам и токенам, общий для воркеров через SQLite).
+# Лимиты уточняются по заголовкам x-ratelimit-*; OPENAI_RPM_LIMIT / OPENAI_TPM_LIMIT — начальные значения (0 — неизвестны)
+OPENAI_RATE_LIMIT_ENABLED = os.getenv('OPENAI_RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+OPENAI_RPM_LIMIT = int(os.getenv('OPENAI_RPM_LIMIT', '0'))
+OPENAI_TPM_LIMIT = int(os.getenv('OPENAI_TPM_LIMIT', '0'))
+# Сколько запрос может ждать лимита, сек; дольше — сразу 503 с Retry-After
+OPENAI_QUEUE_TIMEOUT = float(os.getenv('OPENAI_QUEUE_TIMEOUT', '10'))
+# Circuit breaker: после скольких ошибок OpenAI подряд (5xx, таймауты, сеть) отвечать 503 и сколько секунд; 0 — выключен
+OPENAI_BREAKER_THRESHOLD = int(os.getenv('OPENAI_BREAKER_THRESHOLD', '10'))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv('OPENAI_BREAKER_COOLDOWN', '30'))
+# Общее состояние лимитера и breaker; пусто — отдельное в каждом процессе
+OPENAI_LIMITS_DB = os.getenv('OPENAI_LIMITS_DB', str(BASE_DIR / 'cache' / 'openai_limits.sqlite3'))
+
+# Асинхронные эндпоинты ask/moderate-image (запуск через backend.asgi под uvicorn)
+COPILOT_ASYNC_VIEWS = os.getenv('COPILOT_ASYNC_VIEWS', 'False').lower() == 'true'
+# Потоки для декодирования/кодирования изображений в асинхронном режиме
+IMAGE_WORKER_THREADS = int(os.getenv('IMAGE_WORKER_THREADS', '4'))
+
+# Пакетная модерация /copilot/moderate-images/
+MODERATION_BATCH_MAX_FILES = int(os.getenv('MODERATION_BATCH_MAX_FILES', '30'))
+MODERATION_BATCH_CONCURRENCY = int(os.getenv('MODERATION_BATCH_CONCURRENCY', '5'))
+
+# Очередь асинхронных задач модерации (SQLite, без Redis)
+JOBS_DB = os.getenv('JOBS_DB', str(BASE_DIR / 'cache' / 'jobs.sqlite3'))
+# Потоков-воркеров в каждом процессе gunicorn; 0 — только отдельный процесс run_moderation_worker
+JOB_WORKER_THREADS = int(os.getenv('JOB_WORKER_THREADS', '2'))
+JOB_VISIBILITY_TIMEOUT = int(os.getenv('JOB_VISIBILITY_TIMEOUT', '300'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+JOB_WEBHOOK_TIMEOUT = float(os.getenv('JOB_WEBHOOK_TIMEOUT', '10'))
+JOB_WEBHOOK_RETRIES = int(os.getenv('JOB_WEBHOOK_RETRIES', '2'))
+# Сколько дней хранить завершенные задачи (удаляет python manage.py purge_moderation_jobs)
+JOB_RETENTION_DAYS = float(os.getenv('JOB_RETENTION_DAYS', '7'))
+# Ключ подписи webhook (HMAC-SHA256 в X-Copilot-Signature); пусто — SECRET_KEY, поэтому задайте отдельный
+# секрет и передайте его получателям
+JOB_WEBHOOK_SECRET = os.getenv('JOB_WEBHOOK_SECRET', '')
+# True — разрешить callback_url на loopback и частные адреса (только для локальной разработки)
+JOB_WEBHOOK_ALLOW_PRIVATE = os.getenv('JOB_WEBHOOK_ALLOW_PRIVATE', 'False').lower() == 'true'
+
+# Ответ модерации по строгой JSON-схеме (response_format json_schema): вердикт из перечня и найденные теги.
+# False — прежний свободный JSON в тексте ответа (для сравнения доли ошибок разбора)
+MODERATION_STRUCTURED_OUTPUT = os.getenv('MODERATION_STRUCTURED_OUTPUT', 'True').lower() == 'true'
+
+# История модерации (/copilot/content/upload/): записи в БД пишет фоновый поток пачками,
+# не дольше чем раз в MODERATION_HISTORY_FLUSH_INTERVAL сек; при переполнении очереди записи отбрасываются
+MODERATION_HISTORY_BATCH_SIZE = int(os.getenv('MODERATION_HISTORY_BATCH_SIZE', '100'))
+MODERATION_HISTORY_FLUSH_INTERVAL = float(os.getenv('MODERATION_HISTORY_FLUSH_INTERVAL', '1'))
+MODERATION_HISTORY_QUEUE_SIZE = int(os.getenv('MODERATION_HISTORY_QUEUE_SIZE', '10000'))
+
+# Кеш вердиктов модерации изображений (LRU в памяти + SQLite, общий для воркеров)
+MODERATION_CACHE_ENABLED = os.getenv('MODERATION_CACHE_ENABLED', 'True').lower() == 'true'
+MODERATION_CACHE_MAX_ENTRIES = int(os.getenv('MODERATION_CACHE_MAX_ENTRIES', '1024'))
+MODERATION_CACHE_TTL = int(os.getenv('MODERATION_CACHE_TTL', str(7 * 24 * 3600)))
+# Пустое значение отключает дисковый уровень кеша
+MODERATION_CACHE_DB = os.getenv('MODERATION_CACHE_DB', str(BASE_DIR / 'cache' / 'moderation_cache.sqlite3'))
+
+# Лимит входных токенов /copilot/ask/ (оценка до запроса; gpt-4 — 8192 токена вместе с ответом)
+ASK_INPUT_TOKEN_BUDGET = int(os.getenv('ASK_INPUT_TOKEN_BUDGET', '7000'))
+# reject — сразу ответить 413, truncate — оставить самые релевантные фрагменты текста
+ASK_TOKEN_OVERFLOW = os.getenv('ASK_TOKEN_OVERFLOW', 'reject')
+
+# Кеш ответов /copilot/ask/ по нормализованным тексту и вопросу (LRU в памяти + SQLite)
+ASK_CACHE_ENABLED = os.getenv('ASK_CACHE_ENABLED', 'True').lower() == 'true'
+ASK_CACHE_MAX_ENTRIES = int(os.getenv('ASK_CACHE_MAX_ENTRIES', '2048'))
+ASK_CACHE_TTL = int(os.getenv('ASK_CACHE_TTL', str(24 * 3600)))
+# Пустое значение отключает дисковый уровень кеша
+ASK_CACHE_DB = os.getenv('ASK_CACHE_DB', str(BASE_DIR / 'cache' / 'ask_cache.sqlite3'))
+
+# Выбор модели /copilot/ask/: маршруты fast / balanced / best — модели через запятую в порядке предпочтения
+# и SLO по p95 в мс (берется первая модель, укладывающаяся в SLO; 0 — всегда первая)
+ASK_ROUTING_ENABLED = os.getenv('ASK_ROUTING_ENABLED', 'True').lower() == 'true'
+ASK_ROUTE_FAST_MODELS = os.getenv('ASK_ROUTE_FAST_MODELS', 'gpt-4o-mini,gpt-4o')
+ASK_ROUTE_FAST_SLO_MS = int(os.getenv('ASK_ROUTE_FAST_SLO_MS', '3000'))
+ASK_ROUTE_BALANCED_MODELS = os.getenv('ASK_ROUTE_BALANCED_MODELS', 'gpt-4o,gpt-4o-mini')
+ASK_ROUTE_BALANCED_SLO_MS = int(os.getenv('ASK_ROUTE_BALANCED_SLO_MS', '8000'))
+ASK_ROUTE_BEST_MODELS = os.getenv('ASK_ROUTE_BEST_MODELS', 'gpt-4,gpt-4o')
+ASK_ROUTE_BEST_SLO_MS = int(os.getenv('ASK_ROUTE_BEST_SLO_MS', '0'))
+# Короткий текст и короткий неаналитический вопрос идут в маршрут fast
+ASK_ROUTE_SHORT_CONTEXT_CHARS = int(os.getenv('ASK_ROUTE_SHORT_CONTEXT_CHARS', '2000'))
+ASK_ROUTE_SHORT_QUESTION_CHARS = int(os.getenv('ASK_ROUTE_SHORT_QUESTION_CHARS', '200'))
+# Запасная модель (следующая в списке маршрута): основной дается ASK_PRIMARY_TIMEOUT сек без повторов
+ASK_FALLBACK_ENABLED = os.getenv('ASK_FALLBACK_ENABLED', 'True').lower() == 'true'
+ASK_PRIMARY_TIMEOUT = float(os.getenv('ASK_PRIMARY_TIMEOUT', '20'))
+# Окно замеров задержки на модель, их срок жизни (сек) и сколько замеров нужно, чтобы учитывать SLO
+ASK_ROUTE_LATENCY_WINDOW = int(os.getenv('ASK_ROUTE_LATENCY_WINDOW', '100'))
+ASK_ROUTE_LATENCY_TTL = int(os.getenv('ASK_ROUTE_LATENCY_TTL', '300'))
+ASK_ROUTE_MIN_SAMPLES = int(os.getenv('ASK_ROUTE_MIN_SAMPLES', '5'))
+
+# Пакет вопросов по одному тексту /copilot/ask/batch/: число вопросов, сколько идет к OpenAI параллельно
+# и отправлять ли первый вопрос отдельно, чтобы остальные взяли общее начало промпта из кеша промптов OpenAI
+ASK_BATCH_MAX_QUESTIONS = int(os.getenv('ASK_BATCH_MAX_QUESTIONS', '20'))
+ASK_BATCH_CONCURRENCY = int(os.getenv('ASK_BATCH_CONCURRENCY', '5'))
+ASK_BATCH_WARM_PREFIX = os.getenv('ASK_BATCH_WARM_PREFIX', 'True').lower() == 'true'
+
+# Поиск по фрагментам длинного текста в /copilot/ask/ (BM25, индекс кешируется по хешу текста)
+RETRIEVAL_ENABLED = os.getenv('RETRIEVAL_ENABLED', 'True').lower() == 'true'
+# Автоматически включается для текстов длиннее этого числа символов
+RETRIEVAL_MIN_CONTEXT_CHARS = int(os.getenv('RETRIEVAL_MIN_CONTEXT_CHARS', '12000'))
+RETRIEVAL_CHUNK_SIZE = int(os.getenv('RETRIEVAL_CHUNK_SIZE', '1500'))
+RETRIEVAL_CHUNK_OVERLAP = int(os.getenv('RETRIEVAL_CHUNK_OVERLAP', '200'))
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '4'))
+RETRIEVAL_MAX_TOP_K = int(os.getenv('RETRIEVAL_MAX_TOP_K', '20'))
+RETRIEVAL_INDEX_CACHE_SIZE = int(os.getenv('RETRIEVAL_INDEX_CACHE_SIZE', '64'))
+RETRIEVAL_INDEX_TTL = int(os.getenv('RETRIEVAL_INDEX_TTL', '3600'))
+
+# Документы и диалоги /copilot/ask/: текст загружается один раз (POST /copilot/documents/),
+# история диалога хранится в БД. Когда краткое содержание и несвернутые ходы больше
+# CONVERSATION_SUMMARY_THRESHOLD_TOKENS, старые ходы сворачиваются моделью CONVERSATION_SUMMARY_MODEL,
+# последние CONVERSATION_KEEP_TURNS ходов остаются целиком
+DOCUMENT_MAX_CHARS = int(os.getenv('DOCUMENT_MAX_CHARS', '2000000'))
+CONVERSATION_SUMMARY_THRESHOLD_TOKENS = int(os.getenv('CONVERSATION_SUMMARY_THRESHOLD_TOKENS', '1500'))
+CONVERSATION_KEEP_TURNS = int(os.getenv('CONVERSATION_KEEP_TURNS', '2'))
+CONVERSATION_SUMMARY_MODEL = os.getenv('CONVERSATION_SUMMARY_MODEL', 'gpt-4o-mini')
+CONVERSATION_SUMMARY_MAX_TOKENS = int(os.getenv('CONVERSATION_SUMMARY_MAX_TOKENS', '400'))
+
+# Объединение одинаковых одновременных запросов к OpenAI: ожидающие получают результат первого.
+# COALESCE_LOCK_DIR — общий каталог блокировок для объединения между воркерами gunicorn
+# (результат берется из дискового кеша, поэтому нужны MODERATION_CACHE_DB / ASK_CACHE_DB); пусто — только внутри процесса
+COALESCE_ENABLED = os.getenv('COALESCE_ENABLED', 'True').lower() == 'true'
+COALESCE_TIMEOUT = float(os.getenv('COALESCE_TIMEOUT', '60'))
+COALESCE_LOCK_DIR = os.getenv('COALESCE_LOCK_DIR', '')
+
+# Проверка загрузок до чтения всего тела запроса: размер файла изображения (байт),
+# число пикселей и кадров по заголовку (защита от «бомб», которые раздуваются при декодировании)
+UPLOAD_MAX_IMAGE_SIZE = int(os.getenv('UPLOAD_MAX_IMAGE_SIZE', str(10 * 1024 * 1024)))
+UPLOAD_MAX_PIXELS = int(os.getenv('UPLOAD_MAX_PIXELS', str(64 * 1000 * 1000)))
+UPLOAD_MAX_FRAMES = int(os.getenv('UPLOAD_MAX_FRAMES', '1000'))
+
+# Предобработка изображений перед отправкой в OpenAI Vision
+MODERATION_IMAGE_MAX_DIMENSION = int(os.getenv('MODERATION_IMAGE_MAX_DIMENSION', '1024'))
+MODERATION_IMAGE_FORMAT = os.getenv('MODERATION_IMAGE_FORMAT', 'JPEG').upper()  # JPEG, WEBP или PNG
+MODERATION_IMAGE_QUALITY = int(os.getenv('MODERATION_IMAGE_QUALITY', '85'))
+# Небольшие JPEG/PNG/WebP до этого размера отправляются без перекодирования
+MODERATION_IMAGE_PASSTHROUGH_MAX_BYTES = int(os.getenv('MODERATION_IMAGE_PASSTHROUGH_MAX_BYTES', str(1024 * 1024)))
+
+# Локальный префильтр: очевидно безопасные изображения получают safe без запроса к OpenAI.
+# Путь к классу с методом check(img); пустое значение выключает префильтр.
+# Перед включением проверьте пороги командой evaluate_prefilter на размеченных изображениях.
+MODERATION_PREFILTER = os.getenv('MODERATION_PREFILTER', '')
+PREFILTER_SAMPLE_SIZE = int(os.getenv('PREFILTER_SAMPLE_SIZE', '128'))
+PREFILTER_SAFE_CONFIDENCE = float(os.getenv('PREFILTER_SAFE_CONFIDENCE', '0.85'))
+PREFILTER_MAX_SKIN_RATIO = float(os.getenv('PREFILTER_MAX_SKIN_RATIO', '0.08'))
+PREFILTER_PALETTE_SIZE = int(os.getenv('PREFILTER_PALETTE_SIZE', '8'))
+# Плоская графика (логотипы, символы, надписи) всегда уходит в модель: если PREFILTER_GRAPHIC_COLORS
+# цветов покрывают не меньше PREFILTER_MAX_GRAPHIC_RATIO пикселей объекта (не фона)
+PREFILTER_GRAPHIC_COLORS = int(os.getenv('PREFILTER_GRAPHIC_COLORS', '4'))
+PREFILTER_MAX_GRAPHIC_RATIO = float(os.getenv('PREFILTER_MAX_GRAPHIC_RATIO', '0.9'))
+
+# Модерация видео и анимаций: выбор ключевых кадров и контактные листы
+VIDEO_MAX_UPLOAD_SIZE = int(os.getenv('VIDEO_MAX_UPLOAD_SIZE', str(200 * 1024 * 1024)))
+VIDEO_SAMPLE_FPS = float(os.getenv('VIDEO_SAMPLE_FPS', '2'))
+VIDEO_MAX_DURATION = float(os.getenv('VIDEO_MAX_DURATION', '600'))  # сек, более длинные видео отклоняются с 413
+# Минимальная смена сцены (0..1) и обязательный ключевой кадр раз в N секунд
+VIDEO_SCENE_THRESHOLD = float(os.getenv('VIDEO_SCENE_THRESHOLD', '0.3'))
+VIDEO_KEYFRAME_INTERVAL = float(os.getenv('VIDEO_KEYFRAME_INTERVAL', '10'))
+# Кадры с расстоянием Хэмминга dHash не больше этого считаются дубликатами
+VIDEO_DEDUP_DISTANCE = int(os.getenv('VIDEO_DEDUP_DISTANCE', '6'))
+VIDEO_MAX_FRAMES = int(os.getenv('VIDEO_MAX_FRAMES', '32'))
+VIDEO_SHEET_COLUMNS = int(os.getenv('VIDEO_SHEET_COLUMNS', '4'))
+VIDEO_SHEET_ROWS = int(os.getenv('VIDEO_SHEET_ROWS', '4'))
 
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = os.getenv('CORS_ALLOW_ALL_ORIGINS', 'True').lower() == 'true'
@@ -14,22 +14,29 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.contrib import admin
 from django.urls import path, include
-
-from drf_spectacular.views import (
-    SpectacularAPIView,
-    SpectacularSwaggerView,
-)
 from django.conf import settings
 from django.conf.urls.static import static
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
     path('copilot/', include('copilot.urls')),
-     # Swagger UI
-    path("api/schema/", SpectacularAPIView.as_view(), name="schema"),  # <-- нужный путь
-    path('api/docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
 ]
+# Админка и Swagger подключаются только вне профиля production (ADMIN_ENABLED / API_DOCS_ENABLED):
+# их модули не импортируются воркером, если выключены
+if settings.ADMIN_ENABLED:
+    from django.contrib import admin
+
+    urlpatterns.append(path('admin/', admin.site.urls))
+if settings.API_DOCS_ENABLED:
+    from drf_spectacular.views import (
+        SpectacularAPIView,
+        SpectacularSwaggerView,
+    )
+
+    urlpatterns += [
+        # Swagger UI
+        path("api/schema/", SpectacularAPIView.as_view(), name="schema"),  # <-- нужный путь
+        path('api/docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
+    ]
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,4 +1,48 @@
+from django.contrib import admin
 
-pass
+from .models import Content, Conversation, ConversationTurn, Document, ModerationResult, Tag
 
-    
+
+@admin.register(Tag)
+class TagAdmin(admin.ModelAdmin):
+    list_display = ('name', 'created_at')
+    search_fields = ('name',)
+
+
+@admin.register(Content)
+class ContentAdmin(admin.ModelAdmin):
+    list_display = ('id', 'file_type', 'safety_status', 'content_hash', 'created_at')
+    list_filter = ('file_type', 'safety_status')
+    search_fields = ('content_hash',)
+    # Полный COUNT(*) на больших таблицах дорог
+    show_full_result_count = False
+
+
+@admin.register(ModerationResult)
+class ModerationResultAdmin(admin.ModelAdmin):
+    list_display = ('id', 'content', 'verdict', 'created_at')
+    list_filter = ('verdict',)
+    list_select_related = ('content',)
+    raw_id_fields = ('content',)
+    filter_horizontal = ('detected_tags',)
+    show_full_result_count = False
+
+
+@admin.register(Document)
+class DocumentAdmin(admin.ModelAdmin):
+    list_display = ('id', 'chars', 'estimated_tokens', 'created_at')
+    search_fields = ('id',)
+    show_full_result_count = False
+
+
+class ConversationTurnInline(admin.TabularInline):
+    model = ConversationTurn
+    extra = 0
+
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'document', 'created_at', 'updated_at')
+    raw_id_fields = ('document',)
+    inlines = [ConversationTurnInline]
+    show_full_result_count = False
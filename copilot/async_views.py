@@ -0,0 +1,174 @@
+"""
+Асинхронные версии эндпоинтов ask, ask/batch и moderate-image для запуска под ASGI.
+Подключаются вместо DRF-представлений при COPILOT_ASYNC_VIEWS=True.
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.urls import reverse
+
+from .exceptions import custom_exception_headers, custom_exception_payload
+from .metrics import StageTimer
+from .renderers import json_dumps, json_loads
+from .uploads import IMAGE_FORMATS, VIDEO_FORMATS, limit_uploads
+from .jobs import KIND_BATCH, KIND_IMAGE, submit_job, wants_job
+from .serializers import (
+    AskRequestSerializer, AskBatchRequestSerializer, ImageModerationRequestSerializer, ImageBatchModerationRequestSerializer,
+    VideoModerationRequestSerializer, ImageAdviceRequestSerializer,
+)
+from .services import (
+    analyze_image_with_ai_async, advise_image, moderate_image_batch_async, run_in_image_executor, plan_ask, AskBatch,
+    moderation_usage_headers,
+)
+from .video import moderate_video as moderate_video_file
+from .streaming import wants_event_stream, astream_cached_answer, event_stream_response
+
+logger = logging.getLogger(__name__)
+
+
+def async_api_view(view):
+    """
+    Оборачивает async-представление: только POST, без CSRF (как у DRF)
+    и с тем же форматом ошибок, что у custom_exception_handler.
+    """
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'POST':
+            return _json_response({'detail': f'Метод "{request.method}" не разрешен.'}, status=405)
+        try:
+            return await view(request, *args, **kwargs)
+        except Exception as exc:
+            custom = custom_exception_payload(exc)
+            if custom is None:
+                raise
+            data, status_code = custom
+            return _json_response(data, status=status_code, headers=custom_exception_headers(exc))
+
+    # csrf_exempt из Django 4.2 не поддерживает корутины, поэтому ставим флаг напрямую
+    wrapper.csrf_exempt = True
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+def _json_response(data, status=200, headers=None):
+    return HttpResponse(json_dumps(data), status=status, headers=headers, content_type='application/json')
+
+
+def _multipart_data(request):
+    """Поля формы и файлы вместе, как request.data в DRF"""
+    data = request.POST.copy()
+    data.update(request.FILES)
+    return data
+
+
+def _body_data(request):
+    """Тело JSON-запроса или поля формы; ValueError — некорректный JSON"""
+    return json_loads(request.body or b'{}') if request.content_type == 'application/json' else request.POST
+
+
+async def _job_accepted(request, kind, files, validated_data):
+    job_id = await sync_to_async(submit_job, thread_sensitive=False)(
+        kind, files, validated_data.get("callback_url"), validated_data["mode"]
+    )
+    return _json_response({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": request.build_absolute_uri(reverse("moderation-job", args=[job_id])),
+    }, status=202)
+
+
+@async_api_view
+async def ask(request):
+    """Асинхронная версия AskView.post"""
+    try:
+        data = _body_data(request)
+    except ValueError:
+        return _json_response({'detail': 'Некорректный JSON'}, status=400)
+    serializer = AskRequestSerializer(data=data)
+    # document_id и conversation_id загружаются из БД: валидация и подготовка идут в потоке Django,
+    # где соединения с БД живут и закрываются по обычным правилам, а не в пуле для картинок
+    if not await sync_to_async(serializer.is_valid, thread_sensitive=True)():
+        return _json_response(serializer.errors, status=400)
+    plan = await sync_to_async(plan_ask, thread_sensitive=True)(request, serializer.validated_data)
+    if wants_event_stream(request):
+        if plan.cached is not None:
+            return event_stream_response(astream_cached_answer(plan.cached["answer"], plan.meta()))
+        return event_stream_response(plan.astream())
+    if plan.cached is not None:
+        return _json_response(plan.payload(plan.cached["answer"], cached=True))
+    payload, headers = await plan.acomplete()
+    return _json_response(payload, headers=headers)
+
+
+@async_api_view
+async def ask_batch(request):
+    """Асинхронная версия AskBatchView.post: вопросы идут к AsyncOpenAI параллельно"""
+    try:
+        data = _body_data(request)
+    except ValueError:
+        return _json_response({'detail': 'Некорректный JSON'}, status=400)
+    serializer = AskBatchRequestSerializer(data=data)
+    if not await sync_to_async(serializer.is_valid, thread_sensitive=True)():
+        return _json_response(serializer.errors, status=400)
+    batch = await sync_to_async(AskBatch, thread_sensitive=True)(request, serializer.validated_data)
+    payload, headers = await batch.arun()
+    return _json_response(payload, headers=headers)
+
+
+@async_api_view
+async def moderate_image(request):
+    """Асинхронная версия moderate_image: PIL работает в пуле потоков"""
+    limit_uploads(request, IMAGE_FORMATS, settings.UPLOAD_MAX_IMAGE_SIZE)
+    with StageTimer('upload_parse'):
+        serializer = ImageModerationRequestSerializer(data=_multipart_data(request))
+        # ImageField проверяет файл через Pillow, поэтому валидация тоже вне event loop
+        valid = await run_in_image_executor(serializer.is_valid)
+    if not valid:
+        return _json_response(serializer.errors, status=400)
+    file = serializer.validated_data["file"]
+    if wants_job(request, serializer.validated_data):
+        return await _job_accepted(request, KIND_IMAGE, [file], serializer.validated_data)
+    result = await analyze_image_with_ai_async(file, serializer.validated_data["mode"])
+    return _json_response(result, headers=moderation_usage_headers([result]))
+
+
+@async_api_view
+async def moderate_image_advice(request):
+    """Асинхронная версия moderate_image_advice; редкий запрос, поэтому синхронный клиент в потоке"""
+    limit_uploads(request, IMAGE_FORMATS, settings.UPLOAD_MAX_IMAGE_SIZE)
+    serializer = ImageAdviceRequestSerializer(data=_multipart_data(request))
+    if not await run_in_image_executor(serializer.is_valid):
+        return _json_response(serializer.errors, status=400)
+    result = await sync_to_async(advise_image, thread_sensitive=False)(serializer.validated_data["file"])
+    return _json_response(result, headers=moderation_usage_headers([result]))
+
+
+@async_api_view
+async def moderate_images(request):
+    """Асинхронная версия пакетной модерации"""
+    limit_uploads(
+        request, IMAGE_FORMATS, settings.UPLOAD_MAX_IMAGE_SIZE, settings.MODERATION_BATCH_MAX_FILES, sniff=False
+    )
+    serializer = ImageBatchModerationRequestSerializer(data=_multipart_data(request))
+    # callback_url проверяется через DNS, поэтому валидация вне event loop
+    if not await run_in_image_executor(serializer.is_valid):
+        return _json_response(serializer.errors, status=400)
+    files = serializer.validated_data["files"]
+    if wants_job(request, serializer.validated_data):
+        return await _job_accepted(request, KIND_BATCH, files, serializer.validated_data)
+    result = await moderate_image_batch_async(files, serializer.validated_data["mode"])
+    return _json_response(result, headers=moderation_usage_headers(result["results"]))
+
+
+@async_api_view
+async def moderate_video(request):
+    """Асинхронная версия модерации видео; декодирование кадров идет в пуле потоков"""
+    limit_uploads(request, VIDEO_FORMATS, settings.VIDEO_MAX_UPLOAD_SIZE)
+    serializer = VideoModerationRequestSerializer(data=_multipart_data(request))
+    # Проверка формата читает загруженный файл, поэтому валидация вне event loop
+    if not await run_in_image_executor(serializer.is_valid):
+        return _json_response(serializer.errors, status=400)
+    result = await sync_to_async(moderate_video_file, thread_sensitive=False)(serializer.validated_data["file"])
+    return _json_response(result, headers=moderation_usage_headers([result]))
@@ -0,0 +1,405 @@
+"""
+Нагрузочное тестирование без расхода кредитов OpenAI.
+
+FakeOpenAIServer — локальный OpenAI-совместимый сервер (/v1/chat/completions)
+с настраиваемым распределением задержки, долей ошибок, потоковой выдачей
+и лимитом запросов в минуту (заголовки x-ratelimit-* и 429, как у OpenAI).
+Генератор нагрузки на httpx.AsyncClient держит заданное число одновременных
+запросов к запущенному gunicorn, MemorySampler снимает RSS воркеров из /proc.
+Все это запускает команда load_benchmark.
+"""
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+from PIL import Image
+
+FAKE_ANSWER = (
+    'Кампания проходит до конца месяца, участвовать могут все зарегистрированные пользователи. '
+    'Приз начисляется в течение трех рабочих дней после завершения розыгрыша.'
+)
+FAKE_VERDICT = '{"verdict": "safe", "explanation": "Ответ тестового сервера"}'
+
+
+class FakeOpenAIConfig:
+    def __init__(self, latency_ms=800, latency_sigma=0.5, error_rate=0.0, error_status=429,
+                 token_delay_ms=20, completion_tokens=60, rate_limit_rpm=0):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.token_delay_ms = token_delay_ms
+        self.completion_tokens = completion_tokens
+        self.rate_limit_rpm = rate_limit_rpm
+
+    def latency(self):
+        """Задержка до первого байта в секундах: логнормальное распределение с медианой latency_ms"""
+        return self.latency_ms / 1000 * math.exp(random.gauss(0, self.latency_sigma))
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            self._send_json(200, self.server.snapshot())
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'Not found'}})
+            return
+        config = self.server.config
+        payload = json.loads(body or b'{}')
+        allowed, limit_headers = self.server.take_request()
+        if not allowed:
+            self.server.count('rate_limited')
+            self._send_json(429, {
+                'error': {'message': 'Rate limit reached for requests', 'type': 'requests', 'code': 'rate_limit_exceeded'},
+            }, headers=limit_headers)
+            return
+        if random.random() < config.error_rate:
+            self.server.count('errors')
+            time.sleep(config.latency() / 10)
+            self._send_json(config.error_status, {
+                'error': {'message': 'Injected error', 'type': 'fake_error', 'code': None},
+            }, headers={'Retry-After': '1'} if config.error_status == 429 else None)
+            return
+        self.server.count('streamed' if payload.get('stream') else 'completed')
+
+        has_image = '"image_url"' in body.decode('utf-8', 'ignore')
+        content = FAKE_VERDICT if has_image else self._answer(config.completion_tokens)
+        usage = {
+            'prompt_tokens': len(body) // 4,
+            'completion_tokens': config.completion_tokens,
+            'total_tokens': len(body) // 4 + config.completion_tokens,
+        }
+        time.sleep(config.latency())
+        if payload.get('stream'):
+            self._stream(payload, content, usage, config.token_delay_ms / 1000, limit_headers)
+        else:
+            self._send_json(200, {
+                'id': f'chatcmpl-{uuid.uuid4().hex}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': payload.get('model', 'fake'),
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': content},
+                    'finish_reason': 'stop',
+                }],
+                'usage': usage,
+            }, headers=limit_headers)
+
+    def _answer(self, tokens):
+        words = FAKE_ANSWER.split()
+        return ' '.join(words[i % len(words)] for i in range(tokens))
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def _stream(self, payload, content, usage, token_delay, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        base = {
+            'id': f'chatcmpl-{uuid.uuid4().hex}',
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': payload.get('model', 'fake'),
+        }
+        tokens = content.split(' ')
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(token_delay)
+            delta = {'content': token if i == 0 else ' ' + token}
+            chunk = {**base, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]}
+            self._chunk(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+        final = {**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+        self._chunk(f'data: {json.dumps(final)}\n\n'.encode('utf-8'))
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            self._chunk(f'data: {json.dumps({**base, "choices": [], "usage": usage})}\n\n'.encode('utf-8'))
+        self._chunk(b'data: [DONE]\n\n')
+        self._chunk(b'')
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, config):
+        super().__init__(address, FakeOpenAIHandler)
+        self.config = config
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        self._allowance = float(config.rate_limit_rpm)
+        self._allowance_updated = time.monotonic()
+
+    def count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def take_request(self):
+        """Token bucket на rate_limit_rpm запросов в минуту: (разрешен ли запрос, заголовки x-ratelimit-*)"""
+        limit = self.config.rate_limit_rpm
+        if not limit:
+            return True, None
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(limit, self._allowance + (now - self._allowance_updated) * limit / 60)
+            self._allowance_updated = now
+            allowed = self._allowance >= 1
+            if allowed:
+                self._allowance -= 1
+            reset = (limit - self._allowance) * 60 / limit
+        headers = {
+            'x-ratelimit-limit-requests': str(limit),
+            'x-ratelimit-remaining-requests': str(int(self._allowance)),
+            'x-ratelimit-reset-requests': f'{reset:.3f}s',
+        }
+        if not allowed:
+            headers['Retry-After'] = str(max(1, math.ceil(60 / limit)))
+        return allowed, headers
+
+    def snapshot(self):
+        with self._lock:
+            return {'requests': sum(self._counters.values()), **self._counters}
+
+
+def percentile(sorted_values, p):
+    """Перцентиль методом ближайшего ранга"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 1)
+
+
+def summarize(samples, window):
+    """samples — список (задержка, время до первого байта, статус)"""
+    latencies = sorted(latency for latency, _, status in samples if status == 200)
+    first_bytes = sorted(first_byte for _, first_byte, status in samples if status == 200 and first_byte is not None)
+    statuses = Counter(str(status) for _, _, status in samples)
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - statuses.get('200', 0),
+        'status_codes': dict(statuses),
+        'throughput_rps': round(len(samples) / window, 2) if window else 0.0,
+        'latency_ms': {
+            'p50': _ms(percentile(latencies, 50)),
+            'p95': _ms(percentile(latencies, 95)),
+            'p99': _ms(percentile(latencies, 99)),
+            'mean': _ms(sum(latencies) / len(latencies)) if latencies else None,
+            'max': _ms(latencies[-1]) if latencies else None,
+        },
+        'first_byte_ms': {
+            'p50': _ms(percentile(first_bytes, 50)),
+            'p95': _ms(percentile(first_bytes, 95)),
+            'p99': _ms(percentile(first_bytes, 99)),
+        },
+    }
+
+
+def _sample_image(seed, width, height):
+    """JPEG с крупным шумом: достаточно большой, чтобы пройти полную предобработку"""
+    rng = random.Random(seed)
+    small = Image.new('RGB', (32, 24))
+    small.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(32 * 24)])
+    buffer = io.BytesIO()
+    small.resize((width, height), Image.BILINEAR).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+class Scenario:
+    """Набор запросов одного вида; request(i) возвращает параметры httpx для i-го запроса"""
+
+    def __init__(self, name, path, image_size=(1280, 960), context_chars=3000):
+        self.name = name
+        self.path = path
+        self.context = (FAKE_ANSWER + ' ') * (context_chars // len(FAKE_ANSWER) + 1)
+        self.images = []
+        if name == 'moderate-image':
+            self.images = [_sample_image(seed, *image_size) for seed in range(16)]
+
+    def request(self, i):
+        if self.images:
+            return {'files': {'file': (f'image-{i}.jpg', self.images[i % len(self.images)], 'image/jpeg')}}
+        return {'json': {'context': self.context, 'question': f'Когда начисляется приз? (вопрос {i})'}}
+
+
+SCENARIOS = {
+    'ask': '/copilot/ask/',
+    'ask-stream': '/copilot/ask/?stream=true',
+    'moderate-image': '/copilot/moderate-image/',
+}
+
+
+def make_scenario(name, **kwargs):
+    return Scenario(name, SCENARIOS[name], **kwargs)
+
+
+async def _drive(base_url, scenario, concurrency, duration, warmup, timeout):
+    samples = []
+    started_at = time.perf_counter()
+    measure_from = started_at + warmup
+    stop_at = measure_from + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        async def worker(n):
+            i = n
+            while time.perf_counter() < stop_at:
+                kwargs = scenario.request(i)
+                i += concurrency
+                started = time.perf_counter()
+                first_byte = None
+                try:
+                    async with client.stream('POST', scenario.path, **kwargs) as response:
+                        async for _ in response.aiter_raw():
+                            if first_byte is None:
+                                first_byte = time.perf_counter() - started
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = e.__class__.__name__
+                if started >= measure_from:
+                    samples.append((time.perf_counter() - started, first_byte, status))
+
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    return samples, time.perf_counter() - measure_from
+
+
+def run_load(base_url, scenario, concurrency, duration, warmup=5, timeout=120):
+    """Держит concurrency одновременных запросов duration секунд (после прогрева warmup)"""
+    samples, window = asyncio.run(_drive(base_url, scenario, concurrency, duration, warmup, timeout))
+    return summarize(samples, window)
+
+
+def child_pids(parent_pid):
+    """Дочерние процессы (воркеры gunicorn) по /proc; пустой список вне Linux"""
+    pids = []
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return pids
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent_pid:
+            pids.append(int(entry))
+    return pids
+
+
+def rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def pss_mb(pid):
+    """
+    PSS процесса: общие с другими процессами страницы делятся между ними поровну.
+    В отличие от RSS показывает, сколько памяти воркеры экономят на copy-on-write после fork
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as smaps:
+            for line in smaps:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemorySampler:
+    """Периодически снимает RSS мастера и воркеров gunicorn, запоминает пиковые значения"""
+
+    def __init__(self, master_pid, interval=0.5):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peaks = {}
+        self.last = {}
+        self.total_peak = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        total = 0.0
+        for pid in [self.master_pid] + child_pids(self.master_pid):
+            value = rss_mb(pid)
+            if value is None:
+                continue
+            self.last[pid] = value
+            self.peaks[pid] = max(self.peaks.get(pid, 0.0), value)
+            total += value
+        self.total_peak = max(self.total_peak, total)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        return False
+
+    def report(self):
+        workers = {
+            str(pid): {'peak_rss_mb': round(peak, 1), 'last_rss_mb': round(self.last[pid], 1)}
+            for pid, peak in self.peaks.items() if pid != self.master_pid
+        }
+        return {
+            'master_rss_mb': round(self.last.get(self.master_pid, 0.0), 1),
+            'workers': workers,
+            'worker_peak_rss_mb': round(max((w['peak_rss_mb'] for w in workers.values()), default=0.0), 1),
+            'total_peak_rss_mb': round(self.total_peak, 1),
+        }
@@ -0,0 +1,177 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import CACHE_LOOKUPS
+
+
+class LRUCache:
+    """Ограниченный LRU-кеш в памяти процесса с TTL"""
+
+    def __init__(self, max_entries=1024, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCacheStore:
+    """
+    Персистентный уровень кеша в SQLite-файле.
+    Общий для всех воркеров gunicorn и переживает перезапуск.
+    """
+
+    def __init__(self, path, table='cache_entries'):
+        self.path = str(path)
+        self.table = table
+        self._local = threading.local()
+
+    def _connection(self):
+        # Соединение на поток и на процесс: после fork соединение родителя не используем
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table} ('
+            'key TEXT PRIMARY KEY, version TEXT, value TEXT, '
+            'created_at REAL, expires_at REAL)'
+        )
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            f'SELECT value, expires_at FROM {self.table} WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None, None
+        value, expires_at = row
+        if expires_at < time.time():
+            self._connection().execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+            return None, None
+        return json.loads(value), expires_at
+
+    def set(self, key, value, version, ttl):
+        now = time.time()
+        self._connection().execute(
+            f'INSERT OR REPLACE INTO {self.table} (key, version, value, created_at, expires_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, version, json.dumps(value, ensure_ascii=False), now, now + ttl)
+        )
+
+    def purge(self, keep_version=None):
+        """Удаляет просроченные записи и записи чужих версий (или все, если версия не задана)"""
+        conn = self._connection()
+        if keep_version is None:
+            cursor = conn.execute(f'DELETE FROM {self.table}')
+        else:
+            cursor = conn.execute(
+                f'DELETE FROM {self.table} WHERE version != ? OR expires_at < ?',
+                (keep_version, time.time())
+            )
+        return cursor.rowcount
+
+    def count(self):
+        return self._connection().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+
+class TieredCache:
+    """
+    Двухуровневый кеш: LRU в памяти + опциональный SQLite на диске.
+    Ведет счетчики попаданий, промахов и вытеснений.
+    """
+
+    def __init__(self, version, max_entries=1024, ttl=3600, db_path=None, table='cache_entries'):
+        self.name = table
+        self.version = version
+        self.ttl = ttl
+        self.memory = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.store = SQLiteCacheStore(db_path, table=table) if db_path else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self._count('hits')
+            CACHE_LOOKUPS.labels(self.name, 'hit').inc()
+            return value
+        if self.store is not None:
+            value, expires_at = self.store.get(key)
+            if value is not None:
+                # Поднимаем запись в память с оставшимся сроком жизни
+                self.memory.set(key, value, ttl=max(expires_at - time.time(), 0))
+                self._count('hits')
+                self._count('disk_hits')
+                CACHE_LOOKUPS.labels(self.name, 'disk_hit').inc()
+                return value
+        self._count('misses')
+        CACHE_LOOKUPS.labels(self.name, 'miss').inc()
+        return None
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.store is not None:
+            self.store.set(key, value, self.version, self.ttl)
+
+    def purge(self, stale_only=True):
+        """Очищает кеш. При stale_only удаляются только записи других версий промпта"""
+        self.memory.clear()
+        if self.store is None:
+            return 0
+        return self.store.purge(keep_version=self.version if stale_only else None)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'version': self.version,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.memory.evictions,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'memory_entries': len(self.memory),
+        }
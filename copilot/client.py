@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+
+from django.conf import settings
+
+from .exceptions import OpenAIAPIException, UpstreamUnavailableException
+from .metrics import UPSTREAM_ERRORS, UPSTREAM_LATENCY, UPSTREAM_RETRIES, error_status
+from .ratelimit import get_upstream_guard, request_cost
+
+logger = logging.getLogger(__name__)
+
+# openai и httpx (~0.3 с импорта) загружаются при первом обращении к OpenAI, а не при старте воркера;
+# под gunicorn --preload их заранее импортирует мастер (copilot.startup.warm_up)
+
+# Коды ответа OpenAI, после которых имеет смысл повторить запрос
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+_client = None
+_client_lock = threading.Lock()
+# AsyncOpenAI привязан к event loop, в котором открыл соединения: свой клиент на каждый loop
+# (под WSGI async_to_sync запускает асинхронные view в отдельных loop в разных потоках)
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _reset_client():
+    """Сбрасывает клиент в дочернем процессе: пул соединений родителя не наследуем"""
+    global _client, _client_lock, _async_clients
+    _client = None
+    _client_lock = threading.Lock()
+    _async_clients = weakref.WeakKeyDictionary()
+
+
+# gunicorn --preload: воркеры создаются через fork после импорта приложения
+os.register_at_fork(after_in_child=_reset_client)
+
+
+def get_openai_client():
+    """
+    Возвращает общий для процесса клиент OpenAI с пулом keep-alive соединений.
+    Повторы выполняет call_openai, встроенные повторы SDK отключены.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import httpx
+                import openai
+
+                _client = openai.OpenAI(
+                    api_key=settings.OPENAI_API_KEY,
+                    base_url=settings.OPENAI_BASE_URL,
+                    max_retries=0,
+                    http_client=openai.DefaultHttpxClient(
+                        timeout=httpx.Timeout(settings.OPENAI_READ_TIMEOUT, connect=settings.OPENAI_CONNECT_TIMEOUT),
+                        limits=httpx.Limits(
+                            max_connections=settings.OPENAI_POOL_SIZE,
+                            max_keepalive_connections=settings.OPENAI_POOL_SIZE,
+                            keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY,
+                        ),
+                    ),
+                )
+    return _client
+
+
+def get_async_openai_client():
+    """
+    Возвращает AsyncOpenAI для текущего event loop (под uvicorn — один на воркер).
+    Пул рассчитан на сотни одновременных запросов (OPENAI_ASYNC_POOL_SIZE).
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        import httpx
+        import openai
+
+        client = openai.AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=settings.OPENAI_BASE_URL,
+            max_retries=0,
+            http_client=openai.DefaultAsyncHttpxClient(
+                timeout=httpx.Timeout(settings.OPENAI_READ_TIMEOUT, connect=settings.OPENAI_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=settings.OPENAI_ASYNC_POOL_SIZE,
+                    max_keepalive_connections=settings.OPENAI_ASYNC_POOL_SIZE,
+                    keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY,
+                ),
+            ),
+        )
+        # Словарь общий для потоков с разными loop
+        with _client_lock:
+            _drop_closed_loops()
+            _async_clients[loop] = client
+    return client
+
+
+def _drop_closed_loops():
+    """
+    Забывает клиенты закрытых loop. Открытые соединения ссылаются на свой loop,
+    поэтому слабая ссылка сама не освободится; сокеты закроет сборщик мусора.
+    """
+    for loop in [loop for loop in list(_async_clients.keys()) if loop.is_closed()]:
+        _async_clients.pop(loop, None)
+
+
+def retry_delay(attempt, retry_after=None):
+    """Экспоненциальная задержка с джиттером; заголовок Retry-After имеет приоритет"""
+    if retry_after is not None:
+        return min(retry_after, settings.OPENAI_RETRY_MAX_DELAY)
+    delay = min(settings.OPENAI_RETRY_BASE_DELAY * (2 ** attempt), settings.OPENAI_RETRY_MAX_DELAY)
+    return random.uniform(delay / 2, delay)
+
+
+def _retry_after(exc):
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def to_api_exception(exc):
+    """Преобразует ошибку SDK в OpenAIAPIException с подходящим HTTP-статусом"""
+    import openai
+
+    if isinstance(exc, openai.APITimeoutError):
+        return OpenAIAPIException('Превышено время ожидания ответа AI сервиса', status_code=504)
+    if isinstance(exc, openai.APIConnectionError):
+        return OpenAIAPIException('AI сервис недоступен', status_code=502)
+    if isinstance(exc, openai.RateLimitError):
+        # Лимит исчерпан у всего сервиса, а не у клиента: 503 с Retry-After
+        return UpstreamUnavailableException('Превышен лимит запросов к AI сервису', retry_after=_retry_after(exc))
+    if isinstance(exc, openai.APIStatusError):
+        status_code = 502 if exc.status_code >= 500 else 500
+        return OpenAIAPIException(f'AI сервис вернул ошибку {exc.status_code}: {exc.message}', status_code=status_code)
+    return OpenAIAPIException(str(exc))
+
+
+def is_retryable(exc):
+    import openai
+
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code in RETRYABLE_STATUS_CODES
+
+
+def call_openai(func, *args, attempts=None, **kwargs):
+    """
+    Вызывает метод клиента OpenAI с повторами на 429/5xx и сетевых ошибках.
+    Перед каждой попыткой ждет своей очереди в лимитере; при разомкнутом
+    circuit breaker или слишком долгом ожидании поднимает UpstreamUnavailableException (503).
+    attempts ограничивает число попыток (по умолчанию OPENAI_MAX_RETRIES + 1).
+    Итоговая ошибка поднимается как OpenAIAPIException.
+    """
+    import openai
+
+    attempts = attempts or settings.OPENAI_MAX_RETRIES + 1
+    model = kwargs.get('model', '')
+    guard = get_upstream_guard()
+    cost = request_cost(kwargs)
+    for attempt in range(attempts):
+        wait = guard.acquire(model, cost)
+        if wait:
+            time.sleep(wait)
+        started = time.perf_counter()
+        try:
+            response = func(*args, **kwargs)
+        except openai.OpenAIError as exc:
+            time.sleep(_handle_failure(guard, model, exc, started, attempt, attempts))
+            continue
+        UPSTREAM_LATENCY.labels(model, 'ok').observe(time.perf_counter() - started)
+        headers, response = _unwrap(response)
+        guard.record_success(model, headers)
+        return response
+
+
+def _handle_failure(guard, model, exc, started, attempt, attempts):
+    """Учитывает неудачную попытку; возвращает паузу перед повтором или поднимает итоговую ошибку"""
+    status = error_status(exc)
+    UPSTREAM_LATENCY.labels(model, 'error').observe(time.perf_counter() - started)
+    UPSTREAM_ERRORS.labels(status).inc()
+    response = getattr(exc, 'response', None)
+    retry_after = _retry_after(exc)
+    guard.record_failure(model, status, getattr(response, 'headers', None), retry_after)
+    if attempt + 1 >= attempts or not is_retryable(exc):
+        raise to_api_exception(exc) from exc
+    UPSTREAM_RETRIES.labels(status).inc()
+    if status == '429' and settings.OPENAI_RATE_LIMIT_ENABLED:
+        # Паузу до сброса лимита выдержит лимитер (общую для всех воркеров)
+        delay = 0
+    else:
+        delay = retry_delay(attempt, retry_after)
+    logger.warning(f"OpenAI call failed ({exc.__class__.__name__}), retry {attempt + 1} in {delay:.2f}s")
+    return delay
+
+
+def _unwrap(response):
+    """Ответ with_raw_response — (заголовки, разобранный ответ); остальные ответы без заголовков"""
+    # Класс сырого ответа — приватная часть SDK, поэтому проверяем по интерфейсу
+    if hasattr(response, 'parse') and hasattr(response, 'headers'):
+        return response.headers, response.parse()
+    return None, response
+
+
+def chat_completion(**kwargs):
+    """chat.completions.create через общий клиент и политику повторов (с stream=True — поток)"""
+    return call_openai(get_openai_client().chat.completions.with_raw_response.create, **kwargs)
+
+
+async def acall_openai(func, *args, attempts=None, **kwargs):
+    """Асинхронный вариант call_openai с той же политикой повторов и лимитером"""
+    import openai
+
+    attempts = attempts or settings.OPENAI_MAX_RETRIES + 1
+    model = kwargs.get('model', '')
+    guard = get_upstream_guard()
+    cost = request_cost(kwargs)
+    for attempt in range(attempts):
+        # Состояние лимитера в SQLite: не блокируем event loop
+        wait = await asyncio.to_thread(guard.acquire, model, cost)
+        if wait:
+            await asyncio.sleep(wait)
+        started = time.perf_counter()
+        try:
+            response = await func(*args, **kwargs)
+        except openai.OpenAIError as exc:
+            delay = await asyncio.to_thread(_handle_failure, guard, model, exc, started, attempt, attempts)
+            await asyncio.sleep(delay)
+            continue
+        UPSTREAM_LATENCY.labels(model, 'ok').observe(time.perf_counter() - started)
+        headers, response = _unwrap(response)
+        await asyncio.to_thread(guard.record_success, model, headers)
+        return response
+
+
+async def async_chat_completion(**kwargs):
+    """chat.completions.create через AsyncOpenAI и политику повторов"""
+    return await acall_openai(get_async_openai_client().chat.completions.with_raw_response.create, **kwargs)
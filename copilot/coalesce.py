@@ -0,0 +1,237 @@
+"""
+Объединение одинаковых одновременных запросов к OpenAI (single-flight).
+
+Пока запрос по ключу (хеш изображения, нормализованные текст и вопрос)
+выполняется, такие же запросы ждут его результат вместо собственного вызова.
+Внутри процесса ожидание идет через threading.Event (потоки) или asyncio.Future
+(ASGI). Между воркерами gunicorn — через файловую блокировку в COALESCE_LOCK_DIR:
+воркер, не получивший блокировку, ждет ее освобождения и читает результат
+из общего дискового кеша. Ожидание ограничено COALESCE_TIMEOUT, после чего
+запрос выполняется самостоятельно, чтобы зависший лидер не держал остальных.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .metrics import COALESCE_TIMEOUTS, COALESCED_REQUESTS
+
+try:
+    import fcntl
+except ImportError:  # Windows: только объединение внутри процесса
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Как часто воркер-последователь проверяет блокировку лидера из другого процесса, сек
+LOCK_POLL_INTERVAL = 0.05
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class CoalesceStats:
+    """Счетчики по эндпоинтам: сколько вызовов выполнено и сколько запросов к ним присоединилось"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, name):
+        with self._lock:
+            stats = self._endpoints.setdefault(
+                endpoint, {'leaders': 0, 'in_process': 0, 'cross_worker': 0, 'timeouts': 0}
+            )
+            stats[name] += 1
+        if name in ('in_process', 'cross_worker'):
+            COALESCED_REQUESTS.labels(endpoint, name).inc()
+        elif name == 'timeouts':
+            COALESCE_TIMEOUTS.labels(endpoint).inc()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: {**stats, 'coalesced': stats['in_process'] + stats['cross_worker']}
+                for endpoint, stats in self._endpoints.items()
+            }
+
+
+coalesce_stats = CoalesceStats()
+
+
+def _lock_path(endpoint, key):
+    os.makedirs(settings.COALESCE_LOCK_DIR, exist_ok=True)
+    digest = hashlib.sha256(f'{endpoint}:{key}'.encode('utf-8')).hexdigest()[:40]
+    return os.path.join(settings.COALESCE_LOCK_DIR, f'{endpoint}-{digest}.lock')
+
+
+def _try_lock(path):
+    """Дескриптор захваченной блокировки или None, если ее держит другой процесс"""
+    while True:
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            current = os.stat(path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            current = False
+        if current:
+            return fd
+        # Лидер успел удалить файл после завершения: блокируем новый
+        os.close(fd)
+
+
+def _unlock(path, fd):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    os.close(fd)
+
+
+def _cross_worker_enabled(lookup):
+    return lookup is not None and fcntl is not None and bool(settings.COALESCE_LOCK_DIR)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._futures = {}
+
+    def run(self, endpoint, key, fn, lookup=None):
+        """
+        Выполняет fn() один раз на ключ среди одновременных вызовов.
+        lookup() ищет результат в общем хранилище (для ожидания другого воркера).
+        Возвращает (значение, shared): shared=True, если значение получено от другого запроса.
+        Значение общее для всех ожидавших, изменять его нельзя.
+        """
+        if not settings.COALESCE_ENABLED or key is None:
+            return fn(), False
+        name = f'{endpoint}:{key}'
+        with self._lock:
+            call = self._calls.get(name)
+            leader = call is None
+            if leader:
+                call = self._calls[name] = _Call()
+
+        if not leader:
+            if not call.event.wait(settings.COALESCE_TIMEOUT):
+                coalesce_stats.record(endpoint, 'timeouts')
+                logger.warning(f"Coalesced {endpoint} call timed out, calling upstream directly")
+                return fn(), False
+            coalesce_stats.record(endpoint, 'in_process')
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value, shared = self._lead(endpoint, key, fn, lookup)
+            return call.value, shared
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[name]
+            call.event.set()
+
+    def _lead(self, endpoint, key, fn, lookup):
+        if not _cross_worker_enabled(lookup):
+            coalesce_stats.record(endpoint, 'leaders')
+            return fn(), False
+        path = _lock_path(endpoint, key)
+        deadline = time.monotonic() + settings.COALESCE_TIMEOUT
+        while True:
+            fd = _try_lock(path)
+            if fd is not None:
+                try:
+                    # Блокировка свободна: результат другого воркера мог уже появиться в кеше
+                    value = lookup()
+                    if value is not None:
+                        coalesce_stats.record(endpoint, 'cross_worker')
+                        return value, True
+                    coalesce_stats.record(endpoint, 'leaders')
+                    return fn(), False
+                finally:
+                    _unlock(path, fd)
+            if time.monotonic() >= deadline:
+                coalesce_stats.record(endpoint, 'timeouts')
+                return fn(), False
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    async def arun(self, endpoint, key, fn, lookup=None):
+        """Асинхронный run: fn и lookup — корутинные функции"""
+        if not settings.COALESCE_ENABLED or key is None:
+            return await fn(), False
+        name = f'{endpoint}:{key}'
+        loop = asyncio.get_running_loop()
+        future = self._futures.get(name)
+        if future is not None and future.get_loop() is loop:
+            try:
+                value = await asyncio.wait_for(asyncio.shield(future), settings.COALESCE_TIMEOUT)
+            except asyncio.TimeoutError:
+                coalesce_stats.record(endpoint, 'timeouts')
+                logger.warning(f"Coalesced {endpoint} call timed out, calling upstream directly")
+                return await fn(), False
+            except asyncio.CancelledError:
+                # Лидер отменен (клиент отключился) — выполняем запрос сами
+                if not future.cancelled():
+                    raise
+                return await fn(), False
+            coalesce_stats.record(endpoint, 'in_process')
+            return value, True
+
+        future = self._futures[name] = loop.create_future()
+        try:
+            value, shared = await self._alead(endpoint, key, fn, lookup)
+            future.set_result(value)
+            return value, shared
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Ошибку получат ожидающие; без них asyncio не должен ругаться на непрочитанное исключение
+            future.exception()
+            raise
+        finally:
+            if self._futures.get(name) is future:
+                del self._futures[name]
+
+    async def _alead(self, endpoint, key, fn, lookup):
+        if not _cross_worker_enabled(lookup):
+            coalesce_stats.record(endpoint, 'leaders')
+            return await fn(), False
+        path = _lock_path(endpoint, key)
+        deadline = time.monotonic() + settings.COALESCE_TIMEOUT
+        while True:
+            fd = _try_lock(path)
+            if fd is not None:
+                try:
+                    value = await lookup()
+                    if value is not None:
+                        coalesce_stats.record(endpoint, 'cross_worker')
+                        return value, True
+                    coalesce_stats.record(endpoint, 'leaders')
+                    return await fn(), False
+                finally:
+                    _unlock(path, fd)
+            if time.monotonic() >= deadline:
+                coalesce_stats.record(endpoint, 'timeouts')
+                return await fn(), False
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,107 @@
+"""
+Документы и диалоги /copilot/ask/.
+
+Документ загружается один раз; его id — sha256 текста, поэтому повторная
+загрузка того же текста возвращает тот же id без новой записи. Диалог хранит
+вопросы и ответы в БД: в модель уходят краткое содержание свернутых ходов
+и несвернутые ходы. Когда они вместе больше CONVERSATION_SUMMARY_THRESHOLD_TOKENS,
+старые ходы перед следующим вопросом сворачиваются отдельным запросом к модели,
+и размер промпта не растет с длиной диалога.
+"""
+import hashlib
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .exceptions import OpenAIAPIException
+from .models import Conversation, ConversationTurn, Document
+from .tokens import completion_with_usage, estimate_request_tokens, estimate_text_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Сократи диалог пользователя с ИИ-помощником до краткого содержания: о чем спрашивали, "
+    "какие ответы и факты уже прозвучали. Без вступлений, не больше 10 предложений."
+)
+
+
+def document_id(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def save_document(text):
+    """Сохраняет текст, если его еще нет; возвращает (Document без поля text, создан ли)"""
+    digest = document_id(text)
+    document = Document.objects.defer('text').filter(pk=digest).first()
+    if document is not None:
+        return document, False
+    try:
+        with transaction.atomic():
+            document = Document.objects.create(
+                id=digest, text=text, chars=len(text), estimated_tokens=estimate_text_tokens(text)
+            )
+        return document, True
+    except IntegrityError:
+        # Тот же текст одновременно загрузил другой запрос
+        return Document.objects.defer('text').get(pk=digest), False
+
+
+def conversation_history(conversation):
+    """
+    Сообщения истории для запроса к модели. Если история длиннее порога,
+    старые ходы сначала сворачиваются в краткое содержание.
+    """
+    turns = list(conversation.turns.filter(summarized=False).only('id', 'question', 'answer'))
+    tokens = estimate_text_tokens(conversation.summary) + sum(
+        estimate_text_tokens(turn.question) + estimate_text_tokens(turn.answer) for turn in turns
+    )
+    split = max(len(turns) - settings.CONVERSATION_KEEP_TURNS, 0)
+    if tokens > settings.CONVERSATION_SUMMARY_THRESHOLD_TOKENS and split and compact(conversation, turns[:split]):
+        turns = turns[split:]
+    messages = []
+    if conversation.summary:
+        messages.append({
+            "role": "system", "content": f"Краткое содержание предыдущей части диалога: {conversation.summary}"
+        })
+    for turn in turns:
+        messages.append({"role": "user", "content": turn.question})
+        messages.append({"role": "assistant", "content": turn.answer})
+    return messages
+
+
+def compact(conversation, turns):
+    """Сворачивает ходы вместе с прежним кратким содержанием; при ошибке OpenAI история остается как есть"""
+    transcript = '\n\n'.join(f"Пользователь: {turn.question}\nПомощник: {turn.answer}" for turn in turns)
+    if conversation.summary:
+        transcript = f"Краткое содержание до этого: {conversation.summary}\n\n{transcript}"
+    request_kwargs = dict(
+        model=settings.CONVERSATION_SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ],
+        temperature=0,
+        max_tokens=settings.CONVERSATION_SUMMARY_MAX_TOKENS,
+    )
+    try:
+        response, _ = completion_with_usage(
+            'conversation_summary', estimate_request_tokens(request_kwargs), **request_kwargs
+        )
+    except OpenAIAPIException as exc:
+        logger.warning(f"Conversation {conversation.pk} summary failed ({exc.status_code}), sending full history")
+        return False
+    summary = response.choices[0].message.content.strip()
+    with transaction.atomic():
+        ConversationTurn.objects.filter(pk__in=[turn.pk for turn in turns]).update(summarized=True)
+        Conversation.objects.filter(pk=conversation.pk).update(summary=summary, updated_at=timezone.now())
+    conversation.summary = summary
+    return True
+
+
+def record_turn(conversation, question, answer, model=''):
+    if not answer:
+        return
+    ConversationTurn.objects.create(conversation=conversation, question=question, answer=answer, model=model or '')
+    Conversation.objects.filter(pk=conversation.pk).update(updated_at=timezone.now())
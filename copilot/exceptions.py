@@ -2,6 +2,7 @@ from rest_framework.views import exception_handler
 from rest_framework.response import Response
 from rest_framework import status
 import logging
+import math
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +15,13 @@ class OpenAIAPIException(Exception):
         super().__init__(self.message)
 
 
+class UpstreamUnavailableException(OpenAIAPIException):
+    """OpenAI временно недоступен (разомкнут circuit breaker или исчерпан лимит запросов)"""
+    def __init__(self, message, retry_after=None, status_code=503):
+        self.retry_after = retry_after
+        super().__init__(message, status_code=status_code)
+
+
 class ContentModerationException(Exception):
     """Исключение для ошибок модерации контента"""
     def __init__(self, message, content_id=None):
@@ -24,9 +32,19 @@ class ContentModerationException(Exception):
 
 class FileValidationException(Exception):
     """Исключение для ошибок валидации файлов"""
-    def __init__(self, message, file_name=None):
+    def __init__(self, message, file_name=None, status_code=400):
         self.message = message
         self.file_name = file_name
+        self.status_code = status_code
+        super().__init__(self.message)
+
+
+class TokenBudgetException(Exception):
+    """Запрос к модели превышает допустимое число входных токенов"""
+    def __init__(self, message, estimated_tokens=None, budget=None):
+        self.message = message
+        self.estimated_tokens = estimated_tokens
+        self.budget = budget
         super().__init__(self.message)
 
 
@@ -48,33 +66,78 @@ def custom_exception_handler(exc, context):
         response.data = custom_response_data
     
     # Обработка кастомных исключений
+    custom = custom_exception_payload(exc)
+    if custom is not None:
+        data, status_code = custom
+        return Response(data, status=status_code, headers=custom_exception_headers(exc))
+    
+    return response
+
+
+def retry_after_seconds(exc):
+    """Целое число секунд для Retry-After или None"""
+    retry_after = getattr(exc, 'retry_after', None)
+    if retry_after is None:
+        return None
+    return max(1, math.ceil(retry_after))
+
+
+def custom_exception_headers(exc):
+    """Заголовки ответа для кастомных исключений: Retry-After, когда известно время восстановления"""
+    retry_after = retry_after_seconds(exc)
+    return None if retry_after is None else {'Retry-After': str(retry_after)}
+
+
+def custom_exception_payload(exc):
+    """Тело и статус ответа для кастомных исключений (None для остальных)"""
+    if isinstance(exc, UpstreamUnavailableException):
+        logger.warning(f"OpenAI unavailable: {exc.message}")
+        return {
+            'error': True,
+            'message': 'AI сервис временно недоступен, повторите запрос позже',
+            'details': exc.message,
+            'retry_after': retry_after_seconds(exc),
+            'status_code': exc.status_code
+        }, exc.status_code
+
     if isinstance(exc, OpenAIAPIException):
         logger.error(f"OpenAI API Error: {exc.message}")
-        return Response({
+        return {
             'error': True,
             'message': 'Ошибка при обращении к AI сервису',
             'details': exc.message,
             'status_code': exc.status_code
-        }, status=exc.status_code)
+        }, exc.status_code
     
     if isinstance(exc, ContentModerationException):
         logger.error(f"Content Moderation Error: {exc.message}")
-        return Response({
+        return {
             'error': True,
             'message': 'Ошибка при модерации контента',
             'details': exc.message,
             'content_id': exc.content_id,
             'status_code': 400
-        }, status=status.HTTP_400_BAD_REQUEST)
+        }, status.HTTP_400_BAD_REQUEST
+    
+    if isinstance(exc, TokenBudgetException):
+        logger.warning(f"Token budget exceeded: {exc.message}")
+        return {
+            'error': True,
+            'message': 'Превышен лимит токенов запроса',
+            'details': exc.message,
+            'estimated_tokens': exc.estimated_tokens,
+            'budget': exc.budget,
+            'status_code': 413
+        }, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
     
     if isinstance(exc, FileValidationException):
         logger.error(f"File Validation Error: {exc.message}")
-        return Response({
+        return {
             'error': True,
             'message': 'Ошибка валидации файла',
             'details': exc.message,
             'file_name': exc.file_name,
-            'status_code': 400
-        }, status=status.HTTP_400_BAD_REQUEST)
+            'status_code': exc.status_code
+        }, exc.status_code
     
-    return response
+    return None
@@ -0,0 +1,173 @@
+"""
+История модерации в БД (Content, ModerationResult, Tag).
+
+Запись не задерживает ответ: результаты складываются в очередь процесса,
+а фоновый поток пишет их пачками (до MODERATION_HISTORY_BATCH_SIZE записей
+или раз в MODERATION_HISTORY_FLUSH_INTERVAL секунд) в одной транзакции.
+Теги привязываются одним bulk_create в промежуточную таблицу, а id тегов
+по имени кешируются в процессе, поэтому на каждый тег запросов нет.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+
+from .metrics import HISTORY_RECORDS
+from .models import Content, ModerationResult, Tag
+
+logger = logging.getLogger(__name__)
+
+SAFETY_STATUSES = {status for status, _ in Content.SAFETY_STATUSES}
+
+
+class TagCache:
+    """Соответствие имени тега и его id; недостающие теги создаются одним запросом"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+
+    def ids(self, names):
+        names = set(names)
+        with self._lock:
+            missing = names - self._ids.keys()
+        if missing:
+            Tag.objects.bulk_create([Tag(name=name) for name in missing], ignore_conflicts=True)
+            found = dict(Tag.objects.filter(name__in=missing).values_list('name', 'id'))
+            with self._lock:
+                self._ids.update(found)
+        with self._lock:
+            return {name: self._ids[name] for name in names if name in self._ids}
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+tag_cache = TagCache()
+
+
+def attach_tags(items):
+    """Привязывает теги к результатам одним INSERT; items — пары (ModerationResult, имена тегов)"""
+    ids = tag_cache.ids(name for _, names in items for name in names)
+    through = ModerationResult.detected_tags.through
+    through.objects.bulk_create(
+        [
+            through(moderationresult_id=result.pk, tag_id=ids[name])
+            for result, names in items for name in names if name in ids
+        ],
+        ignore_conflicts=True,
+    )
+
+
+class HistoryRecord:
+    def __init__(self, file_type, content_hash, result, file_name=''):
+        self.file_type = file_type
+        self.content_hash = content_hash
+        self.result = result
+        self.file_name = file_name
+
+
+def safety_status(result):
+    verdict = result.get('verdict')
+    return verdict if verdict in SAFETY_STATUSES else 'error'
+
+
+def write_history(records):
+    """Пишет пачку записей: Content, ModerationResult и теги — по одному bulk-запросу на таблицу"""
+    with transaction.atomic():
+        contents = Content.objects.bulk_create([
+            Content(
+                file=record.file_name, file_type=record.file_type, content_hash=record.content_hash,
+                safety_status=safety_status(record.result),
+            )
+            for record in records
+        ])
+        results = ModerationResult.objects.bulk_create([
+            ModerationResult(
+                content=content, verdict=safety_status(record.result),
+                explanation=record.result.get('explanation', ''), ai_analysis_raw=record.result,
+            )
+            for content, record in zip(contents, records)
+        ])
+        attach_tags([(result, record.result.get('tags') or []) for result, record in zip(results, records)])
+
+
+class HistoryWriter:
+    """Фоновый поток, который пишет историю пачками; запускается в каждом процессе лениво"""
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+        self._queue = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=settings.MODERATION_HISTORY_QUEUE_SIZE)
+            threading.Thread(target=self.run, name='copilot-history-writer', daemon=True).start()
+
+    def submit(self, record):
+        self.ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            HISTORY_RECORDS.labels('dropped').inc()
+            logger.warning("Moderation history queue is full, record dropped")
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + settings.MODERATION_HISTORY_FLUSH_INTERVAL
+            try:
+                while len(batch) < settings.MODERATION_HISTORY_BATCH_SIZE:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                pass
+            self._write(batch)
+
+    def flush(self):
+        """Синхронно записывает все, что осталось в очереди (при завершении процесса)"""
+        if self._pid != os.getpid():
+            return
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            try:
+                write_history(batch)
+            except IntegrityError:
+                # Теги могли удалить (create_tags --reset) — id в кеше устарели
+                tag_cache.clear()
+                write_history(batch)
+            HISTORY_RECORDS.labels('written').inc(len(batch))
+        except Exception:
+            HISTORY_RECORDS.labels('failed').inc(len(batch))
+            logger.exception(f"Failed to write {len(batch)} moderation history records")
+        finally:
+            close_old_connections()
+
+
+history_writer = HistoryWriter()
+atexit.register(history_writer.flush)
+
+
+def record_moderation(file_type, content_hash, result, file_name=''):
+    """Ставит результат модерации в очередь записи истории"""
+    history_writer.submit(HistoryRecord(file_type, content_hash, result, file_name))
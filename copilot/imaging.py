@@ -0,0 +1,141 @@
+import base64
+import logging
+import time
+from io import BytesIO
+
+from PIL import Image
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Форматы, которые OpenAI Vision принимает как есть
+PASSTHROUGH_FORMATS = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+}
+
+OUTPUT_MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+}
+
+
+class PreparedImage:
+    """Результат предобработки: data URL для OpenAI и статистика по этапам"""
+
+    def __init__(self, data_url, width, height, passthrough, timings, bytes_in, bytes_out):
+        self.data_url = data_url
+        self.width = width
+        self.height = height
+        self.passthrough = passthrough
+        self.timings = timings
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+
+    def stats(self):
+        return {
+            'passthrough': self.passthrough,
+            'width': self.width,
+            'height': self.height,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_saved': self.bytes_in - self.bytes_out,
+            'timings_ms': {stage: round(value * 1000, 2) for stage, value in self.timings.items()},
+        }
+
+
+def _encode_data_url(mime, data):
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def _passthrough(image_file, mime):
+    """Кодирует исходные байты без декодирования и без лишних копий"""
+    raw = getattr(image_file, 'file', None)
+    image_file.seek(0)
+    if isinstance(raw, BytesIO):
+        # InMemoryUploadedFile: base64 прямо из буфера загрузки
+        with raw.getbuffer() as view:
+            return _encode_data_url(mime, view)
+    return _encode_data_url(mime, image_file.read())
+
+
+def image_to_data_url(img):
+    """Кодирует уже подготовленное изображение PIL в data URL (формат и качество из настроек)"""
+    output_format = settings.MODERATION_IMAGE_FORMAT
+    if output_format == 'JPEG' and img.mode != 'RGB':
+        img = img.convert('RGB')
+    buffer = BytesIO()
+    save_options = {'format': output_format}
+    if output_format in ('JPEG', 'WEBP'):
+        save_options['quality'] = settings.MODERATION_IMAGE_QUALITY
+    img.save(buffer, **save_options)
+    with buffer.getbuffer() as view:
+        return _encode_data_url(OUTPUT_MIME_TYPES[output_format], view)
+
+
+def prepare_image(image_file):
+    """
+    Готовит изображение к отправке в OpenAI Vision.
+    Небольшие JPEG/PNG/WebP уходят без изменений, остальные уменьшаются
+    до MODERATION_IMAGE_MAX_DIMENSION и перекодируются в заданный формат.
+    """
+    max_dimension = settings.MODERATION_IMAGE_MAX_DIMENSION
+    timings = {}
+    bytes_in = image_file.size
+
+    started = time.perf_counter()
+    image_file.seek(0)
+    # Image.open читает только заголовок, пиксели еще не декодированы
+    img = Image.open(image_file)
+    width, height = img.size
+    timings['open'] = time.perf_counter() - started
+
+    mime = PASSTHROUGH_FORMATS.get(img.format)
+    if (
+        mime is not None
+        and max(width, height) <= max_dimension
+        and bytes_in <= settings.MODERATION_IMAGE_PASSTHROUGH_MAX_BYTES
+    ):
+        started = time.perf_counter()
+        data_url = _passthrough(image_file, mime)
+        timings['base64'] = time.perf_counter() - started
+        prepared = PreparedImage(data_url, width, height, True, timings, bytes_in, bytes_in)
+        logger.info(f"Image preprocessing: {prepared.stats()}")
+        return prepared
+
+    started = time.perf_counter()
+    if img.format == 'JPEG':
+        # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8)
+        img.draft('RGB', (max_dimension, max_dimension))
+    img.load()
+    timings['decode'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    # reducing_gap включает быстрый Image.reduce перед финальным ресемплингом
+    img.thumbnail((max_dimension, max_dimension), Image.LANCZOS, reducing_gap=2.0)
+    output_format = settings.MODERATION_IMAGE_FORMAT
+    if output_format == 'JPEG' and img.mode != 'RGB':
+        img = img.convert('RGB')
+    elif img.mode not in ('RGB', 'RGBA', 'L'):
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    timings['resize'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    buffer = BytesIO()
+    save_options = {'format': output_format}
+    if output_format in ('JPEG', 'WEBP'):
+        save_options['quality'] = settings.MODERATION_IMAGE_QUALITY
+    img.save(buffer, **save_options)
+    timings['encode'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with buffer.getbuffer() as view:
+        bytes_out = view.nbytes
+        data_url = _encode_data_url(OUTPUT_MIME_TYPES[output_format], view)
+    timings['base64'] = time.perf_counter() - started
+
+    prepared = PreparedImage(data_url, img.width, img.height, False, timings, bytes_in, bytes_out)
+    logger.info(f"Image preprocessing: {prepared.stats()}")
+    return prepared
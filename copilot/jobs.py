@@ -0,0 +1,481 @@
+"""
+Очередь асинхронных задач модерации на SQLite.
+
+Задача хранится в таблице moderation_jobs, файлы — в moderation_job_files.
+Воркер забирает задачу с арендой (visibility timeout) и продлевает ее, пока
+обрабатывает задачу: если процесс умер, задача снова становится видимой
+не позже чем через JOB_VISIBILITY_TIMEOUT. Повторы
+выполняются с экспоненциальной задержкой до JOB_MAX_ATTEMPTS попыток.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from .client import retry_delay
+from .pagination import APPROXIMATE_COUNT_LIMIT
+from .services import MODE_FULL, moderate_batch_item
+from .validators import validate_callback_url
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+KIND_IMAGE = 'image'
+KIND_BATCH = 'batch'
+
+
+class JobStore:
+    """Хранилище задач в SQLite, общее для всех процессов на хосте"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(
+            'CREATE TABLE IF NOT EXISTS moderation_jobs ('
+            ' id TEXT PRIMARY KEY, kind TEXT, mode TEXT, status TEXT, attempts INTEGER DEFAULT 0,'
+            ' file_count INTEGER, results TEXT, error TEXT, callback_url TEXT, webhook_status TEXT,'
+            ' created_at REAL, updated_at REAL, available_at REAL, lease_expires_at REAL);'
+            'CREATE INDEX IF NOT EXISTS moderation_jobs_pick ON moderation_jobs (status, available_at);'
+            'CREATE INDEX IF NOT EXISTS moderation_jobs_created ON moderation_jobs (created_at, id);'
+            'CREATE TABLE IF NOT EXISTS moderation_job_files ('
+            ' job_id TEXT, idx INTEGER, name TEXT, content_type TEXT, data BLOB,'
+            ' PRIMARY KEY (job_id, idx));'
+        )
+        if 'mode' not in {row['name'] for row in conn.execute('PRAGMA table_info(moderation_jobs)')}:
+            # Таблица создана до появления режимов; задачи без режима выполняются в full
+            try:
+                conn.execute('ALTER TABLE moderation_jobs ADD COLUMN mode TEXT')
+            except sqlite3.OperationalError:
+                pass  # колонку одновременно добавил другой процесс
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, kind, files, callback_url=None, mode=MODE_FULL):
+        """Сохраняет файлы и ставит задачу в очередь; возвращает id задачи"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT INTO moderation_jobs (id, kind, mode, status, file_count, results, callback_url,'
+                ' created_at, updated_at, available_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, kind, mode, STATUS_QUEUED, len(files), json.dumps([None] * len(files)),
+                 callback_url, now, now, now)
+            )
+            for index, upload in enumerate(files):
+                upload.seek(0)
+                conn.execute(
+                    'INSERT INTO moderation_job_files (job_id, idx, name, content_type, data) VALUES (?, ?, ?, ?, ?)',
+                    (job_id, index, upload.name, getattr(upload, 'content_type', None), upload.read())
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return job_id
+
+    def claim(self):
+        """Забирает следующую видимую задачу и выдает на нее аренду"""
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT * FROM moderation_jobs WHERE (status = ? AND available_at <= ?)'
+                ' OR (status = ? AND lease_expires_at < ?) ORDER BY available_at LIMIT 1',
+                (STATUS_QUEUED, now, STATUS_RUNNING, now)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                'UPDATE moderation_jobs SET status = ?, attempts = attempts + 1, updated_at = ?,'
+                ' lease_expires_at = ? WHERE id = ?',
+                (STATUS_RUNNING, now, now + settings.JOB_VISIBILITY_TIMEOUT, row['id'])
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return self.get(row['id'])
+
+    def extend_lease(self, job_id, attempts):
+        """
+        Продлевает аренду задачи. attempts — номер попытки при получении аренды: если задачу
+        уже забрал другой воркер, аренда не продлевается. Возвращает True, если аренда продлена.
+        """
+        cursor = self._connection().execute(
+            'UPDATE moderation_jobs SET lease_expires_at = ? WHERE id = ? AND status = ? AND attempts = ?',
+            (time.time() + settings.JOB_VISIBILITY_TIMEOUT, job_id, STATUS_RUNNING, attempts)
+        )
+        return cursor.rowcount > 0
+
+    def get(self, job_id):
+        row = self._connection().execute('SELECT * FROM moderation_jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['results'] = json.loads(job['results'] or '[]')
+        return job
+
+    def list(self, limit, after=None, status=None):
+        """Задачи от новых к старым, с ключом (created_at, id) меньше after — для постраничного вывода"""
+        conditions, params = [], []
+        if after is not None:
+            conditions.append('(created_at, id) < (?, ?)')
+            params += [float(after[0]), str(after[1])]
+        if status is not None:
+            conditions.append('status = ?')
+            params.append(status)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        rows = self._connection().execute(
+            f'SELECT * FROM moderation_jobs {where} ORDER BY created_at DESC, id DESC LIMIT ?', (*params, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def approximate_count(self, status=None):
+        """
+        Оценка числа задач без полного сканирования: по крайним rowid, а с фильтром
+        по статусу — подсчет по индексу, не больше APPROXIMATE_COUNT_LIMIT задач
+        """
+        if status is not None:
+            return self._connection().execute(
+                'SELECT COUNT(*) FROM (SELECT 1 FROM moderation_jobs WHERE status = ? LIMIT ?)',
+                (status, APPROXIMATE_COUNT_LIMIT)
+            ).fetchone()[0]
+        first, last = self._connection().execute(
+            'SELECT MIN(rowid), MAX(rowid) FROM moderation_jobs'
+        ).fetchone()
+        return 0 if first is None else last - first + 1
+
+    def load_files(self, job_id, indexes):
+        rows = self._connection().execute(
+            'SELECT idx, name, content_type, data FROM moderation_job_files WHERE job_id = ? ORDER BY idx',
+            (job_id,)
+        ).fetchall()
+        return {
+            row['idx']: SimpleUploadedFile(row['name'], row['data'], content_type=row['content_type'])
+            for row in rows if row['idx'] in indexes
+        }
+
+    # save_progress, retry_later и finish получают attempts — номер попытки, под которым воркер
+    # взял аренду (как extend_lease). Если задачу после истечения аренды забрал другой воркер,
+    # запись не выполняется и метод возвращает False: прежний владелец должен остановиться.
+
+    def save_progress(self, job_id, attempts, results):
+        cursor = self._connection().execute(
+            'UPDATE moderation_jobs SET results = ?, updated_at = ? WHERE id = ? AND attempts = ?',
+            (json.dumps(results, ensure_ascii=False), time.time(), job_id, attempts)
+        )
+        return cursor.rowcount > 0
+
+    def retry_later(self, job_id, attempts, delay, error):
+        now = time.time()
+        cursor = self._connection().execute(
+            'UPDATE moderation_jobs SET status = ?, error = ?, available_at = ?, updated_at = ?,'
+            ' lease_expires_at = NULL WHERE id = ? AND attempts = ?',
+            (STATUS_QUEUED, error, now + delay, now, job_id, attempts)
+        )
+        return cursor.rowcount > 0
+
+    def finish(self, job_id, attempts, status, error=None):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = conn.execute(
+                'UPDATE moderation_jobs SET status = ?, error = ?, updated_at = ?, lease_expires_at = NULL'
+                ' WHERE id = ? AND attempts = ?',
+                (status, error, time.time(), job_id, attempts)
+            )
+            if cursor.rowcount:
+                # Файлы больше не нужны
+                conn.execute('DELETE FROM moderation_job_files WHERE job_id = ?', (job_id,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return cursor.rowcount > 0
+
+    def set_webhook_status(self, job_id, webhook_status):
+        self._connection().execute(
+            'UPDATE moderation_jobs SET webhook_status = ? WHERE id = ?', (webhook_status, job_id)
+        )
+
+    def purge(self, older_than):
+        """Удаляет завершенные задачи (done, failed), не менявшиеся older_than секунд; возвращает их число"""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            deleted = conn.execute(
+                'DELETE FROM moderation_jobs WHERE status IN (?, ?) AND updated_at < ?',
+                (STATUS_DONE, STATUS_FAILED, time.time() - older_than)
+            ).rowcount
+            # Файлы задач, которых больше нет
+            conn.execute('DELETE FROM moderation_job_files WHERE job_id NOT IN (SELECT id FROM moderation_jobs)')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return deleted
+
+    def stats(self):
+        """Глубина очереди по статусам и возраст самой старой ожидающей задачи"""
+        conn = self._connection()
+        counts = dict(conn.execute('SELECT status, COUNT(*) FROM moderation_jobs GROUP BY status').fetchall())
+        oldest = conn.execute(
+            'SELECT MIN(created_at) FROM moderation_jobs WHERE status = ?', (STATUS_QUEUED,)
+        ).fetchone()[0]
+        return {
+            'queued': counts.get(STATUS_QUEUED, 0),
+            'running': counts.get(STATUS_RUNNING, 0),
+            'done': counts.get(STATUS_DONE, 0),
+            'failed': counts.get(STATUS_FAILED, 0),
+            'oldest_queued_age_s': round(time.time() - oldest, 2) if oldest else 0.0,
+        }
+
+
+_store = None
+
+
+def get_job_store():
+    global _store
+    if _store is None:
+        _store = JobStore(settings.JOBS_DB)
+    return _store
+
+
+def _is_retryable_item(item):
+    return item is None or (item['status'] == 'error' and item.get('status_code', 400) >= 429)
+
+
+class LeaseHeartbeat:
+    """Продлевает аренду задачи каждую треть JOB_VISIBILITY_TIMEOUT, пока задача обрабатывается"""
+
+    def __init__(self, store, job):
+        self.store = store
+        self.job = job
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"copilot-job-lease-{job['id'][:8]}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        interval = settings.JOB_VISIBILITY_TIMEOUT / 3
+        while not self._stop.wait(interval):
+            try:
+                if not self.store.extend_lease(self.job['id'], self.job['attempts']):
+                    # Задача уже завершена или ее забрал другой воркер после истечения аренды
+                    current = self.store.get(self.job['id'])
+                    if current and current['status'] == STATUS_RUNNING:
+                        logger.warning(f"Job {self.job['id']}: lease lost, the job was claimed by another worker")
+                    return
+            except sqlite3.Error as exc:
+                logger.error(f"Job {self.job['id']}: lease renewal failed: {exc}")
+
+
+def process_job(job):
+    """Модерирует файлы задачи, которые еще не обработаны или упали из-за ошибки OpenAI"""
+    store = get_job_store()
+    job_id, attempts = job['id'], job['attempts']
+    if attempts > settings.JOB_MAX_ATTEMPTS:
+        # Задача несколько раз теряла аренду (например, падал процесс)
+        if store.finish(job_id, attempts, STATUS_FAILED, 'Превышено число попыток обработки'):
+            send_webhook(job_id)
+        return
+    results = job['results']
+    pending = [index for index, item in enumerate(results) if _is_retryable_item(item)]
+    files = store.load_files(job_id, set(pending))
+    mode = job['mode'] or MODE_FULL
+    for index in pending:
+        results[index] = moderate_batch_item(index, files[index], mode)
+        if not store.save_progress(job_id, attempts, results):
+            _lease_lost(job_id)
+            return
+
+    failed = [item for item in results if _is_retryable_item(item)]
+    if not failed:
+        finished = store.finish(job_id, attempts, STATUS_DONE)
+    elif attempts < settings.JOB_MAX_ATTEMPTS:
+        delay = retry_delay(attempts - 1)
+        logger.warning(f"Job {job_id}: {len(failed)} files failed, retry in {delay:.2f}s")
+        if not store.retry_later(job_id, attempts, delay, failed[0].get('error')):
+            _lease_lost(job_id)
+        return
+    else:
+        finished = store.finish(job_id, attempts, STATUS_FAILED, failed[0].get('error'))
+    if not finished:
+        _lease_lost(job_id)
+        return
+    send_webhook(job_id)
+
+
+def _lease_lost(job_id):
+    logger.warning(f"Job {job_id}: lease lost, another worker owns the job now; stopping without writing results")
+
+
+def webhook_signature(timestamp, body):
+    """HMAC-SHA256 от "<timestamp>.<тело>" на JOB_WEBHOOK_SECRET (заголовок X-Copilot-Signature)"""
+    secret = (settings.JOB_WEBHOOK_SECRET or settings.SECRET_KEY).encode('utf-8')
+    digest = hmac.new(secret, f'{timestamp}.'.encode('utf-8') + body, hashlib.sha256).hexdigest()
+    return f'sha256={digest}'
+
+
+def send_webhook(job_id):
+    """POST результата на callback_url задачи (с повторами), тело подписано HMAC"""
+    import httpx
+
+    store = get_job_store()
+    job = store.get(job_id)
+    if not job or not job['callback_url']:
+        return
+    try:
+        # Адрес проверяется снова: DNS-запись могла измениться после постановки задачи
+        validate_callback_url(job['callback_url'])
+    except ValidationError:
+        logger.warning(f"Job {job_id}: webhook to {job['callback_url']} blocked")
+        store.set_webhook_status(job_id, 'blocked')
+        return
+    payload = job_payload(job)
+    payload['results'] = job['results']
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    for attempt in range(settings.JOB_WEBHOOK_RETRIES + 1):
+        timestamp = str(int(time.time()))
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Copilot-Timestamp': timestamp,
+            'X-Copilot-Signature': webhook_signature(timestamp, body),
+        }
+        try:
+            response = httpx.post(
+                job['callback_url'], content=body, headers=headers, timeout=settings.JOB_WEBHOOK_TIMEOUT
+            )
+            if response.status_code < 400:
+                store.set_webhook_status(job_id, f'delivered:{response.status_code}')
+                return
+            webhook_status = f'failed:{response.status_code}'
+        except httpx.HTTPError as exc:
+            webhook_status = f'failed:{exc.__class__.__name__}'
+        if attempt < settings.JOB_WEBHOOK_RETRIES:
+            time.sleep(retry_delay(attempt))
+    logger.error(f"Job {job_id}: webhook delivery to {job['callback_url']} failed ({webhook_status})")
+    store.set_webhook_status(job_id, webhook_status)
+
+
+def job_payload(job):
+    """Публичное представление задачи (без результатов)"""
+    return {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'mode': job['mode'] or MODE_FULL,
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'file_count': job['file_count'],
+        'error': job['error'],
+        'webhook_status': job['webhook_status'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    }
+
+
+class JobWorkerPool:
+    """Потоки-воркеры, опрашивающие очередь; запускаются в каждом процессе лениво"""
+
+    def __init__(self, threads):
+        self.threads = threads
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def ensure_started(self):
+        if self.threads <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            for number in range(self.threads):
+                thread = threading.Thread(
+                    target=self.run, name=f'copilot-job-worker-{number}', daemon=True
+                )
+                thread.start()
+
+    def run(self):
+        store = get_job_store()
+        while not self._stop.is_set():
+            try:
+                job = store.claim()
+            except sqlite3.Error as exc:
+                logger.error(f"Job queue error: {exc}")
+                job = None
+            if job is None:
+                self._stop.wait(settings.JOB_POLL_INTERVAL)
+                continue
+            try:
+                # Длинная пачка не должна потерять аренду и обработаться дважды
+                with LeaseHeartbeat(store, job):
+                    process_job(job)
+            except Exception:
+                # Аренда истечет, и задачу заберет другой воркер
+                logger.exception(f"Job {job['id']} crashed")
+
+    def stop(self):
+        self._stop.set()
+
+    def wait(self, timeout=None):
+        """Ждет остановки пула; возвращает True, если пул остановлен"""
+        return self._stop.wait(timeout)
+
+
+_pool = None
+
+
+def get_worker_pool():
+    global _pool
+    if _pool is None:
+        _pool = JobWorkerPool(settings.JOB_WORKER_THREADS)
+    return _pool
+
+
+def wants_job(request, validated_data):
+    """Асинхронный режим: ?async=true или указан callback_url"""
+    if validated_data.get('callback_url'):
+        return True
+    return request.GET.get('async', '').lower() in ('1', 'true', 'yes')
+
+
+def submit_job(kind, files, callback_url=None, mode=MODE_FULL):
+    """Ставит задачу в очередь и убеждается, что в процессе работают воркеры"""
+    job_id = get_job_store().enqueue(kind, files, callback_url, mode)
+    get_worker_pool().ensure_started()
+    return job_id
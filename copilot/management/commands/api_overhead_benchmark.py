@@ -0,0 +1,114 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Конфигурации: стандартный JSONRenderer/JSONParser DRF или orjson; полный набор middleware или короткий путь
+CONFIGS = {
+    'stock': {'FAST_JSON_ENABLED': 'False', 'STATELESS_API_PREFIXES': ''},
+    'fast-json': {'FAST_JSON_ENABLED': 'True', 'STATELESS_API_PREFIXES': ''},
+    'stateless': {'FAST_JSON_ENABLED': 'False', 'STATELESS_API_PREFIXES': '/copilot/'},
+    'fast': {'FAST_JSON_ENABLED': 'True', 'STATELESS_API_PREFIXES': '/copilot/'},
+}
+
+# Запросы идут через тестовый клиент Django: полный обработчик и middleware без сети и WSGI-сервера.
+# Ответ OpenAI подменен, кеш ответов ask выключен — замеряется только работа приложения
+PROBE = '''
+import json, statistics, sys, time
+from types import SimpleNamespace
+
+import django
+django.setup()
+from unittest import mock
+from django.test import Client
+import copilot.tokens
+
+requests, warmup = int(sys.argv[1]), int(sys.argv[2])
+answer = SimpleNamespace(
+    choices=[SimpleNamespace(message=SimpleNamespace(content='Кампания проходит до конца месяца.'), finish_reason='stop')],
+    usage=SimpleNamespace(prompt_tokens=120, completion_tokens=12, total_tokens=132),
+)
+client = Client()
+body = json.dumps({'context': 'Кампания проходит до конца месяца. ' * 20, 'question': 'Когда заканчивается кампания?'})
+calls = {
+    'health': lambda: client.get('/copilot/health/'),
+    'ask': lambda: client.post('/copilot/ask/', data=body, content_type='application/json'),
+}
+results = {}
+with mock.patch('copilot.tokens.chat_completion', return_value=answer):
+    for name, call in calls.items():
+        for _ in range(warmup):
+            response = call()
+            if response.status_code != 200:
+                sys.exit(f'{name}: HTTP {response.status_code} {response.content[:200]!r}')
+        timings = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - started) * 1_000_000)
+        timings.sort()
+        results[name] = {
+            'mean_us': round(statistics.fmean(timings), 1),
+            'p50_us': round(timings[len(timings) // 2], 1),
+            'p95_us': round(timings[int(len(timings) * 0.95)], 1),
+        }
+print(json.dumps(results))
+'''
+
+
+class Command(BaseCommand):
+    help = (
+        'Накладные расходы приложения на запрос /copilot/health/ и /copilot/ask/ (OpenAI подменен): '
+        'стандартный JSON DRF и orjson, полный набор middleware и короткий путь для STATELESS_API_PREFIXES'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--config', action='append', dest='configs', choices=sorted(CONFIGS),
+            help='Конфигурация (по умолчанию все: stock, fast-json, stateless, fast)',
+        )
+        parser.add_argument('--requests', type=int, default=2000, help='Запросов на эндпоинт')
+        parser.add_argument('--warmup', type=int, default=200, help='Запросов прогрева на эндпоинт')
+        parser.add_argument(
+            '--profile', default='development', choices=['development', 'production'],
+            help='COPILOT_PROFILE (development — полный набор middleware, как раньше)',
+        )
+        parser.add_argument('--output', help='Сохранить результаты в JSON')
+
+    def handle(self, *args, **options):
+        configs = options['configs'] or list(CONFIGS)
+        results = {}
+        for name in configs:
+            env = {
+                **os.environ,
+                **CONFIGS[name],
+                'DJANGO_SETTINGS_MODULE': 'backend.settings',
+                'COPILOT_PROFILE': options['profile'],
+                'OPENAI_API_KEY': 'fake',
+                'ASK_CACHE_ENABLED': 'False',
+                'COPILOT_ASYNC_VIEWS': 'False',
+            }
+            completed = subprocess.run(
+                [sys.executable, '-c', PROBE, str(options['requests']), str(options['warmup'])],
+                cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, timeout=600,
+            )
+            if completed.returncode:
+                raise CommandError(f'{name}: замер не удался:\n{completed.stderr[-2000:]}')
+            results[name] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+        self.stdout.write(f"{'конфигурация':<12} {'health, мкс':>14} {'ask, мкс':>14}   (среднее / p50)")
+        for name, result in results.items():
+            health, ask = result['health'], result['ask']
+            self.stdout.write(
+                f"{name:<12} {health['mean_us']:>7} / {health['p50_us']:<7} {ask['mean_us']:>7} / {ask['p50_us']:<7}"
+            )
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(
+                    {'profile': options['profile'], 'requests': options['requests'], 'configs': results},
+                    f, ensure_ascii=False, indent=2,
+                )
+            self.stdout.write(self.style.SUCCESS(f"Результаты сохранены в {options['output']}"))
@@ -41,12 +41,13 @@ class Command(BaseCommand):
             'abuse'
         ]
         
-        created_count = 0
-        for tag_name in dangerous_tags:
-            tag, created = Tag.objects.get_or_create(name=tag_name)
-            if created:
-                created_count += 1
-                self.stdout.write(f'Создан тег: {tag_name}')
+        # Один запрос на существующие теги и один INSERT на недостающие
+        existing = set(Tag.objects.filter(name__in=dangerous_tags).values_list('name', flat=True))
+        new_tags = [tag_name for tag_name in dangerous_tags if tag_name not in existing]
+        Tag.objects.bulk_create([Tag(name=tag_name) for tag_name in new_tags], ignore_conflicts=True)
+        created_count = len(new_tags)
+        for tag_name in new_tags:
+            self.stdout.write(f'Создан тег: {tag_name}')
         
         self.stdout.write(
             self.style.SUCCESS(
@@ -0,0 +1,85 @@
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from copilot.prefilter import load_sample
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp'}
+SWEEP_THRESHOLDS = [0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95]
+
+
+class Command(BaseCommand):
+    help = (
+        'Проверяет префильтр на размеченных изображениях. Метка — имя подпапки: '
+        'safe/... — безопасные, любые другие папки — небезопасные'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Папка с подпапками-метками (safe, unsafe, ...)')
+        parser.add_argument(
+            '--prefilter',
+            default=settings.MODERATION_PREFILTER or 'copilot.prefilter.HeuristicPrefilter',
+            help='Путь к классу префильтра (по умолчанию MODERATION_PREFILTER)',
+        )
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=settings.PREFILTER_SAFE_CONFIDENCE,
+            help='Порог уверенности для автоматического safe',
+        )
+        parser.add_argument(
+            '--show-errors',
+            action='store_true',
+            help='Вывести небезопасные изображения, которые префильтр пропустил бы',
+        )
+
+    def handle(self, *args, **options):
+        root = Path(options['directory'])
+        if not root.is_dir():
+            raise CommandError(f'Папка не найдена: {root}')
+        prefilter = import_string(options['prefilter'])()
+
+        samples = []
+        elapsed = 0.0
+        for path in sorted(root.rglob('*')):
+            if path.suffix.lower() not in IMAGE_EXTENSIONS:
+                continue
+            is_safe = path.relative_to(root).parts[0].lower() == 'safe'
+            started = time.perf_counter()
+            with open(path, 'rb') as image_file:
+                try:
+                    result = prefilter.check(load_sample(image_file))
+                except Exception as e:
+                    self.stdout.write(self.style.WARNING(f'{path}: {e}'))
+                    continue
+            elapsed += time.perf_counter() - started
+            samples.append((path, is_safe, result.confidence))
+
+        if not samples:
+            raise CommandError('Изображения не найдены')
+
+        total_safe = sum(1 for _, is_safe, _ in samples if is_safe)
+        total_unsafe = len(samples) - total_safe
+        self.stdout.write(
+            f'Изображений: {len(samples)} (safe: {total_safe}, остальные: {total_unsafe}), '
+            f'среднее время: {elapsed / len(samples) * 1000:.2f} мс'
+        )
+        self.stdout.write('порог   пропущено без модели   safe пропущено   небезопасных пропущено')
+        for threshold in sorted(set(SWEEP_THRESHOLDS + [options['threshold']])):
+            cleared_safe = sum(1 for _, is_safe, conf in samples if is_safe and conf >= threshold)
+            cleared_unsafe = sum(1 for _, is_safe, conf in samples if not is_safe and conf >= threshold)
+            line = (
+                f'{threshold:5.2f}   {(cleared_safe + cleared_unsafe) / len(samples):20.1%}   '
+                f'{cleared_safe / total_safe if total_safe else 0:14.1%}   '
+                f'{cleared_unsafe:>5} из {total_unsafe}'
+            )
+            if threshold == options['threshold']:
+                line = self.style.SUCCESS(line + '   <- текущий')
+            self.stdout.write(line)
+
+        if options['show_errors']:
+            for path, is_safe, confidence in samples:
+                if not is_safe and confidence >= options['threshold']:
+                    self.stdout.write(self.style.ERROR(f'{path} (уверенность {confidence:.3f})'))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from copilot.benchmark import FakeOpenAIConfig, FakeOpenAIServer
+
+
+def add_fake_openai_arguments(parser):
+    parser.add_argument('--latency-ms', type=float, default=800, help='Медианная задержка ответа, мс')
+    parser.add_argument(
+        '--latency-sigma', type=float, default=0.5,
+        help='Разброс задержки (sigma логнормального распределения, 0 — постоянная задержка)',
+    )
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов с ошибкой (0..1)')
+    parser.add_argument('--error-status', type=int, default=429, help='HTTP-статус ошибок')
+    parser.add_argument('--token-delay-ms', type=float, default=20, help='Пауза между токенами в потоковом режиме, мс')
+    parser.add_argument('--completion-tokens', type=int, default=60, help='Длина ответа в токенах')
+    parser.add_argument(
+        '--rate-limit-rpm', type=int, default=0,
+        help='Лимит запросов в минуту с заголовками x-ratelimit-* и ответом 429 (0 — без лимита)',
+    )
+
+
+def fake_openai_config(options):
+    return FakeOpenAIConfig(
+        latency_ms=options['latency_ms'],
+        latency_sigma=options['latency_sigma'],
+        error_rate=options['error_rate'],
+        error_status=options['error_status'],
+        token_delay_ms=options['token_delay_ms'],
+        completion_tokens=options['completion_tokens'],
+        rate_limit_rpm=options['rate_limit_rpm'],
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        'Запускает локальный OpenAI-совместимый сервер для нагрузочных тестов. '
+        'Приложение направляется на него через OPENAI_BASE_URL=http://HOST:PORT/v1'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8100)
+        add_fake_openai_arguments(parser)
+
+    def handle(self, *args, **options):
+        server = FakeOpenAIServer((options['host'], options['port']), fake_openai_config(options))
+        self.stdout.write(self.style.SUCCESS(
+            f"Fake OpenAI: http://{options['host']}:{options['port']}/v1 "
+            f"(медиана {options['latency_ms']} мс, ошибки {options['error_rate']:.0%})"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from copilot.benchmark import MemorySampler, SCENARIOS, make_scenario, run_load
+from copilot.management.commands.fake_openai import add_fake_openai_arguments
+
+WORKER_CLASS_ALIASES = {
+    'uvicorn': 'uvicorn.workers.UvicornWorker',
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def stop(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест /copilot/ask/ и /copilot/moderate-image/: запускает локальный fake OpenAI '
+        'и gunicorn с настройками Dockerfile, держит заданную нагрузку и сохраняет '
+        'p50/p95/p99, пропускную способность и память воркеров в JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--worker-class', action='append', dest='worker_classes',
+            help='Класс воркера gunicorn: sync, gthread, gevent, uvicorn (можно указать несколько раз)',
+        )
+        parser.add_argument('--workers', type=int, default=3, help='Число воркеров (как в Dockerfile)')
+        parser.add_argument('--threads', type=int, default=4, help='Потоков на воркер для gthread')
+        parser.add_argument('--timeout', type=int, default=120, help='Таймаут воркера gunicorn, сек')
+        parser.add_argument(
+            '--scenario', action='append', dest='scenarios', choices=sorted(SCENARIOS),
+            help='Сценарий нагрузки (по умолчанию ask и moderate-image)',
+        )
+        parser.add_argument('--concurrency', type=int, default=20, help='Одновременных запросов')
+        parser.add_argument('--duration', type=float, default=30, help='Длительность замера, сек')
+        parser.add_argument('--warmup', type=float, default=5, help='Прогрев перед замером, сек')
+        parser.add_argument('--image-size', default='1280x960', help='Размер тестовых изображений, ШxВ')
+        parser.add_argument('--context-chars', type=int, default=3000, help='Длина текста в запросах ask')
+        parser.add_argument(
+            '--with-cache', action='store_true',
+            help='Не отключать кеши вердиктов и ответов (по умолчанию каждый запрос идет в fake OpenAI)',
+        )
+        parser.add_argument('--output', help='Файл результатов (по умолчанию benchmark-<время>.json)')
+        add_fake_openai_arguments(parser)
+
+    def handle(self, *args, **options):
+        # httpx пишет в INFO каждый запрос генератора нагрузки
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+        worker_classes = options['worker_classes'] or ['sync']
+        scenarios = options['scenarios'] or ['ask', 'moderate-image']
+        width, height = (int(value) for value in options['image_size'].lower().split('x'))
+        started_at = datetime.now(timezone.utc)
+        output = options['output'] or f"benchmark-{started_at.strftime('%Y%m%d-%H%M%S')}.json"
+
+        fake_port = free_port()
+        fake_args = [
+            '--port', str(fake_port),
+            '--latency-ms', str(options['latency_ms']),
+            '--latency-sigma', str(options['latency_sigma']),
+            '--error-rate', str(options['error_rate']),
+            '--error-status', str(options['error_status']),
+            '--token-delay-ms', str(options['token_delay_ms']),
+            '--completion-tokens', str(options['completion_tokens']),
+            '--rate-limit-rpm', str(options['rate_limit_rpm']),
+        ]
+        fake = subprocess.Popen(
+            [sys.executable, 'manage.py', 'fake_openai', *fake_args],
+            cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL,
+        )
+        fake_url = f'http://127.0.0.1:{fake_port}'
+        try:
+            if not wait_ready(f'{fake_url}/v1/stats', fake):
+                raise CommandError('Fake OpenAI не запустился')
+            runs = []
+            for worker_class in worker_classes:
+                runs.append(self._run(worker_class, scenarios, fake_url, options, (width, height)))
+        finally:
+            stop(fake)
+
+        result = {
+            'started_at': started_at.isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'fake_openai': {
+                'latency_ms': options['latency_ms'],
+                'latency_sigma': options['latency_sigma'],
+                'error_rate': options['error_rate'],
+                'error_status': options['error_status'],
+                'token_delay_ms': options['token_delay_ms'],
+                'completion_tokens': options['completion_tokens'],
+                'rate_limit_rpm': options['rate_limit_rpm'],
+            },
+            'load': {
+                'concurrency': options['concurrency'],
+                'duration': options['duration'],
+                'warmup': options['warmup'],
+                'image_size': [width, height],
+                'context_chars': options['context_chars'],
+                'cache': options['with_cache'],
+            },
+            'runs': runs,
+        }
+        with open(output, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {output}'))
+
+    def _run(self, worker_class, scenarios, fake_url, options, image_size):
+        worker_class = WORKER_CLASS_ALIASES.get(worker_class, worker_class)
+        is_asgi = 'uvicorn' in worker_class.lower()
+        port = free_port()
+        env = {
+            **os.environ,
+            'OPENAI_BASE_URL': f'{fake_url}/v1',
+            'OPENAI_API_KEY': 'fake',
+            'COPILOT_ASYNC_VIEWS': str(is_asgi),
+        }
+        if not options['with_cache']:
+            env.update({'MODERATION_CACHE_ENABLED': 'False', 'ASK_CACHE_ENABLED': 'False'})
+        command = [
+            sys.executable, '-m', 'gunicorn',
+            '--bind', f'127.0.0.1:{port}',
+            '--workers', str(options['workers']),
+            '--timeout', str(options['timeout']),
+            '--worker-class', worker_class,
+        ]
+        if worker_class == 'gthread':
+            command += ['--threads', str(options['threads'])]
+        command.append('backend.asgi:application' if is_asgi else 'backend.wsgi:application')
+
+        self.stdout.write(f'gunicorn {worker_class}, воркеров: {options["workers"]}')
+        with tempfile.TemporaryFile() as log, tempfile.TemporaryDirectory() as state_dir:
+            # Лимиты и circuit breaker предыдущего прогона не должны влиять на этот
+            env['OPENAI_LIMITS_DB'] = os.path.join(state_dir, 'openai_limits.sqlite3')
+            server = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env, stdout=log, stderr=log)
+            base_url = f'http://127.0.0.1:{port}'
+            try:
+                if not wait_ready(f'{base_url}/copilot/health/', server):
+                    log.seek(0)
+                    raise CommandError(f'gunicorn не запустился:\n{log.read().decode(errors="replace")[-2000:]}')
+                with MemorySampler(server.pid) as idle:
+                    pass
+                results = {}
+                for name in scenarios:
+                    scenario = make_scenario(name, image_size=image_size, context_chars=options['context_chars'])
+                    upstream_before = httpx.get(f'{fake_url}/v1/stats').json()
+                    with MemorySampler(server.pid) as memory:
+                        summary = run_load(
+                            base_url, scenario, options['concurrency'], options['duration'], options['warmup'],
+                        )
+                    upstream_after = httpx.get(f'{fake_url}/v1/stats').json()
+                    summary['memory'] = memory.report()
+                    summary['upstream'] = {
+                        key: value - upstream_before.get(key, 0) for key, value in upstream_after.items()
+                    }
+                    results[name] = summary
+                    latency = summary['latency_ms']
+                    self.stdout.write(
+                        f"  {name}: {summary['throughput_rps']} rps, p50 {latency['p50']} мс, "
+                        f"p95 {latency['p95']} мс, p99 {latency['p99']} мс, ошибок {summary['errors']}, "
+                        f"пик RSS воркера {summary['memory']['worker_peak_rss_mb']} МБ"
+                    )
+            finally:
+                stop(server)
+
+        return {
+            'worker_class': worker_class,
+            'workers': options['workers'],
+            'threads': options['threads'] if worker_class == 'gthread' else None,
+            'app': 'asgi' if is_asgi else 'wsgi',
+            'idle_memory': idle.report(),
+            'scenarios': results,
+        }
@@ -0,0 +1,134 @@
+import json
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from copilot.models import Content, ModerationResult
+from copilot.pagination import KeysetPagination
+
+ALIAS = 'pagination_benchmark'
+VERDICTS = ['safe', 'potentially_unsafe', 'unsafe']
+
+
+def _median_ms(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 2)
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает постраничный вывод истории модерации через COUNT(*) + OFFSET и по ключу (created_at, id) '
+        'на синтетической таблице во временной SQLite: время первой и глубоких страниц'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Число строк в синтетической таблице')
+        parser.add_argument('--page-size', type=int, default=20, help='Записей на странице')
+        parser.add_argument(
+            '--depth', type=float, action='append', dest='depths',
+            help='Глубина страницы как доля таблицы (по умолчанию 0, 0.01, 0.5, 0.99)',
+        )
+        parser.add_argument('--repeat', type=int, default=5, help='Повторов каждого замера (берется медиана)')
+        parser.add_argument('--output', help='Сохранить результаты в JSON')
+
+    def handle(self, *args, **options):
+        depths = options['depths'] or [0, 0.01, 0.5, 0.99]
+        page_size = options['page_size']
+        with tempfile.TemporaryDirectory() as directory:
+            connections.settings[ALIAS] = {
+                **connections.settings['default'],
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(directory, 'history.sqlite3'),
+            }
+            try:
+                self._create(options['rows'])
+                queryset = ModerationResult.objects.using(ALIAS).select_related('content')
+                rows = []
+                for depth in depths:
+                    offset = min(int(options['rows'] * depth), options['rows'] - page_size)
+                    rows.append({
+                        'depth': depth,
+                        'offset': offset,
+                        'offset_ms': _median_ms(lambda: self._offset_page(queryset, offset, page_size), options['repeat']),
+                        'keyset_ms': _median_ms(
+                            self._keyset_page(queryset, offset, page_size), options['repeat']
+                        ),
+                    })
+            finally:
+                connections[ALIAS].close()
+                del connections.settings[ALIAS]
+
+        self.stdout.write(f"Строк: {options['rows']}, записей на странице: {page_size}")
+        self.stdout.write(f"{'смещение':>10} {'COUNT+OFFSET, мс':>18} {'по ключу, мс':>14}")
+        for row in rows:
+            self.stdout.write(f"{row['offset']:>10} {row['offset_ms']:>18} {row['keyset_ms']:>14}")
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'rows': options['rows'], 'page_size': page_size, 'pages': rows}, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Результаты сохранены в {options['output']}"))
+
+    def _create(self, count):
+        """Таблицы истории и count результатов (по одному на Content); время повторяется, чтобы проверить id"""
+        connection = connections[ALIAS]
+        with connection.schema_editor() as editor:
+            editor.create_model(Content)
+            editor.create_model(ModerationResult)
+        started = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        content_table = Content._meta.db_table
+        result_table = ModerationResult._meta.db_table
+        batch = 50_000
+        self.stdout.write(f'Заполнение таблицы: {count} строк...')
+        # Без транзакции каждый INSERT — отдельный коммит с fsync
+        with transaction.atomic(using=ALIAS), connection.cursor() as cursor:
+            for first in range(1, count + 1, batch):
+                ids = range(first, min(first + batch, count + 1))
+                times = [
+                    connection.ops.adapt_datetimefield_value(started + timedelta(seconds=number // 3))
+                    for number in ids
+                ]
+                cursor.executemany(
+                    f'INSERT INTO {content_table} (id, file, file_type, content_hash, safety_status, created_at)'
+                    ' VALUES (%s, %s, %s, %s, %s, %s)',
+                    [(number, '', 'image', f'{number:064x}', VERDICTS[number % 3], created_at)
+                     for number, created_at in zip(ids, times)]
+                )
+                cursor.executemany(
+                    f'INSERT INTO {result_table} (id, content_id, verdict, explanation, ai_analysis_raw, created_at)'
+                    ' VALUES (%s, %s, %s, %s, %s, %s)',
+                    [(number, number, VERDICTS[number % 3], '', '{}', created_at)
+                     for number, created_at in zip(ids, times)]
+                )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def _offset_page(self, queryset, offset, page_size):
+        """Как PageNumberPagination: COUNT(*) и срез страницы через OFFSET"""
+        paginator = Paginator(queryset.order_by('-created_at', '-pk'), page_size)
+        page = paginator.page(offset // page_size + 1)
+        return paginator.count, list(page.object_list)
+
+    def _keyset_page(self, queryset, offset, page_size):
+        """Курсор берется заранее (как из ответа предыдущей страницы), замеряется только сама страница"""
+        pagination = KeysetPagination()
+        cursor = None
+        if offset:
+            previous = queryset.order_by('-created_at', '-pk')[offset - 1]
+            cursor = pagination.encode_cursor((previous.created_at.isoformat(), previous.pk))
+        params = {'page_size': page_size, **({'cursor': cursor} if cursor else {})}
+        request = Request(APIRequestFactory().get('/copilot/history/', params))
+
+        def page():
+            return KeysetPagination().paginate_queryset(queryset, request)
+        return page
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from copilot.services import get_answer_cache, get_verdict_cache
+
+
+class Command(BaseCommand):
+    help = 'Очищает кеш вердиктов модерации (например, после изменения промпта)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Удалить все записи, включая записи текущей версии промпта',
+        )
+        parser.add_argument(
+            '--ask',
+            action='store_true',
+            help='Очистить кеш ответов /copilot/ask/ вместо кеша вердиктов',
+        )
+
+    def handle(self, *args, **options):
+        cache = get_answer_cache() if options['ask'] else get_verdict_cache()
+        if cache.store is None:
+            setting = 'ASK_CACHE_DB' if options['ask'] else 'MODERATION_CACHE_DB'
+            self.stdout.write(
+                self.style.WARNING(f'Дисковый уровень кеша отключен ({setting}), очищать нечего')
+            )
+            return
+
+        deleted = cache.purge(stale_only=not options['all'])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Удалено записей: {deleted}. Осталось: {cache.store.count()} '
+                f'(текущая версия промпта: {cache.version}).'
+            )
+        )
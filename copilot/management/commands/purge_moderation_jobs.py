@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from copilot.jobs import get_job_store
+
+
+class Command(BaseCommand):
+    help = 'Удаляет завершенные задачи асинхронной модерации старше JOB_RETENTION_DAYS дней'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=float,
+            default=None,
+            help='Срок хранения завершенных задач в днях (по умолчанию JOB_RETENTION_DAYS)',
+        )
+
+    def handle(self, *args, **options):
+        days = settings.JOB_RETENTION_DAYS if options['days'] is None else options['days']
+        store = get_job_store()
+        deleted = store.purge(days * 24 * 3600)
+        self.stdout.write(
+            self.style.SUCCESS(f'Удалено задач: {deleted}. Очередь: {store.stats()}')
+        )
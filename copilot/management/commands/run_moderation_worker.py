@@ -0,0 +1,30 @@
+import signal
+
+from django.core.management.base import BaseCommand
+from copilot.jobs import JobWorkerPool, get_job_store
+
+
+class Command(BaseCommand):
+    help = 'Запускает отдельный процесс-воркер очереди асинхронной модерации'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=4,
+            help='Количество потоков-воркеров',
+        )
+
+    def handle(self, *args, **options):
+        pool = JobWorkerPool(options['threads'])
+        signal.signal(signal.SIGTERM, lambda *_: pool.stop())
+        self.stdout.write(
+            self.style.SUCCESS(f"Воркер запущен ({options['threads']} потоков). Очередь: {get_job_store().stats()}")
+        )
+        pool.ensure_started()
+        try:
+            while not pool.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pool.stop()
+        self.stdout.write('Воркер остановлен')
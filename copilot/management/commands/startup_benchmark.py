@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from copilot.benchmark import child_pids, make_scenario, pss_mb, rss_mb, run_load
+from copilot.management.commands.load_benchmark import free_port, stop, wait_ready
+
+PROFILES = ['development', 'production']
+# Трафик, после которого воркер загрузил все тяжелые модули: ask с длинным текстом (BM25 на NumPy) и модерация
+TRAFFIC_SCENARIOS = ['ask', 'moderate-image']
+TRAFFIC_CONTEXT_CHARS = 20000
+
+# Что делает воркер gunicorn до первого запроса (setup, WSGI-приложение, URLconf со всеми view),
+# затем — догрузка отложенных модулей, как в мастере при --preload
+IMPORT_PROBE = '''
+import json, os, time
+
+def rss_mb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+
+started = time.perf_counter()
+import django
+django.setup()
+from django.core.wsgi import get_wsgi_application
+from django.urls import get_resolver
+get_wsgi_application()
+get_resolver().url_patterns
+boot_ms = (time.perf_counter() - started) * 1000
+boot_rss = rss_mb()
+from copilot.startup import warm_up
+started = time.perf_counter()
+warm_up()
+print(json.dumps({
+    'boot_ms': boot_ms, 'boot_rss_mb': boot_rss,
+    'warm_up_ms': (time.perf_counter() - started) * 1000, 'warm_rss_mb': rss_mb(),
+}))
+'''
+
+
+def _round(value):
+    return round(value, 1) if value is not None else None
+
+
+class Command(BaseCommand):
+    help = (
+        'Время старта воркера и память: импорт приложения в профилях development и production '
+        '(отдельный процесс, медиана по --repeat) и gunicorn без --preload и с ним — время до первого '
+        'ответа /copilot/health/, RSS и PSS каждого воркера сразу после старта и после короткого трафика '
+        'ask и moderate-image через локальный fake OpenAI'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profile', action='append', dest='profiles', choices=PROFILES,
+            help='Профиль COPILOT_PROFILE (по умолчанию оба)',
+        )
+        parser.add_argument('--workers', type=int, default=3, help='Число воркеров gunicorn (как в Dockerfile)')
+        parser.add_argument('--repeat', type=int, default=5, help='Повторов замера импорта (берется медиана)')
+        parser.add_argument(
+            '--traffic-duration', type=float, default=5,
+            help='Секунд трафика на каждый сценарий перед вторым замером памяти',
+        )
+        parser.add_argument('--output', help='Сохранить результаты в JSON')
+
+    def handle(self, *args, **options):
+        # httpx пишет в INFO каждый запрос
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+        profiles = options['profiles'] or PROFILES
+        fake_port = free_port()
+        fake = subprocess.Popen(
+            [sys.executable, 'manage.py', 'fake_openai', '--port', str(fake_port), '--latency-ms', '50'],
+            cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL,
+        )
+        fake_url = f'http://127.0.0.1:{fake_port}'
+        try:
+            if not wait_ready(f'{fake_url}/v1/stats', fake):
+                raise CommandError('Fake OpenAI не запустился')
+            results = [self._measure_profile(profile, fake_url, options) for profile in profiles]
+        finally:
+            stop(fake)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'workers': options['workers'], 'profiles': results}, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Результаты сохранены в {options['output']}"))
+
+    def _measure_profile(self, profile, fake_url, options):
+        env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': 'backend.settings',
+            'COPILOT_PROFILE': profile,
+            'OPENAI_BASE_URL': f'{fake_url}/v1',
+            'OPENAI_API_KEY': 'fake',
+            'MODERATION_CACHE_ENABLED': 'False',
+            'ASK_CACHE_ENABLED': 'False',
+        }
+        for name in ('ADMIN_ENABLED', 'API_DOCS_ENABLED', 'BROWSABLE_API_ENABLED'):
+            env.pop(name, None)
+        imports = self._measure_imports(env, options['repeat'])
+        self.stdout.write(
+            f"{profile}: импорт {imports['boot_ms']} мс, RSS {imports['boot_rss_mb']} МБ; "
+            f"догрузка отложенных модулей {imports['warm_up_ms']} мс, RSS {imports['warm_rss_mb']} МБ"
+        )
+        servers = []
+        for preload in (False, True):
+            server = self._measure_gunicorn(env, preload, options)
+            servers.append(server)
+            idle, loaded = server['idle'], server['after_traffic']
+            self.stdout.write(
+                f"  gunicorn{' --preload' if preload else ''}: первый ответ через {server['ready_ms']} мс; "
+                f"после старта воркер RSS {idle['worker_rss_mb']} МБ, PSS {idle['worker_pss_mb']} МБ; "
+                f"после трафика воркер RSS {loaded['worker_rss_mb']} МБ, PSS {loaded['worker_pss_mb']} МБ, "
+                f"всего PSS {loaded['total_pss_mb']} МБ"
+            )
+        return {'profile': profile, 'imports': imports, 'gunicorn': servers}
+
+    def _measure_imports(self, env, repeat):
+        samples = []
+        for _ in range(repeat):
+            completed = subprocess.run(
+                [sys.executable, '-c', IMPORT_PROBE], cwd=settings.BASE_DIR, env=env,
+                capture_output=True, text=True, timeout=120,
+            )
+            if completed.returncode:
+                raise CommandError(f'Не удалось импортировать приложение:\n{completed.stderr[-2000:]}')
+            samples.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        return {key: _round(statistics.median(sample[key] for sample in samples)) for key in samples[0]}
+
+    def _measure_gunicorn(self, env, preload, options):
+        port = free_port()
+        command = [
+            sys.executable, '-m', 'gunicorn',
+            '--bind', f'127.0.0.1:{port}',
+            '--workers', str(options['workers']),
+        ]
+        if preload:
+            command.append('--preload')
+        command.append('backend.wsgi:application')
+        base_url = f'http://127.0.0.1:{port}'
+        with tempfile.TemporaryFile() as log, tempfile.TemporaryDirectory() as state_dir:
+            server_env = {
+                **env,
+                'PROMETHEUS_MULTIPROC_DIR': os.path.join(state_dir, 'prometheus'),
+                'OPENAI_LIMITS_DB': os.path.join(state_dir, 'openai_limits.sqlite3'),
+            }
+            started = time.perf_counter()
+            server = subprocess.Popen(command, cwd=settings.BASE_DIR, env=server_env, stdout=log, stderr=log)
+            try:
+                if not wait_ready(f'{base_url}/copilot/health/', server, timeout=60):
+                    log.seek(0)
+                    raise CommandError(f'gunicorn не запустился:\n{log.read().decode(errors="replace")[-2000:]}')
+                ready_ms = (time.perf_counter() - started) * 1000
+                # Дать запуститься всем воркерам, а не только ответившему первым
+                time.sleep(1)
+                idle = memory_snapshot(server.pid)
+                traffic = {}
+                for name in TRAFFIC_SCENARIOS:
+                    scenario = make_scenario(name, image_size=(640, 480), context_chars=TRAFFIC_CONTEXT_CHARS)
+                    summary = run_load(base_url, scenario, options['workers'] * 2, options['traffic_duration'], warmup=0)
+                    traffic[name] = {'requests': summary['requests'], 'errors': summary['errors']}
+                after_traffic = memory_snapshot(server.pid)
+            finally:
+                stop(server)
+        return {
+            'preload': preload,
+            'ready_ms': round(ready_ms),
+            'idle': idle,
+            'traffic': traffic,
+            'after_traffic': after_traffic,
+        }
+
+
+def memory_snapshot(master_pid):
+    """RSS и PSS мастера и каждого воркера; PSS учитывает общие после fork страницы"""
+    workers = {
+        str(pid): {'rss_mb': _round(rss_mb(pid)), 'pss_mb': _round(pss_mb(pid))}
+        for pid in child_pids(master_pid)
+    }
+    master = {'rss_mb': _round(rss_mb(master_pid)), 'pss_mb': _round(pss_mb(master_pid))}
+
+    def worst(key):
+        return max((worker[key] or 0 for worker in workers.values()), default=0.0)
+    return {
+        'master': master,
+        'workers': workers,
+        'worker_rss_mb': worst('rss_mb'),
+        'worker_pss_mb': worst('pss_mb'),
+        'total_pss_mb': _round(sum(worker['pss_mb'] or 0 for worker in workers.values()) + (master['pss_mb'] or 0)),
+    }
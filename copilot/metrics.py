@@ -0,0 +1,168 @@
+"""
+Метрики Prometheus для /copilot/metrics/.
+
+Под gunicorn у каждого воркера свои счетчики, поэтому при заданной
+переменной окружения PROMETHEUS_MULTIPROC_DIR prometheus_client пишет
+значения в mmap-файлы этого каталога, а эндпоинт собирает их со всех
+процессов (MultiProcessCollector). Каталог очищается при старте gunicorn,
+файлы завершившихся воркеров помечаются в gunicorn.conf.py.
+"""
+import os
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram(
+    'copilot_request_duration_seconds', 'Время обработки запроса по представлениям',
+    ['view', 'method', 'status'], buckets=REQUEST_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'copilot_requests_in_flight', 'Запросы в обработке', ['view'], multiprocess_mode='livesum',
+)
+UPSTREAM_LATENCY = Histogram(
+    'copilot_openai_request_duration_seconds', 'Время одной попытки запроса к OpenAI',
+    ['model', 'outcome'], buckets=REQUEST_BUCKETS,
+)
+UPSTREAM_ERRORS = Counter(
+    'copilot_openai_errors_total', 'Ошибки OpenAI по статусу (включая повторенные попытки)', ['status'],
+)
+UPSTREAM_RETRIES = Counter('copilot_openai_retries_total', 'Повторы запросов к OpenAI', ['status'])
+UPSTREAM_QUEUE_WAIT = Histogram(
+    'copilot_openai_queue_wait_seconds', 'Ожидание лимита запросов/токенов OpenAI перед запросом',
+    buckets=STAGE_BUCKETS,
+)
+UPSTREAM_REJECTED = Counter(
+    'copilot_openai_rejected_total', 'Запросы, отклоненные без обращения к OpenAI (503)', ['reason'],
+)
+UPSTREAM_TOKENS = Counter('copilot_openai_tokens_total', 'Токены OpenAI по эндпоинтам', ['endpoint', 'kind'])
+MODERATION_STAGE = Histogram(
+    'copilot_moderation_stage_seconds', 'Время этапов модерации изображения', ['stage'], buckets=STAGE_BUCKETS,
+)
+MODERATION_PARSE = Counter(
+    'copilot_moderation_parse_total', 'Разбор ответов модерации по формату ответа и исходу',
+    ['source', 'format', 'result'],
+)
+HISTORY_RECORDS = Counter(
+    'copilot_history_records_total', 'Записи истории модерации: written, dropped, failed', ['result'],
+)
+CACHE_LOOKUPS = Counter('copilot_cache_lookups_total', 'Обращения к кешам', ['cache', 'result'])
+COALESCED_REQUESTS = Counter(
+    'copilot_coalesced_requests_total', 'Запросы, получившие результат чужого вызова OpenAI', ['endpoint', 'source'],
+)
+COALESCE_TIMEOUTS = Counter(
+    'copilot_coalesce_timeouts_total', 'Ожидания чужого вызова, прерванные по таймауту', ['endpoint'],
+)
+ASK_ROUTED = Counter('copilot_ask_routed_total', 'Запросы /copilot/ask/ к OpenAI по маршрутам и моделям', ['route', 'model'])
+ASK_FALLBACKS = Counter(
+    'copilot_ask_fallbacks_total', 'Переключения /copilot/ask/ на запасную модель', ['model', 'fallback'],
+)
+PREFILTER_DECISIONS = Counter('copilot_prefilter_decisions_total', 'Решения локального префильтра', ['decision'])
+
+
+def error_status(exc):
+    """Метка status для ошибки SDK: код ответа, timeout или connection"""
+    status_code = getattr(exc, 'status_code', None)
+    if status_code is not None:
+        return str(status_code)
+    name = exc.__class__.__name__
+    if 'Timeout' in name:
+        return 'timeout'
+    if 'Connection' in name:
+        return 'connection'
+    return 'other'
+
+
+def observe_stages(timings):
+    """Время этапов в секундах: {'decode': 0.012, ...}"""
+    for stage, seconds in timings.items():
+        MODERATION_STAGE.labels(stage).observe(seconds)
+
+
+class StageTimer:
+    """with StageTimer('upstream'): ... — записывает длительность блока в MODERATION_STAGE"""
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.started
+        MODERATION_STAGE.labels(self.stage).observe(self.elapsed)
+        return False
+
+
+def render_metrics():
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+class MetricsMiddleware:
+    """
+    Гистограмма времени ответа и число запросов в обработке по представлениям.
+    Метка view — имя URL (url_name); для потоковых ответов учитывается время до первого байта.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            self._finish(request)
+        self._observe(request, response, started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            self._finish(request)
+        self._observe(request, response, started)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = _view_name(request)
+        request._metrics_view = view
+        REQUESTS_IN_FLIGHT.labels(view).inc()
+        return None
+
+    def _finish(self, request):
+        view = getattr(request, '_metrics_view', None)
+        if view is not None:
+            REQUESTS_IN_FLIGHT.labels(view).dec()
+
+    def _observe(self, request, response, started):
+        REQUEST_LATENCY.labels(
+            getattr(request, '_metrics_view', None) or _view_name(request), request.method, response.status_code
+        ).observe(time.perf_counter() - started)
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.url_name or match.view_name or 'unnamed'
+
@@ -0,0 +1,50 @@
+"""
+Короткий путь запроса для stateless-маршрутов API (STATELESS_API_PREFIXES).
+
+Эндпоинты copilot/ не используют сессии, сообщения и вход пользователя,
+а CSRF для них и так отключен (DRF и async_api_view), поэтому session,
+CSRF, auth, messages и X-Frame-Options middleware для этих путей ничего
+не делают: не читают cookie и сессию, не ставят заголовки. Для админки,
+Swagger и браузерного API они работают как обычно. Классы — подклассы
+middleware Django, поэтому системные проверки админки их узнают.
+"""
+from django.conf import settings
+from django.contrib.auth import middleware as auth_middleware
+from django.contrib.messages import middleware as messages_middleware
+from django.contrib.sessions import middleware as sessions_middleware
+from django.middleware import clickjacking, csrf
+
+
+def is_stateless(request):
+    prefixes = settings.STATELESS_API_PREFIXES
+    return bool(prefixes) and request.path_info.startswith(tuple(prefixes))
+
+
+class StatelessRouteMixin:
+    def __call__(self, request):
+        if is_stateless(request):
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class SessionMiddleware(StatelessRouteMixin, sessions_middleware.SessionMiddleware):
+    pass
+
+
+class CsrfViewMiddleware(StatelessRouteMixin, csrf.CsrfViewMiddleware):
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        if is_stateless(request):
+            return None
+        return super().process_view(request, callback, callback_args, callback_kwargs)
+
+
+class AuthenticationMiddleware(StatelessRouteMixin, auth_middleware.AuthenticationMiddleware):
+    pass
+
+
+class MessageMiddleware(StatelessRouteMixin, messages_middleware.MessageMiddleware):
+    pass
+
+
+class XFrameOptionsMiddleware(StatelessRouteMixin, clickjacking.XFrameOptionsMiddleware):
+    pass
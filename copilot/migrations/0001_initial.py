@@ -0,0 +1,69 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Content',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(blank=True, upload_to='content/')),
+                ('file_type', models.CharField(choices=[('image', 'Изображение'), ('video', 'Видео')], max_length=16)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('safety_status', models.CharField(choices=[('pending', 'Проверяется'), ('safe', 'Безопасно'), ('potentially_unsafe', 'Потенциально опасно'), ('unsafe', 'Опасно'), ('error', 'Ошибка проверки')], default='pending', max_length=32)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ModerationResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('verdict', models.CharField(max_length=32)),
+                ('explanation', models.TextField(blank=True)),
+                ('ai_analysis_raw', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('content', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='moderation_results', to='copilot.content')),
+                ('detected_tags', models.ManyToManyField(blank=True, related_name='moderation_results', to='copilot.tag')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['content_hash'], name='content_hash_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['safety_status', 'created_at'], name='content_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['created_at', 'id'], name='content_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='moderationresult',
+            index=models.Index(fields=['created_at', 'id'], name='moderation_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='moderationresult',
+            index=models.Index(fields=['verdict', 'created_at'], name='moderation_verdict_created_idx'),
+        ),
+    ]
@@ -1,3 +1,113 @@
+import uuid
 
-# No models needed for simple request/response functionality
-pass
\ No newline at end of file
+from django.db import models
+
+
+class Tag(models.Model):
+    """Тег опасного контента (pornography, weapons, ...)"""
+    name = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class Content(models.Model):
+    """Загруженный файл и его текущий статус безопасности"""
+    FILE_TYPES = [
+        ('image', 'Изображение'),
+        ('video', 'Видео'),
+    ]
+    SAFETY_STATUSES = [
+        ('pending', 'Проверяется'),
+        ('safe', 'Безопасно'),
+        ('potentially_unsafe', 'Потенциально опасно'),
+        ('unsafe', 'Опасно'),
+        ('error', 'Ошибка проверки'),
+    ]
+
+    file = models.FileField(upload_to='content/', blank=True)
+    file_type = models.CharField(max_length=16, choices=FILE_TYPES)
+    # sha256 содержимого: поиск повторных загрузок того же файла
+    content_hash = models.CharField(max_length=64)
+    safety_status = models.CharField(max_length=32, choices=SAFETY_STATUSES, default='pending')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['content_hash'], name='content_hash_idx'),
+            models.Index(fields=['safety_status', 'created_at'], name='content_status_created_idx'),
+            models.Index(fields=['created_at', 'id'], name='content_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.file_type} {self.content_hash[:12]} ({self.safety_status})'
+
+
+class ModerationResult(models.Model):
+    """Результат одной проверки контента"""
+    content = models.ForeignKey(Content, on_delete=models.CASCADE, related_name='moderation_results')
+    verdict = models.CharField(max_length=32)
+    explanation = models.TextField(blank=True)
+    # Ответ модерации целиком (вердикт, теги, статистика предобработки)
+    ai_analysis_raw = models.JSONField(default=dict)
+    detected_tags = models.ManyToManyField(Tag, related_name='moderation_results', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='moderation_created_idx'),
+            models.Index(fields=['verdict', 'created_at'], name='moderation_verdict_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.content_id}: {self.verdict}'
+
+
+class Document(models.Model):
+    """Текст для /copilot/ask/, загруженный один раз; id — sha256 текста, повторная загрузка не создает копию"""
+    id = models.CharField(max_length=64, primary_key=True)
+    text = models.TextField()
+    chars = models.PositiveIntegerField()
+    # Оценка токенов текста целиком (до поиска по фрагментам)
+    estimated_tokens = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.id[:12]} ({self.chars} символов)'
+
+
+class Conversation(models.Model):
+    """Диалог: вопросы и ответы хранятся на сервере, старые ходы сворачиваются в краткое содержание"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # Текст по умолчанию для вопросов диалога (можно не передавать context/document_id)
+    document = models.ForeignKey(Document, on_delete=models.SET_NULL, null=True, blank=True, related_name='conversations')
+    # Краткое содержание свернутых ходов
+    summary = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class ConversationTurn(models.Model):
+    """Вопрос и ответ в диалоге; summarized — ход уже вошел в краткое содержание и не отправляется в модель"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='turns')
+    question = models.TextField()
+    answer = models.TextField()
+    model = models.CharField(max_length=64, blank=True)
+    summarized = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['conversation', 'summarized', 'id'], name='turn_conversation_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.conversation_id}: {self.question[:40]}'
@@ -1,5 +1,16 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+
+from django.db import connections, router
+from django.db.models import Max, Min
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+# До скольких строк считается точно, когда оценка по статистике невозможна (запрос с фильтрами)
+APPROXIMATE_COUNT_LIMIT = 10000
 
 
 class CustomPageNumberPagination(PageNumberPagination):
@@ -40,3 +51,124 @@ class ModerationResultsPagination(PageNumberPagination):
             },
             'results': data
         })
+
+
+class KeysetPagination(BasePagination):
+    """
+    Постраничный вывод по ключу (created_at, id), от новых к старым, без COUNT(*) и OFFSET.
+
+    Курсор — непрозрачная строка с ключом последней записи страницы; следующая
+    страница выбирается условием «ключ меньше курсора» по индексу (created_at, id),
+    поэтому глубокая страница стоит столько же, сколько первая. Общее число
+    записей не считается; с ?count=approximate добавляется оценка (count_estimate)
+    с учетом фильтров запроса.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Неверный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """Страница QuerySet модели с полем created_at"""
+        def fetch(after, limit):
+            page = queryset
+            if after is not None:
+                try:
+                    created_at, pk = parse_datetime(after[0]), int(after[1])
+                except (TypeError, ValueError):
+                    created_at = None
+                if created_at is None:
+                    raise NotFound(self.invalid_cursor_message)
+                # created_at <= курсора задает диапазон по индексу, исключаются только записи с тем же временем
+                page = page.filter(created_at__lte=created_at).exclude(created_at=created_at, pk__gte=pk)
+            return list(page.order_by('-created_at', '-pk')[:limit])
+
+        def estimate():
+            return approximate_count(queryset)
+
+        return self.paginate(fetch, request, key=lambda item: (item.created_at.isoformat(), item.pk), estimate=estimate)
+
+    def paginate(self, fetch, request, key, estimate=None):
+        """
+        Общий случай: fetch(after, limit) возвращает записи с ключом меньше after
+        (или первые, если after — None) в порядке убывания ключа.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        after = self.decode_cursor(request)
+        items = fetch(after, self.page_size + 1)
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        self.next_cursor = self.encode_cursor(key(items[-1])) if self.has_next else None
+        self.count_estimate = None
+        if estimate is not None and request.query_params.get(self.count_query_param) == 'approximate':
+            self.count_estimate = estimate()
+        return items
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            value = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+            created_at, pk = value
+        except (TypeError, ValueError, UnicodeEncodeError):
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+    def encode_cursor(self, position):
+        data = json.dumps(list(position), separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        pagination = {
+            'next': self.get_next_link(),
+            'next_cursor': self.next_cursor,
+            'page_size': self.page_size,
+            'has_next': self.has_next,
+        }
+        if self.count_estimate is not None:
+            pagination['count_estimate'] = self.count_estimate
+        return Response({'pagination': pagination, 'results': data})
+
+
+def approximate_count(queryset):
+    """
+    Оценка числа строк QuerySet (с его фильтрами) без полного сканирования.
+    PostgreSQL: оценка планировщика (EXPLAIN) для запроса с фильтрами.
+    Иначе без фильтров — разница между крайними id по индексу первичного ключа,
+    с фильтрами — точный подсчет, но не больше APPROXIMATE_COUNT_LIMIT строк.
+    """
+    model = queryset.model
+    queryset = queryset.order_by().values('pk')
+    connection = connections[router.db_for_read(model)]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    if queryset.query.has_filters():
+        return queryset[:APPROXIMATE_COUNT_LIMIT].count()
+    bounds = model._default_manager.aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return 0
+    return bounds['last'] - bounds['first'] + 1
@@ -0,0 +1,180 @@
+"""
+Локальный префильтр модерации изображений.
+
+Запускается до запроса к OpenAI Vision и сразу отвечает safe на очевидно
+безопасные изображения (предметная съемка на однотонном фоне). Плоская
+графика в несколько цветов (логотипы, символы, надписи, макеты интерфейсов)
+не пропускается: эвристики не отличают безобидный логотип от экстремистского
+символа, поэтому такие изображения всегда уходят в модель. Класс префильтра
+задается настройкой MODERATION_PREFILTER, поэтому эвристики можно заменить,
+например, на локальную CPU-модель с тем же методом check().
+"""
+import logging
+import threading
+import time
+
+from PIL import Image
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import PREFILTER_DECISIONS
+
+logger = logging.getLogger(__name__)
+
+VERDICT_SAFE = 'safe'
+VERDICT_ESCALATE = 'escalate'
+
+
+class PrefilterResult:
+    def __init__(self, verdict, confidence, features):
+        self.verdict = verdict
+        self.confidence = confidence
+        self.features = features
+
+    @property
+    def cleared(self):
+        return self.verdict == VERDICT_SAFE
+
+    def stats(self):
+        return {
+            'verdict': self.verdict,
+            'confidence': round(self.confidence, 3),
+            'features': {name: round(value, 3) for name, value in self.features.items()},
+        }
+
+
+class HeuristicPrefilter:
+    """
+    Векторные эвристики NumPy по уменьшенному изображению:
+    - skin_ratio — доля пикселей цвета кожи (YCbCr);
+    - flat_ratio — доля пикселей в PREFILTER_PALETTE_SIZE самых частых цветах
+      (однотонный фон);
+    - graphic_ratio — доля PREFILTER_GRAPHIC_COLORS самых частых цветов среди
+      пикселей не цвета фона: у фотографии объект в полутонах, у графики —
+      несколько плоских цветов.
+    Уверенность в безопасности растет с flat_ratio и падает с долей кожи;
+    при graphic_ratio не ниже PREFILTER_MAX_GRAPHIC_RATIO она нулевая.
+    """
+
+    def check(self, img):
+        import numpy as np
+
+        rgb = np.asarray(img.convert('RGB'))
+        ycbcr = np.asarray(img.convert('YCbCr'))
+        y, cb, cr = ycbcr[..., 0], ycbcr[..., 1], ycbcr[..., 2]
+        skin = (y > 40) & (cb >= 77) & (cb <= 127) & (cr >= 133) & (cr <= 173)
+        skin_ratio = float(skin.mean())
+
+        # 8 уровней на канал -> 512 цветов
+        quantized = (rgb >> 5).astype(np.int32)
+        codes = (quantized[..., 0] << 6) | (quantized[..., 1] << 3) | quantized[..., 2]
+        counts = np.sort(np.bincount(codes.ravel(), minlength=512))[::-1]
+        flat_ratio = float(counts[:settings.PREFILTER_PALETTE_SIZE].sum() / codes.size)
+        # Самый частый цвет считаем фоном, остальное — изображенным объектом
+        foreground = counts[1:]
+        foreground_size = foreground.sum()
+        graphic_ratio = 1.0
+        if foreground_size:
+            graphic_ratio = float(foreground[:settings.PREFILTER_GRAPHIC_COLORS].sum() / foreground_size)
+
+        skin_score = max(0.0, 1.0 - skin_ratio / settings.PREFILTER_MAX_SKIN_RATIO)
+        graphic = graphic_ratio >= settings.PREFILTER_MAX_GRAPHIC_RATIO
+        confidence = 0.0 if graphic else skin_score * flat_ratio
+        verdict = VERDICT_SAFE if confidence >= settings.PREFILTER_SAFE_CONFIDENCE else VERDICT_ESCALATE
+        return PrefilterResult(verdict, confidence, {
+            'skin_ratio': skin_ratio, 'flat_ratio': flat_ratio, 'graphic_ratio': graphic_ratio,
+        })
+
+
+class PrefilterStats:
+    """Счетчики префильтра в текущем процессе: сколько запросов к OpenAI сэкономлено"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.cleared = 0
+        self.failed = 0
+        self.total_time = 0.0
+
+    def record(self, result, elapsed):
+        PREFILTER_DECISIONS.labels('failed' if result is None else result.verdict).inc()
+        with self._lock:
+            self.total_time += elapsed
+            if result is None:
+                self.failed += 1
+                return
+            self.checked += 1
+            if result.cleared:
+                self.cleared += 1
+
+    def snapshot(self):
+        with self._lock:
+            calls = self.checked + self.failed
+            return {
+                'enabled': bool(settings.MODERATION_PREFILTER),
+                'checked': self.checked,
+                'cleared': self.cleared,
+                'escalated': self.checked - self.cleared,
+                'failed': self.failed,
+                'upstream_calls_saved': self.cleared,
+                'clear_ratio': round(self.cleared / self.checked, 4) if self.checked else 0.0,
+                'avg_ms': round(self.total_time / calls * 1000, 2) if calls else 0.0,
+            }
+
+
+prefilter_stats = PrefilterStats()
+_prefilter = None
+
+
+def get_prefilter():
+    """Экземпляр класса из MODERATION_PREFILTER или None, если префильтр выключен"""
+    global _prefilter
+    if not settings.MODERATION_PREFILTER:
+        return None
+    if _prefilter is None:
+        _prefilter = import_string(settings.MODERATION_PREFILTER)()
+    return _prefilter
+
+
+def load_sample(image_file):
+    """Декодирует изображение сразу в уменьшенном размере PREFILTER_SAMPLE_SIZE"""
+    size = settings.PREFILTER_SAMPLE_SIZE
+    image_file.seek(0)
+    try:
+        img = Image.open(image_file)
+        if img.format == 'JPEG':
+            img.draft('RGB', (size, size))
+        img.thumbnail((size, size))
+        return img
+    finally:
+        image_file.seek(0)
+
+
+def run_prefilter(image_file, prefilter=None):
+    """
+    Проверяет изображение префильтром. Возвращает PrefilterResult или None,
+    если префильтр выключен или упал (тогда изображение уходит в модель).
+    """
+    prefilter = prefilter or get_prefilter()
+    if prefilter is None:
+        return None
+    started = time.perf_counter()
+    try:
+        result = prefilter.check(load_sample(image_file))
+    except Exception as e:
+        logger.warning(f"Prefilter failed, escalating to the model: {str(e)}")
+        result = None
+    prefilter_stats.record(result, time.perf_counter() - started)
+    return result
+
+
+def prefilter_verdict(result):
+    """Ответ API для изображения, которое префильтр пропустил без модели"""
+    return {
+        "verdict": "safe",
+        "tags": [],
+        "explanation": (
+            f"Изображение автоматически признано безопасным локальным фильтром "
+            f"(уверенность {result.confidence:.2f}) без обращения к AI."
+        ),
+    }
@@ -0,0 +1,317 @@
+"""
+Ограничение частоты запросов к OpenAI и circuit breaker.
+
+Лимитер — token bucket по запросам и по токенам для каждой модели. Емкость и
+скорость пополнения берутся из заголовков x-ratelimit-* ответов OpenAI (до
+первого ответа — OPENAI_RPM_LIMIT / OPENAI_TPM_LIMIT), остаток сверяется
+с x-ratelimit-remaining-*. Запрос, которому не хватает лимита, ждет своей
+очереди не дольше OPENAI_QUEUE_TIMEOUT, иначе сразу получает 503 с Retry-After.
+После 429 новые запросы всех воркеров ждут сброса лимита.
+
+Circuit breaker размыкается после OPENAI_BREAKER_THRESHOLD ошибок подряд
+(5xx, таймауты, сетевые ошибки) и OPENAI_BREAKER_COOLDOWN секунд отвечает 503,
+не обращаясь к OpenAI; затем пропускает один пробный запрос.
+
+Состояние хранится в SQLite-файле OPENAI_LIMITS_DB и общее для воркеров
+gunicorn на хосте (пусто — только внутри процесса).
+"""
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .exceptions import UpstreamUnavailableException
+from .metrics import UPSTREAM_QUEUE_WAIT, UPSTREAM_REJECTED
+
+STATE_KEY = 'openai'
+# Ошибки, которые считаются отказом OpenAI (метки error_status)
+BREAKER_STATUSES = {'timeout', 'connection'}
+# Сколько ждать после 429 без Retry-After и x-ratelimit-reset-*, сек
+DEFAULT_BLOCK = 1.0
+
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(value):
+    """Длительность из x-ratelimit-reset-*: '1s', '6m0s', '20ms' — в секундах"""
+    if not value:
+        return None
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def request_cost(request_kwargs):
+    """
+    Сколько токенов запрос занимает в лимите TPM: как и OpenAI, считаем
+    по длине текста (~4 символа на токен) плюс max_tokens ответа.
+    """
+    chars = 0
+    for message in request_kwargs.get('messages') or ():
+        content = message.get('content')
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            chars += sum(len(part.get('text') or '') for part in content if part.get('type') == 'text')
+    return chars // 4 + (request_kwargs.get('max_tokens') or 0)
+
+
+class MemoryStateStore:
+    """Состояние в памяти процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}
+
+    @contextmanager
+    def update(self):
+        with self._lock:
+            yield self._state
+
+    def read(self):
+        with self._lock:
+            return json.loads(json.dumps(self._state))
+
+
+class SQLiteStateStore:
+    """Состояние в SQLite: каждое изменение — транзакция BEGIN IMMEDIATE, общая для процессов"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS upstream_state (key TEXT PRIMARY KEY, value TEXT)')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def update(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT value FROM upstream_state WHERE key = ?', (STATE_KEY,)).fetchone()
+            state = json.loads(row[0]) if row else {}
+            yield state
+            conn.execute(
+                'INSERT OR REPLACE INTO upstream_state (key, value) VALUES (?, ?)', (STATE_KEY, json.dumps(state))
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def read(self):
+        row = self._connection().execute(
+            'SELECT value FROM upstream_state WHERE key = ?', (STATE_KEY,)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+
+def _refill(bucket, now):
+    elapsed = max(0.0, now - bucket['updated'])
+    bucket['level'] = min(bucket['capacity'], bucket['level'] + elapsed * bucket['rate'])
+    bucket['updated'] = now
+
+
+def _bucket(limits, name, default_limit, now):
+    bucket = limits.get(name)
+    if bucket is None and default_limit:
+        bucket = limits[name] = {
+            'capacity': default_limit, 'rate': default_limit / 60, 'level': default_limit, 'updated': now,
+        }
+    if bucket is not None:
+        _refill(bucket, now)
+    return bucket
+
+
+def _bucket_wait(bucket, cost):
+    if bucket is None:
+        return 0.0
+    # Запрос больше всей емкости иначе ждал бы вечно
+    cost = min(cost, bucket['capacity'])
+    return max(0.0, (cost - bucket['level']) / bucket['rate'])
+
+
+class UpstreamGuard:
+    """Лимитер и circuit breaker для вызовов OpenAI"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def acquire(self, model, cost):
+        """
+        Резервирует запрос и cost токенов в лимите модели.
+        Возвращает, сколько секунд подождать перед запросом, или поднимает
+        UpstreamUnavailableException, если цепь разомкнута или ждать дольше OPENAI_QUEUE_TIMEOUT.
+        """
+        now = time.time()
+        with self.store.update() as state:
+            retry_after = self._check_breaker(state, now)
+            if retry_after is not None:
+                reason = 'circuit_open'
+            elif not settings.OPENAI_RATE_LIMIT_ENABLED:
+                return 0.0
+            else:
+                wait = self._reserve(state.setdefault('models', {}).setdefault(model, {}), cost, now)
+                if wait <= settings.OPENAI_QUEUE_TIMEOUT:
+                    UPSTREAM_QUEUE_WAIT.observe(wait)
+                    return wait
+                reason, retry_after = 'rate_limit', wait
+                # Пробный запрос полуоткрытой цепи так и не был отправлен
+                (state.get('breaker') or {}).pop('probe_until', None)
+        UPSTREAM_REJECTED.labels(reason).inc()
+        if reason == 'circuit_open':
+            raise UpstreamUnavailableException('AI сервис временно недоступен', retry_after=retry_after)
+        raise UpstreamUnavailableException('Превышен лимит запросов к AI сервису', retry_after=retry_after)
+
+    def _reserve(self, limits, cost, now):
+        """Время ожидания очереди; если оно не больше OPENAI_QUEUE_TIMEOUT, лимит резервируется"""
+        requests = _bucket(limits, 'requests', settings.OPENAI_RPM_LIMIT, now)
+        tokens = _bucket(limits, 'tokens', settings.OPENAI_TPM_LIMIT, now)
+        wait = max(0.0, limits.get('blocked_until', 0) - now, _bucket_wait(requests, 1), _bucket_wait(tokens, cost))
+        if wait > settings.OPENAI_QUEUE_TIMEOUT:
+            return wait
+        # Уровень может уйти в минус: следующие запросы встанут в очередь за этим
+        for bucket, amount in ((requests, 1), (tokens, cost)):
+            if bucket is not None:
+                bucket['level'] -= min(amount, bucket['capacity'])
+        return wait
+
+    def _check_breaker(self, state, now):
+        """None, если запрос можно выполнить, иначе через сколько секунд повторить"""
+        breaker = state.get('breaker')
+        if not breaker or not breaker.get('opened_until'):
+            return None
+        if breaker['opened_until'] > now:
+            return breaker['opened_until'] - now
+        # Полуоткрытое состояние: пропускаем один пробный запрос
+        if breaker.get('probe_until', 0) > now:
+            return min(breaker['probe_until'] - now, settings.OPENAI_BREAKER_COOLDOWN)
+        breaker['probe_until'] = now + settings.OPENAI_READ_TIMEOUT
+        return None
+
+    def record_success(self, model, headers=None):
+        now = time.time()
+        with self.store.update() as state:
+            state.pop('breaker', None)
+            if headers is not None and settings.OPENAI_RATE_LIMIT_ENABLED:
+                self._learn(state.setdefault('models', {}).setdefault(model, {}), headers, now)
+
+    def record_failure(self, model, status, headers=None, retry_after=None):
+        """Учитывает неудачную попытку: 429 блокирует лимит модели, отказы OpenAI — шаг к размыканию цепи"""
+        now = time.time()
+        with self.store.update() as state:
+            limits = state.setdefault('models', {}).setdefault(model, {})
+            if headers is not None and settings.OPENAI_RATE_LIMIT_ENABLED:
+                self._learn(limits, headers, now)
+            if status == '429' and settings.OPENAI_RATE_LIMIT_ENABLED:
+                self._block(limits, headers, retry_after, now)
+            elif status in BREAKER_STATUSES or (status.isdigit() and int(status) >= 500):
+                self._count_failure(state, now)
+
+    def _learn(self, limits, headers, now):
+        for name, suffix in (('requests', 'requests'), ('tokens', 'tokens')):
+            limit = _int_header(headers, f'x-ratelimit-limit-{suffix}')
+            remaining = _int_header(headers, f'x-ratelimit-remaining-{suffix}')
+            if not limit:
+                continue
+            bucket = limits.get(name)
+            if bucket is None:
+                bucket = limits[name] = {'level': limit, 'updated': now}
+            else:
+                _refill(bucket, now)
+            bucket['capacity'] = limit
+            bucket['rate'] = limit / 60
+            if remaining is not None:
+                # Свои резервы уже вычтены: берем более осторожное значение
+                bucket['level'] = min(bucket['level'], remaining)
+
+    def _block(self, limits, headers, retry_after, now):
+        if retry_after is None and headers is not None:
+            resets = [parse_duration(headers.get(f'x-ratelimit-reset-{suffix}')) for suffix in ('requests', 'tokens')]
+            resets = [value for value in resets if value]
+            retry_after = min(resets) if resets else None
+        limits['blocked_until'] = max(limits.get('blocked_until', 0), now + (retry_after or DEFAULT_BLOCK))
+        requests = limits.get('requests')
+        if requests is not None:
+            requests['level'] = min(requests['level'], 0)
+
+    def _count_failure(self, state, now):
+        threshold = settings.OPENAI_BREAKER_THRESHOLD
+        if threshold <= 0:
+            return
+        breaker = state.setdefault('breaker', {'failures': 0})
+        breaker['failures'] = breaker.get('failures', 0) + 1
+        # Неудачная проба снова размыкает цепь
+        if breaker['failures'] >= threshold or breaker.get('opened_until'):
+            breaker['opened_until'] = now + settings.OPENAI_BREAKER_COOLDOWN
+            breaker.pop('probe_until', None)
+
+    def snapshot(self):
+        """Состояние для /copilot/stats/"""
+        now = time.time()
+        state = self.store.read()
+        breaker = state.get('breaker') or {}
+        opened_until = breaker.get('opened_until', 0)
+        if not opened_until:
+            breaker_state = 'closed'
+        elif opened_until > now:
+            breaker_state = 'open'
+        else:
+            breaker_state = 'half_open'
+        models = {}
+        for model, limits in (state.get('models') or {}).items():
+            info = {'blocked_for': round(max(0.0, limits.get('blocked_until', 0) - now), 2)}
+            for name in ('requests', 'tokens'):
+                bucket = limits.get(name)
+                if bucket is not None:
+                    _refill(bucket, now)
+                    info[name] = {'limit': bucket['capacity'], 'available': math.floor(bucket['level'])}
+            models[model] = info
+        return {
+            'circuit': breaker_state,
+            'consecutive_failures': breaker.get('failures', 0),
+            'retry_after': round(max(0.0, opened_until - now), 2),
+            'models': models,
+        }
+
+
+_guard = None
+_guard_lock = threading.Lock()
+
+
+def get_upstream_guard():
+    global _guard
+    if _guard is None:
+        with _guard_lock:
+            if _guard is None:
+                path = settings.OPENAI_LIMITS_DB
+                _guard = UpstreamGuard(SQLiteStateStore(path) if path else MemoryStateStore())
+    return _guard
@@ -0,0 +1,238 @@
+"""
+Сокращение контекста для /copilot/ask/ на длинных документах.
+
+Текст делится на пересекающиеся фрагменты, по ним строится локальный
+индекс BM25 (NumPy, без внешних сервисов эмбеддингов), и в модель уходят
+только RETRIEVAL_TOP_K самых релевантных вопросу фрагментов. Индекс
+кешируется в памяти процесса по хешу текста, поэтому следующие вопросы
+по тому же документу не разбивают и не индексируют его заново.
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from .cache import LRUCache
+from .tokens import estimate_text_tokens
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+')
+WHITESPACE_RE = re.compile(r'\s')
+
+# Стандартные параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.casefold())
+
+
+def _last_whitespace(text, start, end):
+    for position in range(end - 1, start - 1, -1):
+        if WHITESPACE_RE.match(text, position):
+            return position
+    return -1
+
+
+def split_chunks(text, size, overlap):
+    """Границы фрагментов (start, end) длиной до size символов с перекрытием overlap; режет по пробелам"""
+    spans = []
+    start, length = 0, len(text)
+    while start < length:
+        end = min(start + size, length)
+        if end < length:
+            boundary = _last_whitespace(text, start + size // 2, end)
+            if boundary > start:
+                end = boundary
+        spans.append((start, end))
+        if end >= length:
+            break
+        next_start = max(end - overlap, start + 1)
+        match = WHITESPACE_RE.search(text, next_start, end)
+        start = match.end() if match else next_start
+    return spans
+
+
+class BM25Index:
+    """Инвертированный индекс по фрагментам: постинги хранятся в массивах NumPy"""
+
+    def __init__(self, text, spans):
+        # NumPy (~80 мс импорта) нужен только для длинных текстов — загружается при первом индексе
+        import numpy as np
+
+        self.spans = spans
+        self.vocabulary = {}
+        count = len(spans)
+        term_ids = []
+        doc_ids = []
+        lengths = np.zeros(count, dtype=np.float64)
+        for doc, (start, end) in enumerate(spans):
+            tokens = tokenize(text[start:end])
+            lengths[doc] = len(tokens)
+            term_ids.extend(self.vocabulary.setdefault(token, len(self.vocabulary)) for token in tokens)
+            doc_ids.extend([doc] * len(tokens))
+
+        # Пары (термин, фрагмент) -> частота; после np.unique отсортированы по термину
+        pairs, tf = np.unique(
+            np.array(term_ids, dtype=np.int64) * count + np.array(doc_ids, dtype=np.int64),
+            return_counts=True
+        )
+        terms = pairs // count
+        self.docs = pairs % count
+        self.tf = tf.astype(np.float64)
+        self.offsets = np.searchsorted(terms, np.arange(len(self.vocabulary) + 1))
+        df = np.diff(self.offsets)
+        self.idf = np.log(1 + (count - df + 0.5) / (df + 0.5))
+        average = lengths.mean() if count and lengths.mean() else 1.0
+        self.norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / average)
+
+    def search(self, query, top_k):
+        """Индексы top_k лучших фрагментов и их оценки"""
+        import numpy as np
+
+        scores = np.zeros(len(self.spans))
+        for token in set(tokenize(query)):
+            term = self.vocabulary.get(token)
+            if term is None:
+                continue
+            start, end = self.offsets[term], self.offsets[term + 1]
+            docs, tf = self.docs[start:end], self.tf[start:end]
+            scores[docs] += self.idf[term] * tf * (BM25_K1 + 1) / (tf + self.norm[docs])
+        order = np.argsort(-scores, kind='stable')[:top_k]
+        return [(int(doc), float(scores[doc])) for doc in order]
+
+
+class RetrievalStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.index_builds = 0
+        self.index_hits = 0
+        self.build_time = 0.0
+
+    def record(self, built, elapsed=0.0):
+        with self._lock:
+            if built:
+                self.index_builds += 1
+                self.build_time += elapsed
+            else:
+                self.index_hits += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'index_builds': self.index_builds,
+                'index_hits': self.index_hits,
+                'avg_build_ms': round(self.build_time / self.index_builds * 1000, 2) if self.index_builds else 0.0,
+                'cached_indexes': len(get_index_cache()),
+            }
+
+
+retrieval_stats = RetrievalStats()
+_index_cache = None
+
+
+def get_index_cache():
+    global _index_cache
+    if _index_cache is None:
+        _index_cache = LRUCache(
+            max_entries=settings.RETRIEVAL_INDEX_CACHE_SIZE, ttl=settings.RETRIEVAL_INDEX_TTL
+        )
+    return _index_cache
+
+
+def get_index(context):
+    """Индекс документа из кеша или новый"""
+    size, overlap = settings.RETRIEVAL_CHUNK_SIZE, settings.RETRIEVAL_CHUNK_OVERLAP
+    key = f"{size}:{overlap}:{hashlib.sha256(context.encode('utf-8')).hexdigest()}"
+    cache = get_index_cache()
+    index = cache.get(key)
+    if index is not None:
+        retrieval_stats.record(built=False)
+        return index
+    started = time.perf_counter()
+    index = BM25Index(context, split_chunks(context, size, overlap))
+    elapsed = time.perf_counter() - started
+    retrieval_stats.record(built=True, elapsed=elapsed)
+    logger.info(f"Built retrieval index: {len(index.spans)} chunks in {elapsed * 1000:.1f} ms")
+    cache.set(key, index)
+    return index
+
+
+def retrieval_top_k(context, retrieval=None, top_k=None):
+    """
+    Сколько фрагментов отправлять в модель или None, если нужен весь текст.
+    Без явного флага retrieval режим включается для текстов длиннее RETRIEVAL_MIN_CONTEXT_CHARS.
+    """
+    if retrieval is None:
+        retrieval = settings.RETRIEVAL_ENABLED and len(context) > settings.RETRIEVAL_MIN_CONTEXT_CHARS
+    if not retrieval:
+        return None
+    return top_k or settings.RETRIEVAL_TOP_K
+
+
+def _join_chunks(context, index, found, spans=None):
+    """spans — границы фрагментов, отличные от индекса (обрезанный фрагмент)"""
+    found = sorted(found)
+    parts = []
+    chunks = []
+    for doc, score in found:
+        start, end = (spans or {}).get(doc, index.spans[doc])
+        parts.append(f"[Фрагмент {doc + 1}]\n{context[start:end]}")
+        chunks.append({"index": doc, "start": start, "end": end, "score": round(score, 4)})
+    return "\n\n".join(parts), chunks
+
+
+def fit_context(context, question, max_tokens):
+    """
+    Сокращает текст до max_tokens: фрагменты берутся по убыванию релевантности
+    вопросу, не поместившийся пропускается, и бюджет добирают следующие. Если
+    не помещается ни один, самый релевантный обрезается до бюджета.
+    """
+    index = get_index(context)
+    ranked = index.search(question, len(index.spans))
+    found = []
+    used = 0
+    for doc, score in ranked:
+        start, end = index.spans[doc]
+        # +10 токенов на заголовок «[Фрагмент N]» и разделители
+        tokens = estimate_text_tokens(context[start:end]) + 10
+        if used + tokens > max_tokens:
+            continue
+        found.append((doc, score))
+        used += tokens
+    if found or not ranked:
+        return _join_chunks(context, index, found)
+    doc, score = ranked[0]
+    start, end = index.spans[doc]
+    spans = {doc: (start, _fit_end(context, start, end, max_tokens - 10))}
+    return _join_chunks(context, index, [(doc, score)], spans=spans)
+
+
+def _fit_end(context, start, end, max_tokens):
+    """Наибольшая граница end, при которой context[start:end] укладывается в max_tokens"""
+    low, high = start, end
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_text_tokens(context[start:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def reduce_context(context, question, top_k):
+    """
+    Оставляет top_k релевантных вопросу фрагментов (в порядке следования в тексте).
+    Возвращает сокращенный текст и описание использованных фрагментов.
+    """
+    index = get_index(context)
+    found = [(doc, score) for doc, score in index.search(question, top_k) if score > 0]
+    if not found:
+        # Ни одно слово вопроса не встречается в тексте: берем начало документа
+        found = [(doc, 0.0) for doc in range(min(top_k, len(index.spans)))]
+    return _join_chunks(context, index, found)
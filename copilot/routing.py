@@ -0,0 +1,161 @@
+"""
+Выбор модели для /copilot/ask/.
+
+Запрос попадает в один из маршрутов — fast, balanced или best — по подсказке
+quality или по правилам: короткий текст с коротким фактическим вопросом идет
+в fast, вопросы на анализ и сравнение — в best, остальное — в balanced.
+У маршрута есть список моделей в порядке предпочтения и целевое время ответа
+(SLO по p95): берется первая модель, чье наблюдаемое p95 укладывается в SLO,
+а если не укладывается ни одна — самая быстрая. Следующая модель списка —
+запасная: если основная не ответила за ASK_PRIMARY_TIMEOUT или OpenAI вернул
+ошибку, запрос повторяется на ней. Замеры старше ASK_ROUTE_LATENCY_TTL
+не учитываются, поэтому отставшая модель со временем снова получает запросы.
+"""
+import re
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import ASK_FALLBACKS, ASK_ROUTED
+
+ROUTE_FAST = 'fast'
+ROUTE_BALANCED = 'balanced'
+ROUTE_BEST = 'best'
+ROUTES = (ROUTE_FAST, ROUTE_BALANCED, ROUTE_BEST)
+
+# Вопросы, которым нужна модель посильнее: рассуждение, сравнение, оценка
+ANALYTICAL_QUESTION = re.compile(
+    r'\b(почему|зачем|сравни\w*|сравнен\w*|анализ\w*|проанализируй\w*|объясни\w*|оцени\w*|обоснуй\w*|'
+    r'why|compare|analy[sz]e|explain|evaluate)\b',
+    re.IGNORECASE,
+)
+
+
+class RouteChoice:
+    def __init__(self, route, model, fallback=None):
+        self.route = route
+        self.model = model
+        self.fallback = fallback
+
+
+def route_models(route):
+    value = getattr(settings, f'ASK_ROUTE_{route.upper()}_MODELS')
+    return [model.strip() for model in value.split(',') if model.strip()]
+
+
+def route_slo(route):
+    """SLO маршрута в секундах или None"""
+    slo_ms = getattr(settings, f'ASK_ROUTE_{route.upper()}_SLO_MS')
+    return slo_ms / 1000 if slo_ms else None
+
+
+def routing_signature():
+    """Модели всех маршрутов — для версии кеша ответов"""
+    return ';'.join(f"{route}={','.join(route_models(route))}" for route in ROUTES)
+
+
+def classify(context, question, quality=None):
+    """Маршрут запроса: явная подсказка quality или правила по длине текста и типу вопроса"""
+    if quality:
+        return quality
+    if not settings.ASK_ROUTING_ENABLED:
+        return ROUTE_BEST
+    if ANALYTICAL_QUESTION.search(question):
+        return ROUTE_BEST
+    if len(context) <= settings.ASK_ROUTE_SHORT_CONTEXT_CHARS and len(question) <= settings.ASK_ROUTE_SHORT_QUESTION_CHARS:
+        return ROUTE_FAST
+    return ROUTE_BALANCED
+
+
+class RoutingStats:
+    """Задержки моделей (скользящее окно ответов) и счетчики выбора и переключений на запасную модель"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._routed = {}
+        self._fallbacks = {}
+
+    def record_latency(self, model, seconds):
+        with self._lock:
+            window = self._latency.get(model)
+            if window is None:
+                window = self._latency[model] = deque(maxlen=settings.ASK_ROUTE_LATENCY_WINDOW)
+            window.append((time.monotonic(), seconds))
+
+    def _recent(self, model):
+        since = time.monotonic() - settings.ASK_ROUTE_LATENCY_TTL
+        with self._lock:
+            return [seconds for recorded, seconds in self._latency.get(model, ()) if recorded >= since]
+
+    def p95(self, model):
+        """p95 задержки модели в секундах; None, пока свежих замеров меньше ASK_ROUTE_MIN_SAMPLES"""
+        values = sorted(self._recent(model))
+        if len(values) < settings.ASK_ROUTE_MIN_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(len(values) * 0.95))]
+
+    def record_route(self, route, model):
+        with self._lock:
+            key = f'{route}:{model}'
+            self._routed[key] = self._routed.get(key, 0) + 1
+        ASK_ROUTED.labels(route, model).inc()
+
+    def record_fallback(self, model, fallback):
+        with self._lock:
+            key = f'{model}->{fallback}'
+            self._fallbacks[key] = self._fallbacks.get(key, 0) + 1
+        ASK_FALLBACKS.labels(model, fallback).inc()
+
+    def snapshot(self):
+        with self._lock:
+            models = list(self._latency)
+            routed = dict(self._routed)
+            fallbacks = dict(self._fallbacks)
+        latency = {}
+        for model in models:
+            p95 = self.p95(model)
+            latency[model] = {
+                'samples': len(self._recent(model)),
+                'p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+            }
+        return {
+            'enabled': settings.ASK_ROUTING_ENABLED,
+            'routes': {
+                route: {'models': route_models(route), 'slo_ms': getattr(settings, f'ASK_ROUTE_{route.upper()}_SLO_MS')}
+                for route in ROUTES
+            },
+            'latency': latency,
+            'routed': routed,
+            'fallbacks': fallbacks,
+        }
+
+
+routing_stats = RoutingStats()
+
+
+def pick_model(route):
+    """
+    Основная и запасная модели маршрута: первая модель, укладывающаяся в SLO
+    (модели без замеров считаются укладывающимися), иначе самая быстрая.
+    """
+    models = route_models(route)
+    slo = route_slo(route)
+    model = models[0]
+    if slo is not None and len(models) > 1:
+        latencies = {candidate: routing_stats.p95(candidate) for candidate in models}
+        meeting = [candidate for candidate in models if latencies[candidate] is None or latencies[candidate] <= slo]
+        model = meeting[0] if meeting else min(models, key=lambda candidate: latencies[candidate])
+    fallback = None
+    if settings.ASK_FALLBACK_ENABLED:
+        fallback = next((candidate for candidate in models if candidate != model), None)
+    return model, fallback
+
+
+def select_model(route):
+    """Модели для запроса маршрута route, который пойдет в OpenAI"""
+    model, fallback = pick_model(route)
+    routing_stats.record_route(route, model)
+    return RouteChoice(route, model, fallback)
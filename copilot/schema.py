@@ -0,0 +1,16 @@
+"""
+Декораторы OpenAPI-схемы для представлений. drf_spectacular импортируется только
+при API_DOCS_ENABLED; без документации декораторы ничего не меняют.
+"""
+from django.conf import settings
+
+if settings.API_DOCS_ENABLED:
+    from drf_spectacular.utils import OpenApiExample, extend_schema  # noqa: F401
+else:
+    def extend_schema(*args, **kwargs):
+        def decorator(target):
+            return target
+        return decorator
+
+    def OpenApiExample(*args, **kwargs):
+        return None
@@ -1,17 +1,199 @@
 
+from django.conf import settings
 from rest_framework import serializers
 
+from .models import Content, Conversation, ConversationTurn, Document, ModerationResult
+from .uploads import IMAGE_FORMATS, check_image_header, read_head, sniff_format
+from .validators import (
+    validate_callback_url, validate_file_size, validate_image_file, validate_video_or_animation_file,
+)
+
 class ImageModerationRequestSerializer(serializers.Serializer):
-    file = serializers.ImageField()
+    file = serializers.ImageField(validators=[validate_file_size, validate_image_file])
+    # Для асинхронного режима: результат будет отправлен POST-запросом на этот адрес (только публичные http/https)
+    callback_url = serializers.URLField(required=False, validators=[validate_callback_url])
+    # full — вердикт, теги и объяснение; verdict — только вердикт и теги (быстрее и дешевле)
+    mode = serializers.ChoiceField(choices=['full', 'verdict'], default='full')
+
+    def validate_file(self, value):
+        # Размеры и число кадров по заголовку, до декодирования (FileValidationException, 413)
+        check_image_header(value)
+        return value
+
+class ImageBatchModerationRequestSerializer(serializers.Serializer):
+    # Каждый файл проверяется отдельно, чтобы одна ошибка не отменяла весь пакет
+    files = serializers.ListField(child=serializers.FileField(), allow_empty=False)
+    callback_url = serializers.URLField(required=False, validators=[validate_callback_url])
+    mode = serializers.ChoiceField(choices=['full', 'verdict'], default='full')
+
+    def validate_files(self, value):
+        limit = settings.MODERATION_BATCH_MAX_FILES
+        if len(value) > limit:
+            raise serializers.ValidationError(f'Не больше {limit} файлов за один запрос.')
+        return value
+
+class VideoModerationRequestSerializer(serializers.Serializer):
+    # Видео (mp4, mov, webm, ...) или анимированный GIF/WebP
+    file = serializers.FileField(validators=[validate_video_or_animation_file])
+
+    def validate_file(self, value):
+        limit = settings.VIDEO_MAX_UPLOAD_SIZE
+        if value.size > limit:
+            raise serializers.ValidationError(f'Размер файла не должен превышать {limit // (1024 * 1024)} МБ.')
+        if sniff_format(read_head(value)) in IMAGE_FORMATS:
+            check_image_header(value)
+        return value
 
 class ImageModerationResponseSerializer(serializers.Serializer):
     verdict = serializers.CharField()
-    explanation = serializers.CharField()
+    tags = serializers.ListField(child=serializers.CharField())
+    # Нет в режиме verdict
+    explanation = serializers.CharField(required=False)
+    cached = serializers.BooleanField()
+
+class ImageAdviceRequestSerializer(serializers.Serializer):
+    file = serializers.ImageField(validators=[validate_file_size, validate_image_file])
+
+    def validate_file(self, value):
+        check_image_header(value)
+        return value
+
+class ModerationJobSerializer(serializers.Serializer):
+    job_id = serializers.CharField()
+    kind = serializers.CharField()
+    mode = serializers.CharField()
+    status = serializers.CharField()
+    attempts = serializers.IntegerField()
+    file_count = serializers.IntegerField()
+    error = serializers.CharField(allow_null=True)
+    webhook_status = serializers.CharField(allow_null=True)
+    created_at = serializers.FloatField()
+    updated_at = serializers.FloatField()
+
+class ContentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Content
+        fields = ['id', 'file', 'file_type', 'content_hash', 'safety_status', 'created_at']
+
+class ModerationHistorySerializer(serializers.ModelSerializer):
+    content = ContentSerializer()
+    tags = serializers.SlugRelatedField(source='detected_tags', slug_field='name', many=True, read_only=True)
+
+    class Meta:
+        model = ModerationResult
+        fields = ['id', 'content', 'verdict', 'explanation', 'tags', 'created_at']
 
 class AskRequestSerializer(serializers.Serializer):
-    context = serializers.CharField()
+    # Текст передается один из способов: context, document_id или документ диалога conversation_id
+    context = serializers.CharField(required=False)
+    document_id = serializers.PrimaryKeyRelatedField(queryset=Document.objects.all(), required=False)
+    # Диалог: предыдущие вопросы и ответы берутся из истории на сервере
+    conversation_id = serializers.PrimaryKeyRelatedField(
+        queryset=Conversation.objects.select_related('document'), required=False
+    )
     question = serializers.CharField()
+    # Поиск по фрагментам: true/false; если не указано, включается для длинных текстов
+    retrieval = serializers.BooleanField(required=False, allow_null=True, default=None)
+    top_k = serializers.IntegerField(required=False, min_value=1, max_value=settings.RETRIEVAL_MAX_TOP_K)
+    # Что делать, если запрос больше ASK_INPUT_TOKEN_BUDGET: reject — 413, truncate — сократить текст
+    overflow = serializers.ChoiceField(choices=['reject', 'truncate'], required=False)
+    # Выбор модели: fast — быстрая, best — самая сильная; если не указано, выбирается по тексту и вопросу
+    quality = serializers.ChoiceField(choices=['fast', 'balanced', 'best'], required=False)
+
+    missing_context_message = 'Передайте context, document_id или conversation_id диалога с документом.'
+
+    def validate(self, attrs):
+        document = attrs.pop('document_id', None)
+        conversation = attrs.pop('conversation_id', None)
+        if document is not None and attrs.get('context'):
+            raise serializers.ValidationError('Передайте либо context, либо document_id.')
+        if document is None and conversation is not None and not attrs.get('context'):
+            document = conversation.document
+        if document is not None:
+            attrs['context'] = document.text
+        if not attrs.get('context'):
+            raise serializers.ValidationError({'context': self.missing_context_message})
+        attrs['conversation'] = conversation
+        return attrs
+
+class AskChunkSerializer(serializers.Serializer):
+    index = serializers.IntegerField()
+    start = serializers.IntegerField()
+    end = serializers.IntegerField()
+    score = serializers.FloatField()
 
 class AskResponseSerializer(serializers.Serializer):
     answer = serializers.CharField()
+    cached = serializers.BooleanField()
+    # Фрагменты текста, отправленные в модель (null — текст целиком)
+    chunks = AskChunkSerializer(many=True, allow_null=True)
+    # Текст сокращен, чтобы уложиться в лимит токенов
+    truncated = serializers.BooleanField()
+    # Модель, которая дала ответ, и маршрут выбора модели
+    model = serializers.CharField(allow_null=True)
+    route = serializers.CharField()
+    # Только для вопросов в диалоге
+    conversation_id = serializers.UUIDField(required=False)
+
+class AskBatchRequestSerializer(AskRequestSerializer):
+    # Вопросы по одному тексту; без диалога
+    question = None
+    conversation_id = None
+    questions = serializers.ListField(
+        child=serializers.CharField(), allow_empty=False, max_length=settings.ASK_BATCH_MAX_QUESTIONS
+    )
+
+    missing_context_message = 'Передайте context или document_id.'
+
+class AskUsageSerializer(serializers.Serializer):
+    prompt_tokens = serializers.IntegerField()
+    completion_tokens = serializers.IntegerField()
+    total_tokens = serializers.IntegerField()
+    # Часть prompt_tokens из кеша промптов OpenAI
+    cached_tokens = serializers.IntegerField()
+
+class AskBatchItemSerializer(AskResponseSerializer):
+    index = serializers.IntegerField()
+    question = serializers.CharField()
+    status = serializers.ChoiceField(choices=['ok', 'error'])
+    # null — ответ из кеша или общий с одинаковым вопросом
+    usage = AskUsageSerializer(allow_null=True, required=False)
+    error = serializers.CharField(required=False)
+    status_code = serializers.IntegerField(required=False)
+
+class AskBatchResponseSerializer(serializers.Serializer):
+    total = serializers.IntegerField()
+    succeeded = serializers.IntegerField()
+    failed = serializers.IntegerField()
+    usage = AskUsageSerializer(allow_null=True)
+    results = AskBatchItemSerializer(many=True)
+
+class DocumentRequestSerializer(serializers.Serializer):
+    text = serializers.CharField(max_length=settings.DOCUMENT_MAX_CHARS)
+
+class DocumentSerializer(serializers.ModelSerializer):
+    document_id = serializers.CharField(source='id')
+
+    class Meta:
+        model = Document
+        fields = ['document_id', 'chars', 'estimated_tokens', 'created_at']
+
+class ConversationRequestSerializer(serializers.Serializer):
+    document_id = serializers.PrimaryKeyRelatedField(
+        queryset=Document.objects.defer('text'), required=False, allow_null=True
+    )
+
+class ConversationTurnSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ConversationTurn
+        fields = ['question', 'answer', 'model', 'summarized', 'created_at']
+
+class ConversationSerializer(serializers.ModelSerializer):
+    conversation_id = serializers.UUIDField(source='id')
+    document_id = serializers.CharField(allow_null=True)
+    turns = ConversationTurnSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Conversation
+        fields = ['conversation_id', 'document_id', 'summary', 'turns', 'created_at', 'updated_at']
 
@@ -1,64 +1,1033 @@
-import base64
-from PIL import Image
-from io import BytesIO
-import openai
+import asyncio
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
 from django.conf import settings
 import re
 import json
+from PIL import Image
+
+from .cache import TieredCache
+from .client import async_chat_completion, chat_completion
+from .coalesce import single_flight
+from .conversations import conversation_history, record_turn
+from .exceptions import FileValidationException, OpenAIAPIException, TokenBudgetException, UpstreamUnavailableException
+from .metrics import MODERATION_PARSE, StageTimer, observe_stages
+from .imaging import prepare_image
+from .retrieval import retrieval_top_k, reduce_context, fit_context
+from .routing import ROUTES, RouteChoice, classify, routing_signature, routing_stats, select_model
+from .tokens import (
+    estimate_request_tokens, completion_with_usage, acompletion_with_usage, usage_stats, usage_headers, sum_usage,
+)
+from .streaming import astream_completion, stream_completion, stream_kwargs
+from .prefilter import VERDICT_SAFE, run_prefilter, prefilter_verdict
+from .serializers import ImageModerationRequestSerializer
+
+logger = logging.getLogger(__name__)
+
+ASK_SYSTEM_PROMPT = "Ты ИИ-помощник, анализирующий текст и отвечающий на вопросы."
+ASK_TEMPERATURE = 0.5
+ASK_MAX_TOKENS = 1000
+
+# OpenAI кеширует начало промпта от 1024 токенов
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+MODERATION_MODEL = "gpt-4o"
+
+DANGEROUS_TAGS = [
+    'pornography', 'violence', 'profanity', 'dangerous_symbols', 'hate_speech',
+    'weapons', 'drugs', 'self_harm', 'extremism', 'nudity', 'sexual_content',
+    'graphic_violence', 'blood', 'disturbing_content'
+]
+
+VERDICTS = ['safe', 'potentially_unsafe', 'unsafe']
+
+# Режимы модерации: full — вердикт, теги и объяснение с советом, verdict — только вердикт и теги
+MODE_FULL = 'full'
+MODE_VERDICT = 'verdict'
+MODERATION_MODES = (MODE_FULL, MODE_VERDICT)
+
+MODERATION_PROMPT = (
+    "Проанализируй это изображение на наличие опасного контента и пригодность для краудфандинговой платформы (например, Kickstarter). Не пиши в ответе каких тегов ты не нашел."
+    f"Верни результат в формате JSON со следующими полями: "
+    f"'verdict': safe/potentially_unsafe/unsafe, 'tags': список найденных опасных тегов, 'explanation': объяснение. "
+    f"Опасные теги: {', '.join(DANGEROUS_TAGS)}. "
+    "safe — полностью безопасно, potentially_unsafe — есть сомнительные элементы, unsafe — явно опасно. "
+    "Поле 'explanation' (2–3 предложения) должно включать как обоснование по безопасности, так и краткий совет по улучшению изображения с точки зрения краудфандинга (например: композиция, фон, доверие, профессиональность)."
+)
+
+MODERATION_VERDICT_PROMPT = (
+    "Проверь это изображение на наличие опасного контента для краудфандинговой платформы. "
+    "Верни JSON с полями 'verdict': safe/potentially_unsafe/unsafe и 'tags': список найденных опасных тегов, без пояснений. "
+    f"Опасные теги: {', '.join(DANGEROUS_TAGS)}. "
+    "safe — полностью безопасно, potentially_unsafe — есть сомнительные элементы, unsafe — явно опасно."
+)
+
+MODERATION_ADVICE_PROMPT = (
+    "Это изображение для страницы проекта на краудфандинговой платформе (например, Kickstarter). "
+    "Дай конкретные советы, как сделать его убедительнее для спонсоров: композиция, фон, свет, "
+    "доверие, профессиональность. Не больше 5 пунктов."
+)
+
+MODERATION_PROMPTS = {MODE_FULL: MODERATION_PROMPT, MODE_VERDICT: MODERATION_VERDICT_PROMPT}
+# Лимит ответа по режимам: в режиме verdict ответ — несколько десятков токенов
+MODERATION_MAX_TOKENS = {MODE_FULL: 500, MODE_VERDICT: 100}
+ADVICE_MAX_TOKENS = 600
+
+
+def moderation_schema(name, extra_properties=None):
+    """response_format для строгого JSON-ответа: вердикт из перечня и найденные теги"""
+    properties = {
+        "verdict": {"type": "string", "enum": VERDICTS},
+        "tags": {"type": "array", "items": {"type": "string", "enum": DANGEROUS_TAGS}},
+        **(extra_properties or {}),
+    }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+MODERATION_SCHEMAS = {
+    MODE_FULL: moderation_schema('moderation_full', {"explanation": {"type": "string"}}),
+    MODE_VERDICT: moderation_schema('moderation_verdict'),
+}
+
+# Версия промптов и формата ответа входит в ключ кеша: при их изменении или смене модели старые вердикты не используются
+MODERATION_PROMPT_VERSION = hashlib.sha256(
+    f"{MODERATION_MODEL}\n{MODERATION_PROMPT}\n{MODERATION_VERDICT_PROMPT}\n{MODERATION_ADVICE_PROMPT}\n"
+    f"{json.dumps(MODERATION_SCHEMAS, sort_keys=True)}\n{settings.MODERATION_STRUCTURED_OUTPUT}".encode('utf-8')
+).hexdigest()[:12]
+
+# Версия кеша ответов: при смене моделей маршрутов, промпта или параметров генерации старые ответы не используются
+ASK_CACHE_VERSION = hashlib.sha256(
+    f"{routing_signature()}\n{ASK_SYSTEM_PROMPT}\n{ASK_TEMPERATURE}\n{ASK_MAX_TOKENS}".encode('utf-8')
+).hexdigest()[:12]
+
+_verdict_cache = None
+_answer_cache = None
+_image_executor = None
+_batch_executor = None
+_ask_batch_executor = None
+
+
+def get_verdict_cache():
+    """Возвращает кеш вердиктов модерации (создается при первом обращении)"""
+    global _verdict_cache
+    if _verdict_cache is None:
+        _verdict_cache = TieredCache(
+            version=MODERATION_PROMPT_VERSION,
+            max_entries=settings.MODERATION_CACHE_MAX_ENTRIES,
+            ttl=settings.MODERATION_CACHE_TTL,
+            db_path=settings.MODERATION_CACHE_DB or None,
+            table='moderation_verdicts',
+        )
+    return _verdict_cache
+
+
+def get_answer_cache():
+    """Кеш ответов /copilot/ask/ (создается при первом обращении)"""
+    global _answer_cache
+    if _answer_cache is None:
+        _answer_cache = TieredCache(
+            version=ASK_CACHE_VERSION,
+            max_entries=settings.ASK_CACHE_MAX_ENTRIES,
+            ttl=settings.ASK_CACHE_TTL,
+            db_path=settings.ASK_CACHE_DB or None,
+            table='ask_answers',
+        )
+    return _answer_cache
+
+
+def normalize_text(text):
+    """Схлопывает пробелы и переводы строк и приводит текст к нижнему регистру"""
+    return ' '.join(text.split()).casefold()
+
+
+def answer_cache_key(context, question, variant=''):
+    """
+    Ключ кеша ответов: sha256 нормализованных текста и вопроса + версия модели/промпта.
+    variant различает режимы запроса (например, число фрагментов при поиске по тексту).
+    """
+    digest = hashlib.sha256(
+        f"{normalize_text(context)}\0{normalize_text(question)}\0{variant}".encode('utf-8')
+    ).hexdigest()
+    return f"{ASK_CACHE_VERSION}:{digest}"
+
+
+def lookup_answer(request, context, question, variant=''):
+    """
+    Ищет готовый ответ в кеше. Возвращает (ключ, запись или None); ключ None,
+    если кеш выключен. С Cache-Control: no-cache кеш не читается, но свежий
+    ответ все равно сохраняется.
+    """
+    if not settings.ASK_CACHE_ENABLED:
+        return None, None
+    key = answer_cache_key(context, question, variant)
+    if wants_fresh(request):
+        return key, None
+    return key, get_answer_cache().get(key)
+
+
+def wants_fresh(request):
+    return 'no-cache' in request.META.get('HTTP_CACHE_CONTROL', '').lower()
+
+
+def store_answer(key, entry):
+    if key is not None and entry.get("answer"):
+        get_answer_cache().set(key, entry)
+
+
+def _falls_back(exc):
+    """
+    Переключаться на запасную модель только при таймауте (504) или ошибке самого
+    OpenAI (502). Отказ circuit breaker или лимитера запросов (UpstreamUnavailableException)
+    запасная модель не исправит: он возвращается клиенту сразу.
+    """
+    if isinstance(exc, UpstreamUnavailableException):
+        return False
+    return exc.status_code in (502, 504)
+
+
+class AskPlan:
+    """
+    Подготовленный запрос /copilot/ask/: либо ответ из кеша, либо параметры
+    вызова модели (с сокращенным контекстом, если включен поиск по фрагментам).
+    В диалоге ответ записывается в историю вместе с вопросом.
+    """
+
+    def __init__(self, cache_key, route, cached=None, request_kwargs=None, chunks=None, estimated_tokens=None,
+                 truncated=False, flight_key=None, fresh=False, conversation=None, question=None):
+        self.cache_key = cache_key
+        # Маршрут и модели (для ответа из кеша — модель, которая его дала)
+        self.route = route
+        # Ключ объединения одинаковых запросов: совпадает с ключом кеша, даже если кеш выключен
+        self.flight_key = flight_key or cache_key
+        # Cache-Control: no-cache — ответ другого воркера из кеша не подходит
+        self.fresh = fresh
+        self.cached = cached
+        self.request_kwargs = request_kwargs
+        self.chunks = chunks
+        self.estimated_tokens = estimated_tokens
+        self.truncated = truncated
+        self.conversation = conversation
+        self.question = question
+        # Начало удачной попытки потокового ответа
+        self._stream_started = None
+
+    def payload(self, answer, cached=False, model=None):
+        payload = {
+            "answer": answer, "cached": cached, "chunks": self.chunks, "truncated": self.truncated,
+            "model": model or self.route.model, "route": self.route.route,
+        }
+        return self._with_conversation(payload)
+
+    def meta(self):
+        """Доп. поля события done в потоковом режиме"""
+        meta = {
+            "chunks": self.chunks, "truncated": self.truncated, "estimated_prompt_tokens": self.estimated_tokens,
+            "model": self.route.model, "route": self.route.route,
+        }
+        return self._with_conversation(meta)
+
+    def _with_conversation(self, data):
+        if self.conversation is not None:
+            data["conversation_id"] = str(self.conversation.pk)
+        return data
+
+    def store(self, answer, model=None):
+        store_answer(self.cache_key, {
+            "answer": answer, "chunks": self.chunks, "truncated": self.truncated, "model": model or self.route.model,
+        })
+        if self.conversation is not None:
+            record_turn(self.conversation, self.question, answer, model or self.route.model)
+
+    def complete(self):
+        """Запрашивает ответ модели. Возвращает (тело ответа, заголовки)"""
+        return self._response(*self.answer())
+
+    async def acomplete(self):
+        return self._response(*await self.aanswer())
+
+    def answer(self):
+        """
+        (ответ, usage, модель, shared); одинаковые одновременные вопросы ждут один вызов,
+        shared — ответ получен чужим вызовом.
+        """
+        def call():
+            answer, usage, model = self._request()
+            self.store(answer, model)
+            return answer, usage, model
+
+        (answer, usage, model), shared = single_flight.run(
+            'ask', self.flight_key, call, lookup=self._lookup if self._shared_cache() else None
+        )
+        return answer, usage, model, shared
+
+    async def aanswer(self):
+        async def call():
+            answer, usage, model = await self._arequest()
+            # store пишет реплику беседы через ORM, поэтому в потоке Django, а не в пуле для картинок
+            await sync_to_async(self.store, thread_sensitive=True)(answer, model)
+            return answer, usage, model
+
+        async def lookup():
+            return await run_in_image_executor(self._lookup)
+
+        (answer, usage, model), shared = await single_flight.arun(
+            'ask', self.flight_key, call, lookup=lookup if self._shared_cache() else None
+        )
+        return answer, usage, model, shared
+
+    def _request(self, attempt=None):
+        """
+        (ответ, usage, модель): основная модель, при таймауте или 5xx от OpenAI — запасная.
+        attempt — вызов одной модели (по умолчанию _attempt; для потока — _stream_attempt).
+        """
+        attempt = attempt or self._attempt
+        route = self.route
+        if route.fallback is None:
+            return attempt(route.model)
+        try:
+            return attempt(route.model, timeout=settings.ASK_PRIMARY_TIMEOUT, attempts=1)
+        except OpenAIAPIException as exc:
+            if not _falls_back(exc):
+                raise
+            self._on_fallback(exc)
+        return attempt(route.fallback)
+
+    async def _arequest(self, attempt=None):
+        attempt = attempt or self._aattempt
+        route = self.route
+        if route.fallback is None:
+            return await attempt(route.model)
+        try:
+            return await attempt(route.model, timeout=settings.ASK_PRIMARY_TIMEOUT, attempts=1)
+        except OpenAIAPIException as exc:
+            if not _falls_back(exc):
+                raise
+            self._on_fallback(exc)
+        return await attempt(route.fallback)
+
+    def stream(self):
+        """
+        SSE-генератор ответа с тем же выбором модели, что и complete(): переключение
+        на запасную модель возможно, пока поток не начался; время ответа модели
+        учитывается в маршрутизации, когда поток дошел до конца.
+        """
+        return stream_completion(lambda: self._request(self._stream_attempt), self._stream_done, self.meta())
+
+    def astream(self):
+        return astream_completion(lambda: self._arequest(self._astream_attempt), self._stream_done, self.meta())
+
+    def _stream_attempt(self, model, **options):
+        started = time.perf_counter()
+        try:
+            stream = chat_completion(**{**stream_kwargs(self.request_kwargs), 'model': model}, **options)
+        except OpenAIAPIException as exc:
+            self._record_timeout(model, exc, started)
+            raise
+        self._stream_started = started
+        return stream, model
+
+    async def _astream_attempt(self, model, **options):
+        started = time.perf_counter()
+        try:
+            stream = await async_chat_completion(**{**stream_kwargs(self.request_kwargs), 'model': model}, **options)
+        except OpenAIAPIException as exc:
+            self._record_timeout(model, exc, started)
+            raise
+        self._stream_started = started
+        return stream, model
+
+    def _stream_done(self, answer, model):
+        routing_stats.record_latency(model, time.perf_counter() - self._stream_started)
+        self.store(answer, model)
+
+    def _attempt(self, model, **options):
+        started = time.perf_counter()
+        try:
+            response, usage = completion_with_usage(
+                'ask', self.estimated_tokens, **{**self.request_kwargs, 'model': model}, **options
+            )
+        except OpenAIAPIException as exc:
+            self._record_timeout(model, exc, started)
+            raise
+        routing_stats.record_latency(model, time.perf_counter() - started)
+        return response.choices[0].message.content.strip(), usage, model
+
+    async def _aattempt(self, model, **options):
+        started = time.perf_counter()
+        try:
+            response, usage = await acompletion_with_usage(
+                'ask', self.estimated_tokens, **{**self.request_kwargs, 'model': model}, **options
+            )
+        except OpenAIAPIException as exc:
+            self._record_timeout(model, exc, started)
+            raise
+        routing_stats.record_latency(model, time.perf_counter() - started)
+        return response.choices[0].message.content.strip(), usage, model
+
+    def _record_timeout(self, model, exc, started):
+        # Таймаут тоже замер: медленная модель перестанет укладываться в SLO
+        if exc.status_code == 504:
+            routing_stats.record_latency(model, time.perf_counter() - started)
+
+    def _on_fallback(self, exc):
+        logger.warning(
+            f"Ask model {self.route.model} failed ({exc.status_code}), falling back to {self.route.fallback}"
+        )
+        routing_stats.record_fallback(self.route.model, self.route.fallback)
+
+    def _shared_cache(self):
+        return self.cache_key is not None and not self.fresh
+
+    def _lookup(self):
+        entry = get_answer_cache().get(self.cache_key)
+        return (entry["answer"], None, entry.get("model")) if entry else None
+
+    def _response(self, answer, usage, model, shared):
+        payload = self.payload(answer, model=model)
+        if shared:
+            # Токены потрачены другим запросом
+            payload["coalesced"] = True
+            usage = None
+        return payload, usage_headers(usage, self.estimated_tokens)
+
+
+def plan_ask(request, data):
+    """Проверяет кеш ответов и при промахе готовит запрос к модели"""
+    context = data["context"]
+    question = data["question"]
+    conversation = data.get("conversation")
+    top_k = retrieval_top_k(context, data.get("retrieval"), data.get("top_k"))
+    route = classify(context, question, data.get("quality"))
+    # Ответы разных маршрутов кешируются отдельно: быстрый ответ не отдается на запрос quality=best
+    variant = f"route={route}" + (f";top_k={top_k}" if top_k else '')
+    history = ()
+    if conversation is None:
+        cache_key, cached = lookup_answer(request, context, question, variant)
+        if cached is not None:
+            return AskPlan(
+                cache_key, RouteChoice(route, cached.get("model")), cached=cached,
+                chunks=cached.get("chunks"), truncated=cached.get("truncated", False),
+            )
+    else:
+        # Ответ зависит от истории диалога, поэтому кеш ответов не используется
+        cache_key = None
+        history = conversation_history(conversation)
+        variant += f";conversation={conversation.pk}:{len(history)}"
+    choice = select_model(route)
+    full_context = context
+    chunks = None
+    if top_k:
+        context, chunks = reduce_context(context, question, top_k)
+    request_kwargs = build_ask_request(context, question, choice.model, history)
+    estimated = estimate_request_tokens(request_kwargs)
+    budget = settings.ASK_INPUT_TOKEN_BUDGET
+    truncated = False
+    if estimated > budget:
+        overflow = data.get("overflow") or settings.ASK_TOKEN_OVERFLOW
+        # Сколько токенов остается на текст после промпта и вопроса
+        available = budget - estimate_request_tokens(build_ask_request('', question, choice.model, history))
+        if overflow != 'truncate' or available <= 0:
+            usage_stats.record_rejected('ask')
+            raise TokenBudgetException(
+                f'Запрос слишком большой: примерно {estimated} токенов при лимите {budget}. '
+                f'Сократите текст или передайте "overflow": "truncate".',
+                estimated_tokens=estimated, budget=budget
+            )
+        # Оставляем самые релевантные вопросу фрагменты, которые помещаются в бюджет
+        context, chunks = fit_context(full_context, question, available)
+        request_kwargs = build_ask_request(context, question, choice.model, history)
+        estimated = estimate_request_tokens(request_kwargs)
+        truncated = True
+    return AskPlan(
+        cache_key, choice, request_kwargs=request_kwargs, chunks=chunks, estimated_tokens=estimated, truncated=truncated,
+        flight_key=cache_key or answer_cache_key(data["context"], question, variant), fresh=wants_fresh(request),
+        conversation=conversation, question=question,
+    )
+
+
+class AskBatch:
+    """
+    Несколько вопросов по одному тексту (/copilot/ask/batch/). Каждый вопрос
+    готовится как обычный ask (кеш ответов, поиск по фрагментам, лимит токенов),
+    но все идут по одному маршруту и без поиска по фрагментам, если текст целиком
+    помещается в лимит: начало промпта (система и текст) у них совпадает.
+    Если оно не короче PROMPT_CACHE_MIN_TOKENS, первый вопрос отправляется
+    отдельно, а остальные — параллельно после него и берут начало из кеша
+    промптов OpenAI. Ошибка одного вопроса не отменяет остальные.
+    """
+
+    def __init__(self, request, data):
+        questions = data["questions"]
+        data = {**data, "quality": data.get("quality") or batch_route(data["context"], questions)}
+        if data.get("retrieval") is None and data.get("top_k") is None:
+            longest = estimate_request_tokens(build_ask_request(data["context"], max(questions, key=len), None))
+            if longest <= settings.ASK_INPUT_TOKEN_BUDGET:
+                data["retrieval"] = False
+        self.results = [None] * len(questions)
+        self.pending = []
+        # Повторы вопроса в пакете: (индекс, вопрос, индекс первого такого же вопроса)
+        self.duplicates = []
+        first = {}
+        for index, question in enumerate(questions):
+            try:
+                plan = plan_ask(request, {**data, "question": question})
+            except TokenBudgetException as exc:
+                self.results[index] = _ask_batch_error(index, question, exc.message, 413)
+                continue
+            if plan.cached is not None:
+                self.results[index] = _ask_batch_result(
+                    index, question, plan.payload(plan.cached["answer"], cached=True), None
+                )
+            elif plan.flight_key in first:
+                self.duplicates.append((index, question, first[plan.flight_key]))
+            else:
+                first[plan.flight_key] = index
+                self.pending.append((index, question, plan))
+
+    def run(self):
+        """Возвращает (тело ответа, заголовки)"""
+        pending = list(self.pending)
+        if self._warm_prefix():
+            self._answer(*pending.pop(0))
+        list(get_ask_batch_executor().map(lambda item: self._answer(*item), pending))
+        return self._response()
+
+    async def arun(self):
+        pending = list(self.pending)
+        if self._warm_prefix():
+            await self._aanswer(*pending.pop(0))
+        semaphore = asyncio.Semaphore(settings.ASK_BATCH_CONCURRENCY)
+
+        async def answer(item):
+            async with semaphore:
+                await self._aanswer(*item)
+
+        await asyncio.gather(*(answer(item) for item in pending))
+        return self._response()
+
+    def _answer(self, index, question, plan):
+        try:
+            result = plan.answer()
+        except OpenAIAPIException as exc:
+            self.results[index] = _ask_batch_error(index, question, exc.message, exc.status_code)
+            return
+        self.results[index] = self._result(index, question, plan, *result)
+
+    async def _aanswer(self, index, question, plan):
+        try:
+            result = await plan.aanswer()
+        except OpenAIAPIException as exc:
+            self.results[index] = _ask_batch_error(index, question, exc.message, exc.status_code)
+            return
+        self.results[index] = self._result(index, question, plan, *result)
+
+    def _result(self, index, question, plan, answer, usage, model, shared):
+        payload = plan.payload(answer, model=model)
+        if shared:
+            # Токены потрачены другим запросом
+            payload["coalesced"] = True
+            usage = None
+        return _ask_batch_result(index, question, payload, usage)
+
+    def _warm_prefix(self):
+        """Общее начало промпта у всех вопросов и оно достаточно длинное для кеша промптов OpenAI"""
+        if not settings.ASK_BATCH_WARM_PREFIX or len(self.pending) < 2:
+            return False
+        prefixes = {
+            (plan.request_kwargs["model"], json.dumps(plan.request_kwargs["messages"][:2], ensure_ascii=False))
+            for _, _, plan in self.pending
+        }
+        if len(prefixes) > 1:
+            return False
+        request_kwargs = self.pending[0][2].request_kwargs
+        prefix = {"model": request_kwargs["model"], "messages": request_kwargs["messages"][:2]}
+        return estimate_request_tokens(prefix) >= PROMPT_CACHE_MIN_TOKENS
+
+    def _response(self):
+        for index, question, source in self.duplicates:
+            result = {**self.results[source], "index": index, "question": question}
+            if result["status"] == "ok":
+                # Ответ получен одним запросом к модели
+                result.update(coalesced=True, usage=None)
+            self.results[index] = result
+        usage = sum_usage(item.get("usage") for item in self.results)
+        estimated = sum(plan.estimated_tokens for _, _, plan in self.pending) if self.pending else None
+        return {**_batch_response(self.results), "usage": usage}, usage_headers(usage, estimated)
+
+
+def batch_route(context, questions):
+    """Маршрут пакета — самый требовательный из маршрутов вопросов: одна модель на все вопросы"""
+    return max((classify(context, question) for question in questions), key=ROUTES.index)
+
+
+def _ask_batch_result(index, question, payload, usage):
+    return {"index": index, "question": question, "status": "ok", **payload, "usage": usage}
+
+
+def _ask_batch_error(index, question, error, status_code):
+    return {"index": index, "question": question, "status": "error", "error": error, "status_code": status_code}
+
+
+def get_ask_batch_executor():
+    """Пул потоков для /copilot/ask/batch/ (не больше ASK_BATCH_CONCURRENCY вопросов параллельно)"""
+    global _ask_batch_executor
+    if _ask_batch_executor is None:
+        _ask_batch_executor = ThreadPoolExecutor(
+            max_workers=settings.ASK_BATCH_CONCURRENCY, thread_name_prefix='copilot-ask-batch'
+        )
+    return _ask_batch_executor
+
+
+def get_image_executor():
+    """Пул потоков для работы с PIL, чтобы не блокировать event loop"""
+    global _image_executor
+    if _image_executor is None:
+        _image_executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_WORKER_THREADS, thread_name_prefix='copilot-image'
+        )
+    return _image_executor
+
+
+async def run_in_image_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_image_executor(), func, *args)
 
-def analyze_image_with_ai(image_file):
-    """
-    Принимает InMemoryUploadedFile, возвращает вердикт и объяснение от OpenAI Vision
-    """
-    # Преобразуем изображение в base64
-    img = Image.open(image_file)
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    buffer = BytesIO()
-    img.save(buffer, format='JPEG')
-    img_b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-    client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
-    dangerous_tags = [
-        'pornography', 'violence', 'profanity', 'dangerous_symbols', 'hate_speech',
-        'weapons', 'drugs', 'self_harm', 'extremism', 'nudity', 'sexual_content',
-        'graphic_violence', 'blood', 'disturbing_content'
-    ]
-    prompt = (
-        "Проанализируй это изображение на наличие опасного контента и пригодность для краудфандинговой платформы (например, Kickstarter). Не пиши в ответе каких тегов ты не нашел."
-        f"Верни результат в формате JSON со следующими полями: "
-        f"'verdict': safe/potentially_unsafe/unsafe, 'explanation': объяснение. "
-        f"Опасные теги: {', '.join(dangerous_tags)}. "
-        "safe — полностью безопасно, potentially_unsafe — есть сомнительные элементы, unsafe — явно опасно. "
-        "Поле 'explanation' должно включать как обоснование по безопасности, так и краткий совет по улучшению изображения с точки зрения краудфандинга (например: композиция, фон, доверие, профессиональность)."
+
+def build_ask_request(context, question, model, history=()):
+    """
+    Параметры chat.completions.create для вопроса по тексту. Текст — отдельным
+    сообщением перед историей диалога и вопросом: у вопросов по одному тексту
+    начало промпта совпадает побайтно, и OpenAI берет его из кеша промптов.
+    """
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": ASK_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Текст: {context}"},
+            *history,
+            {"role": "user", "content": f"Вопрос: {question}"},
+        ],
+        temperature=ASK_TEMPERATURE,
+        max_tokens=ASK_MAX_TOKENS,
     )
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
+
+def image_digest(image_file):
+    """sha256 содержимого загруженного файла"""
+    digest = hashlib.sha256()
+    for chunk in image_file.chunks():
+        digest.update(chunk)
+    image_file.seek(0)
+    return digest.hexdigest()
+
+
+def moderation_cache_key(digest, mode=MODE_FULL):
+    """Ключ кеша: хеш файла + версия промпта/модели; у режимов, кроме full, — свой ключ"""
+    if mode == MODE_FULL:
+        return f"{MODERATION_PROMPT_VERSION}:{digest}"
+    return f"{MODERATION_PROMPT_VERSION}:{mode}:{digest}"
+
+
+def image_cache_key(image_file, mode=MODE_FULL):
+    return moderation_cache_key(image_digest(image_file), mode)
+
+
+def _cached_verdict(cache, digest, mode):
+    """Вердикт из кеша; для режима verdict подходит и полный вердикт того же изображения"""
+    result = cache.get(moderation_cache_key(digest, mode))
+    if result is None and mode == MODE_VERDICT:
+        full = cache.get(moderation_cache_key(digest))
+        if full is not None:
+            result = verdict_only(full)
+    return result
+
+
+def verdict_only(result):
+    """Результат режима verdict: без объяснения и совета"""
+    return {key: value for key, value in result.items() if key != "explanation"}
+
+
+def analyze_image_with_ai(image_file, mode=MODE_FULL):
+    """
+    Принимает InMemoryUploadedFile, возвращает вердикт, найденные теги и объяснение от OpenAI Vision
+    (в режиме verdict — без объяснения).
+    Повторные загрузки того же изображения отдаются из кеша (поле cached),
+    одновременные одинаковые загрузки ждут один запрос к модели (поле coalesced).
+    """
+    cache = get_verdict_cache() if settings.MODERATION_CACHE_ENABLED else None
+    digest = image_digest(image_file) if cache is not None or settings.COALESCE_ENABLED else None
+    key = moderation_cache_key(digest, mode) if digest is not None else None
+    if cache is not None:
+        result = _cached_verdict(cache, digest, mode)
+        if result is not None:
+            return {**result, "cached": True}
+
+    def lookup():
+        result = _cached_verdict(cache, digest, mode)
+        return None if result is None else {**result, "cached": True}
+
+    def fresh():
+        result, stats = _request_verdict(image_file, mode)
+        if cache is not None and _is_cacheable(result, stats):
+            cache.set(key, result)
+        return {**result, "cached": False, "preprocessing": stats}
+
+    result, shared = single_flight.run('moderate-image', key, fresh, lookup=lookup if cache is not None else None)
+    return {**result, "coalesced": True} if shared else result
+
+
+def _is_cacheable(result, stats):
+    """
+    Ошибки разбора ответа не кешируем, чтобы повторный запрос мог их исправить.
+    Решения префильтра тоже: они дешевые и зависят от порогов в настройках.
+    """
+    return result["verdict"] != "error" and stats.get("prefilter", {}).get("verdict") != VERDICT_SAFE
+
+
+async def analyze_image_with_ai_async(image_file, mode=MODE_FULL):
+    """
+    Асинхронный вариант analyze_image_with_ai для ASGI.
+    Хеширование, кеш и PIL выполняются в пуле потоков, запрос — через AsyncOpenAI.
+    """
+    cache = get_verdict_cache() if settings.MODERATION_CACHE_ENABLED else None
+    digest = key = None
+    if cache is not None or settings.COALESCE_ENABLED:
+        digest = await run_in_image_executor(image_digest, image_file)
+        key = moderation_cache_key(digest, mode)
+    if cache is not None:
+        result = await run_in_image_executor(_cached_verdict, cache, digest, mode)
+        if result is not None:
+            return {**result, "cached": True}
+
+    async def lookup():
+        result = await run_in_image_executor(_cached_verdict, cache, digest, mode)
+        return None if result is None else {**result, "cached": True}
+
+    async def fresh():
+        result, stats = await _arequest_verdict(image_file, mode)
+        if cache is not None and _is_cacheable(result, stats):
+            await run_in_image_executor(cache.set, key, result)
+        return {**result, "cached": False, "preprocessing": stats}
+
+    result, shared = await single_flight.arun(
+        'moderate-image', key, fresh, lookup=lookup if cache is not None else None
+    )
+    return {**result, "coalesced": True} if shared else result
+
+
+async def _arequest_verdict(image_file, mode=MODE_FULL):
+    """Асинхронный _request_verdict: PIL в пуле потоков, запрос через AsyncOpenAI"""
+    if await run_in_image_executor(is_animated_image, image_file):
+        # Анимация разбирается на кадры и проверяется синхронно в пуле потоков
+        return await run_in_image_executor(_request_verdict, image_file, mode)
+    prefiltered = await run_in_image_executor(run_prefilter, image_file)
+    if prefiltered is not None and prefiltered.cleared:
+        return _for_mode(prefilter_verdict(prefiltered), mode), {"prefilter": prefiltered.stats()}
+    prepared = await run_in_image_executor(prepare_image, image_file)
+    observe_stages(prepared.timings)
+    estimated = estimate_moderation_tokens(prepared, mode)
+    with StageTimer('upstream'):
+        response, usage = await acompletion_with_usage(
+            'moderate-image', estimated, **build_moderation_request(prepared, mode)
+        )
+    stats = _with_usage(_with_prefilter(prepared.stats(), prefiltered), estimated, usage)
+    with StageTimer('json_parse'):
+        result = parse_moderation_response(response, mode)
+    return result, stats
+
+
+def advise_image(image_file):
+    """
+    Советы по улучшению изображения для краудфандинга — отдельный запрос по требованию,
+    чтобы обычная модерация не тратила на них токены. Результат кешируется вместе с вердиктами.
+    """
+    cache = get_verdict_cache() if settings.MODERATION_CACHE_ENABLED else None
+    key = image_cache_key(image_file, 'advice') if cache is not None or settings.COALESCE_ENABLED else None
+    if cache is not None:
+        result = cache.get(key)
+        if result is not None:
+            return {**result, "cached": True}
+
+    def lookup():
+        result = cache.get(key)
+        return None if result is None else {**result, "cached": True}
+
+    def fresh():
+        prepared = prepare_image(image_file)
+        observe_stages(prepared.timings)
+        request_kwargs = build_advice_request(prepared)
+        estimated = estimate_request_tokens(request_kwargs, image_sizes=[(prepared.width, prepared.height)])
+        with StageTimer('upstream'):
+            response, usage = completion_with_usage('moderate-advice', estimated, **request_kwargs)
+        choice = response.choices[0]
+        result = {"advice": choice.message.content or "", "truncated": getattr(choice, 'finish_reason', None) == 'length'}
+        if cache is not None and result["advice"]:
+            cache.set(key, result)
+        return {**result, "cached": False, "preprocessing": _with_usage(prepared.stats(), estimated, usage)}
+
+    result, shared = single_flight.run('moderate-advice', key, fresh, lookup=lookup if cache is not None else None)
+    return {**result, "coalesced": True} if shared else result
+
+
+def build_advice_request(prepared):
+    """Параметры запроса советов по изображению: свободный текст, без схемы"""
+    return dict(
+        model=MODERATION_MODEL,
         messages=[
             {
                 "role": "user",
                 "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
+                    {"type": "text", "text": MODERATION_ADVICE_PROMPT},
+                    {"type": "image_url", "image_url": {"url": prepared.data_url}}
                 ]
             }
         ],
-        max_tokens=300
+        max_tokens=ADVICE_MAX_TOKENS
     )
+
+
+def get_batch_executor():
+    """Пул потоков для пакетной модерации (ограничивает число параллельных запросов к OpenAI)"""
+    global _batch_executor
+    if _batch_executor is None:
+        _batch_executor = ThreadPoolExecutor(
+            max_workers=settings.MODERATION_BATCH_CONCURRENCY, thread_name_prefix='copilot-batch'
+        )
+    return _batch_executor
+
+
+def _validate_batch_file(index, upload):
+    """Проверяет файл так же, как moderate-image; возвращает (файл, None) или (None, ошибка)"""
+    serializer = ImageModerationRequestSerializer(data={"file": upload})
     try:
-        content = response.choices[0].message.content
-        # Убираем блоки ```json ... ```
-        match = re.search(r'```json\s*(\{.*\})\s*```', content, re.DOTALL)
-        if match:
-            content = match.group(1)
-        result = json.loads(content)
-        return {
-            "verdict": result.get("verdict", "unknown"),
-            "explanation": result.get("explanation", "")
-        }
-    except Exception:
-        return {
-            "verdict": "error",
-            "explanation": response.choices[0].message.content
-        }
+        if not serializer.is_valid():
+            return None, _batch_error(index, upload, serializer.errors)
+    except FileValidationException as exc:
+        return None, _batch_error(index, upload, exc.message, exc.status_code)
+    return serializer.validated_data["file"], None
+
+
+def _batch_error(index, upload, error, status_code=400):
+    return {
+        "index": index,
+        "file_name": getattr(upload, 'name', None),
+        "status": "error",
+        "error": error,
+        "status_code": status_code,
+    }
+
+
+def moderate_batch_item(index, upload, mode=MODE_FULL):
+    """Модерация одного файла пакета; ошибки не прерывают обработку остальных"""
+    image_file, error = _validate_batch_file(index, upload)
+    if error is not None:
+        return error
+    try:
+        result = analyze_image_with_ai(image_file, mode)
+    except OpenAIAPIException as exc:
+        return _batch_error(index, upload, exc.message, exc.status_code)
+    return {"index": index, "file_name": upload.name, "status": "ok", **result}
+
+
+def _batch_response(items):
+    succeeded = sum(1 for item in items if item["status"] == "ok")
+    return {
+        "total": len(items),
+        "succeeded": succeeded,
+        "failed": len(items) - succeeded,
+        "results": items,
+    }
+
+
+def moderate_image_batch(files, mode=MODE_FULL):
+    """
+    Модерирует несколько изображений параллельно (не больше MODERATION_BATCH_CONCURRENCY).
+    Результаты возвращаются в порядке загрузки файлов.
+    """
+    executor = get_batch_executor()
+    items = list(executor.map(moderate_batch_item, range(len(files)), files, [mode] * len(files)))
+    return _batch_response(items)
+
+
+async def moderate_image_batch_async(files, mode=MODE_FULL):
+    """Асинхронный вариант moderate_image_batch с ограничением через семафор"""
+    semaphore = asyncio.Semaphore(settings.MODERATION_BATCH_CONCURRENCY)
+
+    async def moderate(index, upload):
+        async with semaphore:
+            image_file, error = await run_in_image_executor(_validate_batch_file, index, upload)
+            if error is not None:
+                return error
+            try:
+                result = await analyze_image_with_ai_async(image_file, mode)
+            except OpenAIAPIException as exc:
+                return _batch_error(index, upload, exc.message, exc.status_code)
+            return {"index": index, "file_name": upload.name, "status": "ok", **result}
+
+    items = await asyncio.gather(*(moderate(index, upload) for index, upload in enumerate(files)))
+    return _batch_response(list(items))
+
+
+def build_moderation_request(prepared, mode=MODE_FULL):
+    """
+    Параметры chat.completions.create для подготовленного изображения.
+    При MODERATION_STRUCTURED_OUTPUT ответ ограничен JSON-схемой режима (strict).
+    """
+    request_kwargs = dict(
+        model=MODERATION_MODEL,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": MODERATION_PROMPTS[mode]},
+                    {"type": "image_url", "image_url": {"url": prepared.data_url}}
+                ]
+            }
+        ],
+        max_tokens=MODERATION_MAX_TOKENS[mode]
+    )
+    if settings.MODERATION_STRUCTURED_OUTPUT:
+        request_kwargs["response_format"] = MODERATION_SCHEMAS[mode]
+    return request_kwargs
+
+
+def is_animated_image(image_file):
+    """Анимированный GIF/WebP (больше одного кадра); читается только заголовок"""
+    image_file.seek(0)
+    try:
+        return getattr(Image.open(image_file), 'is_animated', False)
+    finally:
+        image_file.seek(0)
+
+
+def _request_verdict(image_file, mode=MODE_FULL):
+    """Отправляет изображение в OpenAI Vision и разбирает ответ; возвращает (вердикт, статистику)"""
+    if is_animated_image(image_file):
+        from .video import moderate_animation
+        result, stats = moderate_animation(image_file)
+        return _for_mode(result, mode), stats
+    # Очевидно безопасные изображения отсекаются локально, без запроса к модели
+    prefiltered = run_prefilter(image_file)
+    if prefiltered is not None and prefiltered.cleared:
+        return _for_mode(prefilter_verdict(prefiltered), mode), {"prefilter": prefiltered.stats()}
+    # Уменьшаем изображение (или передаем как есть) и кодируем в base64
+    prepared = prepare_image(image_file)
+    observe_stages(prepared.timings)
+    estimated = estimate_moderation_tokens(prepared, mode)
+    with StageTimer('upstream'):
+        response, usage = completion_with_usage(
+            'moderate-image', estimated, **build_moderation_request(prepared, mode)
+        )
+    stats = _with_usage(_with_prefilter(prepared.stats(), prefiltered), estimated, usage)
+    with StageTimer('json_parse'):
+        result = parse_moderation_response(response, mode)
+    return result, stats
+
+
+def _for_mode(result, mode):
+    return verdict_only(result) if mode == MODE_VERDICT and result["verdict"] != "error" else result
+
+
+def estimate_moderation_tokens(prepared, mode=MODE_FULL):
+    """Оценка prompt_tokens: промпт плюс изображение по размерам после предобработки"""
+    return estimate_request_tokens(
+        build_moderation_request(prepared, mode), image_sizes=[(prepared.width, prepared.height)]
+    )
+
+
+def _with_prefilter(stats, prefiltered):
+    if prefiltered is not None:
+        stats["prefilter"] = prefiltered.stats()
+    return stats
+
+
+def _with_usage(stats, estimated, usage):
+    stats["estimated_prompt_tokens"] = estimated
+    stats["usage"] = usage
+    return stats
+
+
+def moderation_usage_headers(results):
+    """Заголовки с расходом токенов по результатам модерации (для пакета — сумма)"""
+    stats = [item.get("preprocessing") or {} for item in results]
+    usage = sum_usage(item.get("usage") for item in stats)
+    estimated = [item["estimated_prompt_tokens"] for item in stats if "estimated_prompt_tokens" in item]
+    return usage_headers(usage, sum(estimated) if estimated else None)
+
+
+def parse_json_content(content):
+    """Достает JSON из ответа модели, в том числе из блока ```json ... ```"""
+    match = re.search(r'```json\s*(\{.*\})\s*```', content, re.DOTALL)
+    if match:
+        content = match.group(1)
+    return json.loads(content)
+
+
+def parse_verdict_content(response, source):
+    """
+    Разбирает JSON-вердикт из ответа модели: (данные или None, исход разбора).
+    Исход — ok, invalid_json, truncated (ответ обрезан по max_tokens), refusal (отказ модели)
+    или schema_mismatch (вердикт не из перечня); считается в метрике по формату ответа.
+    """
+    choice = response.choices[0]
+    message = choice.message
+    response_format = 'json_schema' if settings.MODERATION_STRUCTURED_OUTPUT else 'free_form'
+    data = None
+    if getattr(message, 'refusal', None):
+        outcome = 'refusal'
+    else:
+        try:
+            # Ответ по схеме — чистый JSON; свободный может быть обернут в ```json
+            content = message.content
+            data = json.loads(content) if response_format == 'json_schema' else parse_json_content(content)
+            outcome = 'ok' if isinstance(data, dict) and data.get("verdict") in VERDICTS else 'schema_mismatch'
+        except (TypeError, ValueError):
+            outcome = 'truncated' if getattr(choice, 'finish_reason', None) == 'length' else 'invalid_json'
+    MODERATION_PARSE.labels(source, response_format, outcome).inc()
+    if outcome != 'ok':
+        logger.warning(f"Moderation response not parsed ({source}, {response_format}): {outcome}")
+        return None, outcome
+    return data, outcome
+
+
+def detected_tags(data):
+    """Найденные теги из ответа: только известные, без повторов"""
+    tags = data.get("tags") or []
+    return [tag for tag in DANGEROUS_TAGS if tag in tags]
+
+
+def unparsed_verdict(response, outcome):
+    """Вердикт error с исходным текстом (или отказом) модели, если ответ не разобран"""
+    message = response.choices[0].message
+    return {
+        "verdict": "error",
+        "tags": [],
+        "explanation": getattr(message, 'refusal', None) or message.content or "",
+        "parse_error": outcome,
+    }
+
+
+def parse_moderation_response(response, mode=MODE_FULL):
+    """Вердикт и найденные теги из ответа модели (в режиме full — и объяснение)"""
+    data, outcome = parse_verdict_content(response, 'image')
+    if data is None:
+        return unparsed_verdict(response, outcome)
+    result = {"verdict": data["verdict"], "tags": detected_tags(data)}
+    if mode == MODE_FULL:
+        result["explanation"] = data.get("explanation", "")
+    return result
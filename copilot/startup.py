@@ -0,0 +1,41 @@
+"""
+Подготовка мастера gunicorn к fork воркеров при --preload.
+
+Тяжелые зависимости (openai, httpx, NumPy, OpenCV) импортируются лениво,
+при первом запросе, которому они нужны. С --preload их выгоднее загрузить
+один раз в мастере: воркеры получают страницы памяти через fork и делят их
+(copy-on-write), пока не изменят. gc.freeze() переносит уже созданные объекты
+в постоянное поколение — сборщик мусора воркера не обходит их и не пишет
+в их заголовки, поэтому общие страницы не копируются.
+"""
+import gc
+import importlib
+import logging
+import time
+
+from django.db import connections
+from django.urls import get_resolver
+
+logger = logging.getLogger(__name__)
+
+# Модули, которые без --preload загружаются при первом запросе; cv2 — необязательная зависимость
+DEFERRED_IMPORTS = ['httpx', 'openai', 'numpy', 'PIL.Image', 'cv2']
+
+
+def warm_up():
+    """Импортирует URLconf со всеми view и отложенные модули, закрывает соединения с БД и замораживает GC"""
+    started = time.perf_counter()
+    get_resolver().url_patterns
+    for name in DEFERRED_IMPORTS:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    from PIL import Image
+    # Плагины форматов Pillow подключаются при первом Image.open
+    Image.init()
+    # Соединения и файловые дескрипторы мастера не должны достаться воркерам
+    connections.close_all()
+    gc.collect()
+    gc.freeze()
+    logger.info(f"Preload warm-up finished in {(time.perf_counter() - started) * 1000:.0f} ms")
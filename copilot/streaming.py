@@ -0,0 +1,165 @@
+"""
+Потоковая отдача ответа /copilot/ask/ через Server-Sent Events.
+"""
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse
+
+from .exceptions import OpenAIAPIException, retry_after_seconds
+from .renderers import sse_event
+from .tokens import usage_from_response, usage_stats
+
+logger = logging.getLogger(__name__)
+
+EVENT_STREAM = 'text/event-stream'
+
+
+def wants_event_stream(request):
+    """Потоковый режим включается параметром ?stream=true или заголовком Accept"""
+    if request.GET.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return EVENT_STREAM in request.META.get('HTTP_ACCEPT', '')
+
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type=EVENT_STREAM)
+    response['Cache-Control'] = 'no-cache'
+    # Отключаем буферизацию в nginx, иначе токены придут одним куском
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class _StreamStats:
+    """Время до первого токена и общее время генерации"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.usage = None
+
+    def record_usage(self, meta):
+        """Учитывает расход токенов потока в счетчиках эндпоинта ask"""
+        estimated = (meta or {}).get('estimated_prompt_tokens')
+        usage_stats.record('ask', self.usage, estimated, time.perf_counter() - self.started)
+
+    def token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+
+    def done_event(self, cached=False, meta=None):
+        finished = time.perf_counter()
+        return sse_event('done', {
+            **(meta or {}),
+            'usage': self.usage,
+            'cached': cached,
+            'timing': {
+                'time_to_first_token_ms': round((self.first_token - self.started) * 1000, 2) if self.first_token else None,
+                'total_ms': round((finished - self.started) * 1000, 2),
+            },
+        })
+
+
+def _error_event(exc):
+    data = {'message': exc.message, 'status_code': exc.status_code}
+    retry_after = retry_after_seconds(exc)
+    if retry_after is not None:
+        data['retry_after'] = retry_after
+    return sse_event('error', data)
+
+
+def stream_kwargs(request_kwargs):
+    return {**request_kwargs, 'stream': True, 'stream_options': {'include_usage': True}}
+
+
+def _with_model(meta, model):
+    """В событии done — модель, которая действительно ответила (после переключения на запасную)"""
+    if meta is None or model is None:
+        return meta
+    return {**meta, 'model': model}
+
+
+def _chunk_text(chunk, stats):
+    if chunk.usage is not None:
+        # Тот же плоский usage, что в обычном ответе /copilot/ask/ (с cached_tokens)
+        stats.usage = usage_from_response(chunk)
+    if chunk.choices and chunk.choices[0].delta.content:
+        stats.token()
+        return chunk.choices[0].delta.content
+    return None
+
+
+def stream_cached_answer(answer, meta=None):
+    """Ответ из кеша одним событием token и событием done"""
+    stats = _StreamStats()
+    stats.token()
+    yield sse_event('token', {'content': answer})
+    yield stats.done_event(cached=True, meta=meta)
+
+
+async def astream_cached_answer(answer, meta=None):
+    for event in stream_cached_answer(answer, meta):
+        yield event
+
+
+def stream_completion(open_stream, on_complete=None, meta=None):
+    """
+    Генератор SSE-событий для WSGI. open_stream() открывает поток OpenAI и возвращает
+    (поток, модель). При обрыве соединения сервер закрывает генератор, и finally
+    закрывает поток OpenAI. on_complete получает полный текст ответа и модель, если
+    поток дошел до конца; meta добавляется в событие done.
+    """
+    stats = _StreamStats()
+    parts = []
+    try:
+        stream, model = open_stream()
+    except OpenAIAPIException as exc:
+        yield _error_event(exc)
+        return
+    meta = _with_model(meta, model)
+    try:
+        for chunk in stream:
+            text = _chunk_text(chunk, stats)
+            if text:
+                parts.append(text)
+                yield sse_event('token', {'content': text})
+        stats.record_usage(meta)
+        if on_complete is not None:
+            on_complete(''.join(parts).strip(), model)
+        yield stats.done_event(meta=meta)
+    except GeneratorExit:
+        logger.info("Client disconnected, closing upstream stream")
+        raise
+    except Exception as e:
+        logger.error(f"Error while streaming answer: {str(e)}")
+        yield sse_event('error', {'message': 'Ошибка при получении ответа от AI сервиса'})
+    finally:
+        stream.close()
+
+
+async def astream_completion(open_stream, on_complete=None, meta=None):
+    """Асинхронный генератор SSE-событий для ASGI; отмена задачи закрывает поток OpenAI"""
+    stats = _StreamStats()
+    parts = []
+    try:
+        stream, model = await open_stream()
+    except OpenAIAPIException as exc:
+        yield _error_event(exc)
+        return
+    meta = _with_model(meta, model)
+    try:
+        async for chunk in stream:
+            text = _chunk_text(chunk, stats)
+            if text:
+                parts.append(text)
+                yield sse_event('token', {'content': text})
+        stats.record_usage(meta)
+        if on_complete is not None:
+            await sync_to_async(on_complete, thread_sensitive=True)(''.join(parts).strip(), model)
+        yield stats.done_event(meta=meta)
+    except Exception as e:
+        logger.error(f"Error while streaming answer: {str(e)}")
+        yield sse_event('error', {'message': 'Ошибка при получении ответа от AI сервиса'})
+    finally:
+        await stream.close()
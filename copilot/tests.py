@@ -0,0 +1,1562 @@
+import asyncio
+import base64
+import json
+import os
+import queue
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import timedelta
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+import numpy as np
+import openai
+from prometheus_client import REGISTRY
+from PIL import Image, ImageDraw
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    async_views, benchmark, client, conversations, history, jobs, middleware, retrieval, routing, services, startup,
+    video, views,
+)
+from .cache import TieredCache
+from .coalesce import SingleFlight, _lock_path, _try_lock, _unlock
+from .exceptions import (
+    FileValidationException, OpenAIAPIException, TokenBudgetException, UpstreamUnavailableException,
+)
+from .imaging import prepare_image
+from .metrics import error_status
+from .models import Content, Conversation, ConversationTurn, ModerationResult, Tag
+from .prefilter import HeuristicPrefilter, VERDICT_ESCALATE, VERDICT_SAFE
+from .ratelimit import MemoryStateStore, UpstreamGuard
+from .tokens import estimate_image_tokens, estimate_request_tokens, estimate_text_tokens, usage_headers
+from .uploads import sniff_format
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def png_header(width, height):
+    """Заголовок PNG (IHDR и пустой IDAT): PIL читает размеры, пиксели не нужны"""
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', ihdr) + png_chunk(b'IDAT', b'')
+
+
+class SniffFormatTests(SimpleTestCase):
+    def test_image_signatures(self):
+        self.assertEqual(sniff_format(b'\xff\xd8\xff\xe0' + b'\0' * 28), 'jpeg')
+        self.assertEqual(sniff_format(png_header(1, 1)[:32]), 'png')
+        self.assertEqual(sniff_format(b'GIF89a' + b'\0' * 26), 'gif')
+        self.assertEqual(sniff_format(b'RIFF\0\0\0\0WEBPVP8 '), 'webp')
+
+    def test_video_signatures(self):
+        self.assertEqual(sniff_format(b'\0\0\0\x18ftypisom'), 'mp4')
+        self.assertEqual(sniff_format(b'\0\0\0\x14ftypqt  '), 'mov')
+        self.assertEqual(sniff_format(b'RIFF\0\0\0\0AVI LIST'), 'avi')
+        self.assertEqual(sniff_format(b'\x1a\x45\xdf\xa3\x9f'), 'webm')
+
+    def test_unknown_and_heif(self):
+        self.assertIsNone(sniff_format(b'\0\0\0\x18ftypheic'))
+        self.assertIsNone(sniff_format(b'<?php echo 1; ?>'))
+        self.assertIsNone(sniff_format(b''))
+
+
+class UploadLimitTests(SimpleTestCase):
+    """Проверки UploadLimitHandler до обращения к OpenAI"""
+
+    def post_image(self, data, name='image.jpg'):
+        upload = SimpleUploadedFile(name, data, content_type='image/jpeg')
+        return self.client.post(reverse('moderate-image'), {'file': upload})
+
+    def test_format_is_sniffed_not_taken_from_extension(self):
+        response = self.post_image(b'<?php echo 1; ?>' * 4, name='photo.jpg')
+        self.assertEqual(response.status_code, 415)
+
+    def test_pixel_limit_is_checked_from_header(self):
+        response = self.post_image(png_header(20000, 20000), name='huge.png')
+        self.assertEqual(response.status_code, 413)
+
+    @override_settings(UPLOAD_MAX_IMAGE_SIZE=1024)
+    def test_file_size_limit(self):
+        response = self.post_image(png_header(10, 10) + b'\0' * 4096, name='big.png')
+        self.assertEqual(response.status_code, 413)
+
+    @override_settings(UPLOAD_MAX_IMAGE_SIZE=1024)
+    def test_content_length_limit(self):
+        response = self.post_image(png_header(10, 10) + b'\0' * (2 * 1024 * 1024), name='big.png')
+        self.assertEqual(response.status_code, 413)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, flight, fn, count, lookup=None):
+        results = [None] * count
+
+        def worker(index):
+            results[index] = flight.run('test', 'key', fn, lookup=lookup)
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_calls_share_one_result(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return 'answer'
+
+        threads, results = self.run_concurrently(flight, fn, 4)
+        # Даем последователям дойти до ожидания лидера
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('answer', False)] + [('answer', True)] * 3)
+
+    def test_error_is_shared_with_waiters(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        errors = []
+
+        def fn():
+            release.wait(5)
+            raise ValueError('upstream failed')
+
+        def worker():
+            try:
+                flight.run('test', 'key', fn)
+            except ValueError as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=worker) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 3)
+        self.assertFalse(flight._calls)
+
+    @override_settings(COALESCE_ENABLED=False)
+    def test_disabled(self):
+        calls = []
+        value = SingleFlight().run('test', 'key', lambda: calls.append(1) or 'answer')
+        self.assertEqual(value, ('answer', False))
+        self.assertEqual(len(calls), 1)
+
+    def test_cross_worker_waits_for_lock_and_reads_shared_cache(self):
+        with tempfile.TemporaryDirectory() as lock_dir, override_settings(COALESCE_LOCK_DIR=lock_dir):
+            # Блокировку держит «другой воркер»; flock конфликтует и внутри одного процесса
+            path = _lock_path('test', 'key')
+            fd = _try_lock(path)
+            shared = {}
+            calls = []
+            threads, results = self.run_concurrently(
+                SingleFlight(), lambda: calls.append(1) or 'own', 1, lookup=lambda: shared.get('value')
+            )
+            time.sleep(0.2)
+            shared['value'] = 'from other worker'
+            _unlock(path, fd)
+            threads[0].join(5)
+        self.assertEqual(results, [('from other worker', True)])
+        self.assertEqual(calls, [])
+
+    def test_async_calls_share_one_result(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'answer'
+
+        async def main():
+            return await asyncio.gather(*(flight.arun('test', 'key', fn) for _ in range(3)))
+
+        results = asyncio.run(main())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('answer', False)] + [('answer', True)] * 2)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        content = Content.objects.create(file_type='image', content_hash='0' * 64, safety_status='safe')
+        now = timezone.now()
+        # Три записи с одинаковым временем: порядок внутри них задает id
+        offsets = [0, 1, 1, 1, 2, 3, 5]
+        self.results = []
+        for offset in offsets:
+            result = ModerationResult.objects.create(content=content, verdict='safe')
+            ModerationResult.objects.filter(pk=result.pk).update(created_at=now - timedelta(seconds=offset))
+            self.results.append(result.pk)
+
+    def walk(self, url):
+        seen = []
+        pages = 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            seen += [item['id'] for item in data['results']]
+            self.assertEqual(data['pagination']['has_next'], data['pagination']['next'] is not None)
+            url = data['pagination']['next']
+            pages += 1
+        return seen, pages
+
+    def test_pages_cover_all_rows_once_in_order(self):
+        seen, pages = self.walk(reverse('moderation-history') + '?page_size=2')
+        # Порядок: created_at по убыванию, при равном времени — id по убыванию
+        expected = [self.results[0], self.results[3], self.results[2], self.results[1], *self.results[4:]]
+        self.assertEqual(seen, expected)
+        self.assertEqual(pages, 4)
+
+    def test_filter_applies_to_every_page(self):
+        ModerationResult.objects.filter(pk__in=self.results[:3]).update(verdict='unsafe')
+        seen, _ = self.walk(reverse('moderation-history') + '?page_size=1&verdict=unsafe')
+        self.assertEqual(sorted(seen), sorted(self.results[:3]))
+
+    def test_count_estimate_respects_filters(self):
+        ModerationResult.objects.filter(pk__in=self.results[:3]).update(verdict='unsafe')
+        url = reverse('moderation-history') + '?count=approximate'
+        self.assertEqual(self.client.get(url).json()['pagination']['count_estimate'], 7)
+        self.assertEqual(self.client.get(url + '&verdict=unsafe').json()['pagination']['count_estimate'], 3)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('moderation-history') + '?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    def test_job_list_pages(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = jobs.JobStore(f'{directory}/jobs.sqlite3')
+            job_ids = [store.enqueue(jobs.KIND_IMAGE, []) for _ in range(5)]
+            with mock.patch.object(jobs, '_store', store):
+                response = self.client.get(reverse('moderation-jobs') + '?page_size=3&count=approximate')
+                first = response.json()
+                second = self.client.get(first['pagination']['next']).json()
+            store.finish(job_ids[0], 0, jobs.STATUS_DONE)
+            self.assertEqual(store.approximate_count(jobs.STATUS_DONE), 1)
+        self.assertEqual(first['pagination']['count_estimate'], 5)
+        self.assertFalse(second['pagination']['has_next'])
+        seen = [job['job_id'] for job in first['results'] + second['results']]
+        self.assertEqual(sorted(seen), sorted(job_ids))
+        self.assertEqual(len(seen), len(set(seen)))
+
+
+def ok_item(index, upload, mode='full'):
+    return {'index': index, 'file_name': upload.name, 'status': 'ok', 'verdict': 'safe'}
+
+
+def upstream_error(index, upload, mode='full'):
+    return {
+        'index': index, 'file_name': upload.name, 'status': 'error', 'status_code': 502,
+        'error': 'AI сервис недоступен',
+    }
+
+
+@override_settings(JOB_MAX_ATTEMPTS=3, JOB_VISIBILITY_TIMEOUT=300)
+class JobLeaseTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = jobs.JobStore(f'{directory.name}/jobs.sqlite3')
+        patcher = mock.patch.object(jobs, '_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        files = [SimpleUploadedFile('a.png', png_header(1, 1)), SimpleUploadedFile('b.png', png_header(1, 1))]
+        self.job_id = self.store.enqueue(jobs.KIND_BATCH, files)
+
+    def no_retry_delay(self):
+        return mock.patch.object(jobs, 'retry_delay', return_value=0)
+
+    def test_leased_job_is_not_claimed_twice(self):
+        job = self.store.claim()
+        self.assertEqual((job['id'], job['status'], job['attempts']), (self.job_id, jobs.STATUS_RUNNING, 1))
+        self.assertIsNone(self.store.claim())
+        self.assertTrue(self.store.extend_lease(self.job_id, 1))
+
+    def test_expired_lease_is_reclaimed_and_old_owner_loses_it(self):
+        with override_settings(JOB_VISIBILITY_TIMEOUT=0):
+            first = self.store.claim()
+        time.sleep(0.01)
+        second = self.store.claim()
+        self.assertEqual(second['attempts'], 2)
+        self.assertFalse(self.store.extend_lease(self.job_id, first['attempts']))
+        self.assertTrue(self.store.extend_lease(self.job_id, second['attempts']))
+
+    def test_worker_that_lost_the_lease_stops_writing(self):
+        with override_settings(JOB_VISIBILITY_TIMEOUT=0):
+            stale = self.store.claim()
+        time.sleep(0.01)
+        current = self.store.claim()
+        webhook = mock.patch.object(jobs, 'send_webhook').start()
+        self.addCleanup(mock.patch.stopall)
+        with mock.patch.object(jobs, 'moderate_batch_item', ok_item):
+            jobs.process_job(stale)
+        job = self.store.get(self.job_id)
+        self.assertEqual((job['status'], job['attempts'], job['results']), (jobs.STATUS_RUNNING, 2, [None, None]))
+        self.assertEqual(len(self.store.load_files(self.job_id, {0, 1})), 2)
+        webhook.assert_not_called()
+        with mock.patch.object(jobs, 'moderate_batch_item', ok_item):
+            jobs.process_job(current)
+        self.assertEqual(self.store.get(self.job_id)['status'], jobs.STATUS_DONE)
+
+    def test_heartbeat_keeps_lease_alive(self):
+        with override_settings(JOB_VISIBILITY_TIMEOUT=0.3):
+            job = self.store.claim()
+            with jobs.LeaseHeartbeat(self.store, job):
+                time.sleep(0.5)
+                self.assertIsNone(self.store.claim())
+
+    def test_failed_items_are_retried_and_finished_items_are_kept(self):
+        items = iter([ok_item, upstream_error, ok_item])
+        calls = []
+
+        def moderate(index, upload, mode):
+            calls.append(index)
+            return next(items)(index, upload)
+
+        with mock.patch.object(jobs, 'moderate_batch_item', moderate), self.no_retry_delay():
+            jobs.process_job(self.store.claim())
+            job = self.store.get(self.job_id)
+            self.assertEqual((job['status'], job['error']), (jobs.STATUS_QUEUED, 'AI сервис недоступен'))
+            jobs.process_job(self.store.claim())
+        job = self.store.get(self.job_id)
+        self.assertEqual(job['status'], jobs.STATUS_DONE)
+        self.assertEqual(job['attempts'], 2)
+        # Второй раз модерируется только файл, упавший из-за ошибки OpenAI
+        self.assertEqual(calls, [0, 1, 1])
+        self.assertEqual([item['status'] for item in job['results']], ['ok', 'ok'])
+
+    def test_mode_is_stored_with_the_job(self):
+        modes = []
+
+        def moderate(index, upload, mode):
+            modes.append(mode)
+            return ok_item(index, upload)
+
+        job_id = self.store.enqueue(jobs.KIND_IMAGE, [SimpleUploadedFile('c.png', png_header(1, 1))], mode='verdict')
+        self.store.finish(self.job_id, 0, jobs.STATUS_DONE)
+        with mock.patch.object(jobs, 'moderate_batch_item', moderate):
+            jobs.process_job(self.store.claim())
+        self.assertEqual(modes, ['verdict'])
+        self.assertEqual(jobs.job_payload(self.store.get(job_id))['mode'], 'verdict')
+
+    def test_job_fails_after_max_attempts(self):
+        with mock.patch.object(jobs, 'moderate_batch_item', upstream_error), self.no_retry_delay():
+            for _ in range(3):
+                jobs.process_job(self.store.claim())
+        job = self.store.get(self.job_id)
+        self.assertEqual((job['status'], job['attempts']), (jobs.STATUS_FAILED, 3))
+        self.assertIsNone(self.store.claim())
+
+
+class HeuristicPrefilterTests(SimpleTestCase):
+    def check(self, img):
+        img.thumbnail((128, 128))
+        return HeuristicPrefilter().check(img)
+
+    def test_flat_graphics_go_to_the_model(self):
+        # Символ из плоских цветов на однотонном фоне: палитра маленькая, но без модели не пропускается
+        img = Image.new('RGB', (512, 512), 'red')
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((96, 96, 416, 416), fill='white')
+        draw.rectangle((236, 128, 276, 384), fill='black')
+        draw.rectangle((128, 236, 384, 276), fill='black')
+        result = self.check(img)
+        self.assertEqual(result.verdict, VERDICT_ESCALATE)
+        self.assertGreaterEqual(result.features['graphic_ratio'], 0.9)
+
+    def test_shaded_object_on_plain_background_is_cleared(self):
+        yy, xx = np.mgrid[0:512, 0:512]
+        radius = np.hypot(xx - 256, yy - 256)
+        shade = np.clip(1 - radius / 160, 0, 1)[..., None]
+        pixels = np.where(radius[..., None] < 160, [60, 90, 160] + shade * [150, 120, 80], 245)
+        noise = np.random.default_rng(0).normal(0, 4, pixels.shape)
+        result = self.check(Image.fromarray((pixels + noise).clip(0, 255).astype(np.uint8)))
+        self.assertEqual(result.verdict, VERDICT_SAFE)
+
+
+class TieredCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = f'{directory.name}/cache.sqlite3'
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = TieredCache('v1', max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expired_entries_are_not_returned(self):
+        cache = TieredCache('v1', ttl=60, db_path=self.db_path)
+        cache.set('a', {'verdict': 'safe'})
+        with mock.patch('copilot.cache.time.time', return_value=time.time() + 120):
+            self.assertIsNone(cache.get('a'))
+
+    def test_disk_tier_is_shared_between_instances(self):
+        TieredCache('v1', db_path=self.db_path).set('a', {'verdict': 'safe'})
+        other = TieredCache('v1', db_path=self.db_path)
+        self.assertEqual(other.get('a'), {'verdict': 'safe'})
+        self.assertEqual(other.stats()['disk_hits'], 1)
+
+    def test_purge_removes_other_versions_only(self):
+        TieredCache('v1', db_path=self.db_path).set('old', 1)
+        current = TieredCache('v2', db_path=self.db_path)
+        current.set('new', 2)
+        self.assertEqual(current.purge(), 1)
+        self.assertEqual(current.get('new'), 2)
+        self.assertIsNone(current.get('old'))
+
+
+class VerdictCacheKeyTests(SimpleTestCase):
+    def test_key_depends_on_content_not_name(self):
+        first = SimpleUploadedFile('a.png', png_header(1, 1))
+        second = SimpleUploadedFile('b.png', png_header(1, 1))
+        self.assertEqual(services.image_cache_key(first), services.image_cache_key(second))
+        self.assertTrue(services.image_cache_key(first).startswith(services.MODERATION_PROMPT_VERSION))
+
+    def test_verdict_mode_reuses_full_verdict(self):
+        cache = TieredCache('v1')
+        digest = '0' * 64
+        cache.set(services.moderation_cache_key(digest), {'verdict': 'safe', 'tags': [], 'explanation': 'ок'})
+        self.assertNotEqual(services.moderation_cache_key(digest), services.moderation_cache_key(digest, 'verdict'))
+        self.assertEqual(
+            services._cached_verdict(cache, digest, services.MODE_VERDICT), {'verdict': 'safe', 'tags': []}
+        )
+        self.assertIsNone(services._cached_verdict(TieredCache('v1'), digest, services.MODE_FULL))
+
+
+def fake_completion(content, prompt_tokens=10, cached_tokens=0):
+    """Ответ chat.completions в том виде, в каком его читают сервисы"""
+    usage = SimpleNamespace(
+        prompt_tokens=prompt_tokens, completion_tokens=5, total_tokens=prompt_tokens + 5,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens),
+    )
+    message = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+class AnswerCacheTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(services, '_answer_cache', TieredCache('test'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = []
+
+        def completion(**kwargs):
+            self.calls.append(kwargs)
+            return fake_completion('Ответ')
+
+        async def async_completion(**kwargs):
+            return completion(**kwargs)
+
+        for name, fake in (('chat_completion', completion), ('async_chat_completion', async_completion)):
+            patcher = mock.patch(f'copilot.tokens.{name}', fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def ask(self, context, question, **headers):
+        return self.client.post(
+            reverse('copilot-ask'), {'context': context, 'question': question}, content_type='application/json',
+            **headers
+        )
+
+    def test_key_ignores_whitespace_and_case(self):
+        self.assertEqual(
+            services.answer_cache_key('Текст  про\nкошек', 'Кто? '),
+            services.answer_cache_key('текст про кошек', 'кто?'),
+        )
+        self.assertNotEqual(services.answer_cache_key('текст', 'кто?'), services.answer_cache_key('текст', 'где?'))
+
+    def test_repeated_question_is_answered_from_cache(self):
+        first = self.ask('Текст про кошек.', 'Про кого текст?')
+        second = self.ask('текст  про кошек.', 'про кого текст?')
+        self.assertEqual(len(self.calls), 1)
+        self.assertFalse(first.json()['cached'])
+        self.assertEqual((second.json()['answer'], second.json()['cached']), ('Ответ', True))
+
+    def test_no_cache_header_skips_lookup(self):
+        self.ask('Текст про кошек.', 'Про кого текст?')
+        response = self.ask('Текст про кошек.', 'Про кого текст?', HTTP_CACHE_CONTROL='no-cache')
+        self.assertEqual(len(self.calls), 2)
+        self.assertFalse(response.json()['cached'])
+
+
+def image_upload(size, image_format='PNG', name='image.png', color=(200, 30, 30)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format=image_format)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+@override_settings(MODERATION_IMAGE_MAX_DIMENSION=512, MODERATION_IMAGE_FORMAT='JPEG')
+class PrepareImageTests(SimpleTestCase):
+    def test_small_image_is_sent_unchanged(self):
+        upload = image_upload((100, 80))
+        prepared = prepare_image(upload)
+        self.assertTrue(prepared.passthrough)
+        self.assertEqual(prepared.data_url, 'data:image/png;base64,' + base64.b64encode(upload.read()).decode())
+        self.assertEqual(prepared.bytes_out, upload.size)
+
+    def test_large_image_is_resized_and_reencoded(self):
+        prepared = prepare_image(image_upload((2000, 1000)))
+        self.assertFalse(prepared.passthrough)
+        self.assertEqual((prepared.width, prepared.height), (512, 256))
+        self.assertTrue(prepared.data_url.startswith('data:image/jpeg;base64,'))
+
+    def test_unsupported_format_is_reencoded(self):
+        prepared = prepare_image(image_upload((100, 80), 'BMP', 'image.bmp'))
+        self.assertFalse(prepared.passthrough)
+        self.assertEqual((prepared.width, prepared.height), (100, 80))
+
+    @override_settings(MODERATION_IMAGE_PASSTHROUGH_MAX_BYTES=100)
+    def test_heavy_file_is_reencoded_even_if_small(self):
+        self.assertFalse(prepare_image(image_upload((100, 80))).passthrough)
+
+
+OPENAI_REQUEST = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+
+
+def openai_status_error(error_class, status_code, headers=None):
+    response = httpx.Response(status_code, headers=headers, request=OPENAI_REQUEST)
+    return error_class('upstream error', response=response, body=None)
+
+
+class RawResponse:
+    """Ответ with_raw_response: заголовки и parse()"""
+
+    def __init__(self, parsed, headers=None):
+        self.parsed = parsed
+        self.headers = headers or {}
+
+    def parse(self):
+        return self.parsed
+
+
+@override_settings(OPENAI_MAX_RETRIES=2, OPENAI_RATE_LIMIT_ENABLED=False)
+class OpenAIRetryTests(SimpleTestCase):
+    def setUp(self):
+        self.guard = UpstreamGuard(MemoryStateStore())
+        for patcher in (
+            mock.patch.object(client, 'get_upstream_guard', return_value=self.guard),
+            mock.patch.object(client.time, 'sleep'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def call(self, *outcomes):
+        outcomes = list(outcomes)
+        calls = []
+
+        def func(**kwargs):
+            calls.append(kwargs)
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        return client.call_openai(func, model='gpt-test'), calls
+
+    def test_retryable_errors_are_retried(self):
+        result, calls = self.call(
+            openai.APITimeoutError(request=OPENAI_REQUEST),
+            openai_status_error(openai.InternalServerError, 500),
+            RawResponse('ok', {'x-request-id': '1'}),
+        )
+        self.assertEqual((result, len(calls)), ('ok', 3))
+
+    def test_client_errors_are_not_retried(self):
+        with self.assertRaises(OpenAIAPIException) as raised:
+            self.call(openai_status_error(openai.BadRequestError, 400), RawResponse('ok'))
+        self.assertEqual(raised.exception.status_code, 500)
+
+    def test_last_error_is_raised_after_all_attempts(self):
+        with self.assertRaises(OpenAIAPIException) as raised:
+            self.call(*[openai.APITimeoutError(request=OPENAI_REQUEST)] * 3)
+        self.assertEqual(raised.exception.status_code, 504)
+
+    def test_exception_mapping(self):
+        cases = [
+            (openai.APITimeoutError(request=OPENAI_REQUEST), 504),
+            (openai.APIConnectionError(request=OPENAI_REQUEST), 502),
+            (openai_status_error(openai.InternalServerError, 503), 502),
+            (openai_status_error(openai.AuthenticationError, 401), 500),
+        ]
+        for exc, status_code in cases:
+            self.assertEqual(client.to_api_exception(exc).status_code, status_code)
+        limited = client.to_api_exception(openai_status_error(openai.RateLimitError, 429, {'retry-after': '7'}))
+        self.assertIsInstance(limited, UpstreamUnavailableException)
+        self.assertEqual((limited.status_code, limited.retry_after), (503, 7.0))
+
+    def test_retry_after_header_wins_over_backoff(self):
+        self.assertEqual(client.retry_delay(0, retry_after=1.5), 1.5)
+        with override_settings(OPENAI_RETRY_MAX_DELAY=2):
+            self.assertEqual(client.retry_delay(0, retry_after=60), 2)
+            self.assertLessEqual(client.retry_delay(10), 2)
+
+    def test_unwrap_reads_headers_of_raw_responses_only(self):
+        self.assertEqual(client._unwrap(RawResponse('ok', {'a': '1'})), ({'a': '1'}, 'ok'))
+        self.assertEqual(client._unwrap('plain'), (None, 'plain'))
+
+
+class AsyncViewTests(SimpleTestCase):
+    factory = AsyncRequestFactory()
+
+    def setUp(self):
+        patcher = mock.patch.object(services, '_answer_cache', TieredCache('test'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_ask_answers_through_async_client(self):
+        async def completion(**kwargs):
+            return fake_completion('Ответ')
+
+        request = self.factory.post(
+            '/copilot/ask/', {'context': 'Текст про кошек.', 'question': 'Про кого?'}, content_type='application/json'
+        )
+        with mock.patch('copilot.tokens.async_chat_completion', completion):
+            response = await async_views.ask(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['answer'], 'Ответ')
+
+    async def test_errors_use_drf_format(self):
+        response = await async_views.ask(self.factory.get('/copilot/ask/'))
+        self.assertEqual(response.status_code, 405)
+        request = self.factory.post('/copilot/ask/', b'{', content_type='application/json')
+        self.assertEqual((await async_views.ask(request)).status_code, 400)
+        request = self.factory.post('/copilot/ask/', {'question': 'Про кого?'}, content_type='application/json')
+        response = await async_views.ask(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('context', json.loads(response.content))
+
+    async def test_moderate_image_runs_async_analysis(self):
+        async def analyze(image_file, mode):
+            return {'verdict': 'safe', 'tags': [], 'mode': mode}
+
+        request = self.factory.post(
+            '/copilot/moderate-image/', {'file': image_upload((10, 10)), 'mode': 'verdict'}
+        )
+        with mock.patch.object(async_views, 'analyze_image_with_ai_async', analyze):
+            response = await async_views.moderate_image(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {'verdict': 'safe', 'tags': [], 'mode': 'verdict'})
+
+    def test_async_client_is_kept_per_event_loop(self):
+        async def get_twice():
+            return client.get_async_openai_client(), client.get_async_openai_client()
+
+        first, same = asyncio.run(get_twice())
+        second, _ = asyncio.run(get_twice())
+        self.assertIs(first, same)
+        self.assertIsNot(first, second)
+
+
+def stream_chunk(text=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=text))] if text else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class FakeStream(list):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeAsyncStream:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.chunks:
+            raise StopAsyncIteration
+        return self.chunks.pop(0)
+
+    async def close(self):
+        pass
+
+
+def sse_events(response, body=None):
+    """[(событие, данные)] из тела text/event-stream"""
+    events = []
+    body = b''.join(response.streaming_content) if body is None else body
+    for block in body.decode().split('\n\n'):
+        if block:
+            name, data = block.split('\n', 1)
+            events.append((name[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+class AskStreamTests(SimpleTestCase):
+    """Потоковый ответ синхронного AskView (в async-режиме urls подключают другое представление)"""
+
+    def setUp(self):
+        patcher = mock.patch.object(services, '_answer_cache', TieredCache('test'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ask_stream(self, question='Про кого?'):
+        request = RequestFactory().post(
+            '/copilot/ask/?stream=true', {'context': 'Текст про кошек.', 'question': question},
+            content_type='application/json',
+        )
+        return views.AskView.as_view()(request)
+
+    def test_tokens_then_done_and_answer_is_cached(self):
+        usage = fake_completion('', prompt_tokens=12).usage
+        stream = FakeStream([stream_chunk('Про '), stream_chunk('кошек'), stream_chunk(usage=usage)])
+        with mock.patch.object(services, 'chat_completion', return_value=stream) as completion:
+            response = self.ask_stream()
+            events = sse_events(response)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(completion.call_args.kwargs['stream'])
+        self.assertEqual([name for name, _ in events], ['token', 'token', 'done'])
+        self.assertEqual(events[-1][1]['usage']['prompt_tokens'], 12)
+        self.assertTrue(stream.closed)
+        cached = sse_events(self.ask_stream())
+        self.assertEqual(cached[0], ('token', {'content': 'Про кошек'}))
+        self.assertTrue(cached[-1][1]['cached'])
+
+    def test_upstream_error_is_sent_as_event(self):
+        error = OpenAIAPIException('AI сервис недоступен', status_code=502)
+        with mock.patch.object(services, 'chat_completion', side_effect=error):
+            events = sse_events(self.ask_stream())
+        self.assertEqual(events, [('error', {'message': 'AI сервис недоступен', 'status_code': 502})])
+
+    def test_async_view_streams_the_same_events(self):
+        async def completion(**kwargs):
+            return FakeAsyncStream([stream_chunk('Про '), stream_chunk('кошек')])
+
+        async def run():
+            request = AsyncRequestFactory().post(
+                '/copilot/ask/?stream=true', {'context': 'Текст про кошек.', 'question': 'Про кого?'},
+                content_type='application/json',
+            )
+            response = await async_views.ask(request)
+            return response, b''.join([chunk async for chunk in response.streaming_content])
+
+        with mock.patch.object(services, 'async_chat_completion', completion):
+            response, body = asyncio.run(run())
+        events = sse_events(response, body)
+        self.assertEqual([name for name, _ in events], ['token', 'token', 'done'])
+        self.assertFalse(events[-1][1]['cached'])
+
+
+class BatchModerationTests(SimpleTestCase):
+    def files(self):
+        return [
+            image_upload((10, 10), name='a.png'),
+            SimpleUploadedFile('bad.png', b'<?php echo 1; ?>' * 4),
+            image_upload((10, 10), name='c.png'),
+        ]
+
+    def analyze(self, image_file, mode):
+        if image_file.name == 'c.png':
+            raise OpenAIAPIException('AI сервис недоступен', status_code=502)
+        return {'verdict': 'safe', 'tags': [], 'mode': mode}
+
+    def check(self, result):
+        self.assertEqual((result['total'], result['succeeded'], result['failed']), (3, 1, 2))
+        self.assertEqual([item['index'] for item in result['results']], [0, 1, 2])
+        first, bad, failed = result['results']
+        self.assertEqual((first['status'], first['mode']), ('ok', 'verdict'))
+        self.assertEqual((bad['status'], bad['file_name']), ('error', 'bad.png'))
+        self.assertEqual((failed['status'], failed['status_code']), ('error', 502))
+
+    def test_results_keep_upload_order_and_errors_stay_per_file(self):
+        with mock.patch.object(services, 'analyze_image_with_ai', self.analyze):
+            self.check(services.moderate_image_batch(self.files(), 'verdict'))
+
+    def test_async_batch(self):
+        async def analyze(image_file, mode):
+            return self.analyze(image_file, mode)
+
+        with mock.patch.object(services, 'analyze_image_with_ai_async', analyze):
+            self.check(asyncio.run(services.moderate_image_batch_async(self.files(), 'verdict')))
+
+    @override_settings(MODERATION_BATCH_MAX_FILES=2)
+    def test_too_many_files_are_rejected(self):
+        response = self.client.post(reverse('moderate-images'), {'files': self.files()})
+        self.assertEqual(response.status_code, 413)
+
+
+def write_video(path, seconds, fps=10, size=(64, 48)):
+    """MP4, в котором каждую секунду меняется цвет кадра"""
+    import cv2
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    for index in range(seconds * fps):
+        second = index // fps
+        frame = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        frame[:, : size[0] // 2] = (second * 40) % 256
+        frame[:, size[0] // 2:] = 255 - (second * 40) % 256
+        writer.write(frame)
+    writer.release()
+
+
+def sheet_verdict(verdict='safe', flagged_frames=()):
+    result = {'verdict': verdict, 'tags': [], 'explanation': '', 'flagged_frames': list(flagged_frames)}
+    return result, 100, None
+
+
+@override_settings(
+    VIDEO_SAMPLE_FPS=2, VIDEO_MAX_DURATION=600, VIDEO_SCENE_THRESHOLD=0.3, VIDEO_KEYFRAME_INTERVAL=100,
+    VIDEO_DEDUP_DISTANCE=6, VIDEO_MAX_FRAMES=16,
+)
+class VideoSamplingTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f'{directory.name}/clip.mp4'
+
+    def test_frames_are_sampled_at_configured_rate(self):
+        write_video(self.path, 3)
+        frames = video.VideoFrames(self.path)
+        timestamps = [round(timestamp, 2) for timestamp, _ in frames]
+        self.assertEqual(timestamps, [0.0, 0.5, 1.0, 1.5, 2.0, 2.5])
+        self.assertFalse(frames.truncated)
+
+    @override_settings(VIDEO_MAX_DURATION=2)
+    def test_too_long_video_is_rejected(self):
+        write_video(self.path, 5)
+        with self.assertRaises(FileValidationException) as raised:
+            list(video.VideoFrames(self.path))
+        self.assertEqual(raised.exception.status_code, 413)
+
+    def test_repeated_scenes_are_deduplicated(self):
+        selector = video.KeyframeSelector()
+        red, blue = Image.new('RGB', (32, 32), (220, 0, 0)), Image.new('RGB', (32, 32), (0, 0, 40))
+        for timestamp, image in enumerate([red, red, blue, blue, red, blue]):
+            selector.offer(timestamp, image)
+        self.assertEqual([frame.timestamp for frame in selector.keyframes()], [0, 2])
+        self.assertEqual((selector.sampled, selector.duplicates), (6, 2))
+
+    @override_settings(VIDEO_MAX_FRAMES=3)
+    def test_smallest_scene_change_is_evicted_when_full(self):
+        selector = video.KeyframeSelector()
+        half = Image.new('RGB', (32, 32), 'white')
+        half.paste((0, 0, 0), (0, 0, 16, 32))
+        for timestamp, image in enumerate([
+            Image.new('RGB', (32, 32), 'black'), Image.new('RGB', (32, 32), 'white'), half,
+            Image.new('RGB', (32, 32), (120, 0, 0)),
+        ]):
+            selector.offer(timestamp, image)
+        self.assertEqual([frame.timestamp for frame in selector.keyframes()], [0, 1, 3])
+
+    def test_partly_checked_video_is_never_safe(self):
+        frames = mock.MagicMock()
+        frames.__iter__.return_value = iter([(0.0, Image.new('RGB', (32, 32), 'white'))])
+        frames.truncated = True
+        with mock.patch.object(video, '_moderate_sheet', return_value=sheet_verdict('safe')):
+            result, _ = video.moderate_frames(frames)
+        self.assertEqual((result['verdict'], result['truncated']), ('potentially_unsafe', True))
+
+    def test_strictest_sheet_verdict_wins_and_flagged_frames_get_timestamps(self):
+        frames = [(float(second), Image.new('RGB', (32, 32), (second * 80, 0, 0))) for second in range(3)]
+        verdicts = [sheet_verdict('safe'), sheet_verdict('unsafe', [2])]
+        with override_settings(VIDEO_SHEET_COLUMNS=1, VIDEO_SHEET_ROWS=2), \
+                mock.patch.object(video, '_moderate_sheet', side_effect=verdicts):
+            result, stats = video.moderate_frames(frames)
+        self.assertEqual(result['verdict'], 'unsafe')
+        self.assertEqual(result['flagged_timestamps'], [{'frame': 2, 'timestamp': 1.0}])
+        self.assertEqual(stats['sheets'], 2)
+
+
+DOCUMENT = ' '.join([
+    'Кошки спят большую часть дня и охотятся ночью.',
+    'Собаки любят долгие прогулки и игры с мячом.',
+    'Попугаи умеют повторять слова и живут долго.',
+    'Рыбки живут в аквариуме и не требуют прогулок.',
+] * 3)
+
+
+@override_settings(RETRIEVAL_CHUNK_SIZE=60, RETRIEVAL_CHUNK_OVERLAP=0)
+class RetrievalTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(retrieval, '_index_cache', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_chunks_cover_text_and_end_on_whitespace(self):
+        spans = retrieval.split_chunks(DOCUMENT, 60, 0)
+        self.assertEqual((spans[0][0], spans[-1][1]), (0, len(DOCUMENT)))
+        for start, end in spans[:-1]:
+            self.assertLessEqual(end - start, 60)
+            self.assertTrue(DOCUMENT[end].isspace())
+
+    def test_relevant_chunk_ranks_first(self):
+        index = retrieval.get_index(DOCUMENT)
+        doc, score = index.search('Что любят собаки?', 1)[0]
+        start, end = index.spans[doc]
+        self.assertIn('Собаки', DOCUMENT[start:end])
+        self.assertGreater(score, 0)
+        self.assertEqual(index.search('телескоп', 2)[0][1], 0.0)
+
+    def test_index_is_reused_for_the_same_text(self):
+        self.assertIs(retrieval.get_index(DOCUMENT), retrieval.get_index(DOCUMENT))
+
+    def test_reduce_context_keeps_document_order(self):
+        text, chunks = retrieval.reduce_context(DOCUMENT, 'попугаи и рыбки', 3)
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual([chunk['index'] for chunk in chunks], sorted(chunk['index'] for chunk in chunks))
+        self.assertTrue(text.startswith(f"[Фрагмент {chunks[0]['index'] + 1}]"))
+
+    def test_fit_context_stays_within_budget(self):
+        budget = 80
+        text, chunks = retrieval.fit_context(DOCUMENT, 'Что любят собаки?', budget)
+        self.assertTrue(chunks)
+        self.assertLessEqual(sum(estimate_text_tokens(DOCUMENT[c['start']:c['end']]) + 10 for c in chunks), budget)
+        self.assertIn('Собаки', text)
+
+    def test_fit_context_trims_the_best_chunk_when_nothing_fits(self):
+        text, chunks = retrieval.fit_context(DOCUMENT, 'Что любят собаки?', 15)
+        self.assertEqual(len(chunks), 1)
+        chunk = chunks[0]
+        self.assertLessEqual(estimate_text_tokens(DOCUMENT[chunk['start']:chunk['end']]), 5)
+
+
+class TokenEstimateTests(SimpleTestCase):
+    def test_text_estimate_without_tiktoken(self):
+        with mock.patch('copilot.tokens._encoding', return_value=None):
+            self.assertEqual(estimate_text_tokens('abcdefgh'), 2)
+            self.assertEqual(estimate_text_tokens('кошка'), 3)
+            self.assertEqual(estimate_text_tokens('cat кот'), 3)
+
+    def test_image_estimate_follows_vision_tiling(self):
+        self.assertEqual(estimate_image_tokens(1024, 1024), 85 + 170 * 4)
+        self.assertEqual(estimate_image_tokens(2048, 4096), 85 + 170 * 6)
+        self.assertEqual(estimate_image_tokens(100, 100), 85 + 170)
+
+    def test_request_estimate_counts_messages_and_images(self):
+        request_kwargs = {'model': 'gpt-4o', 'messages': [
+            {'role': 'system', 'content': 'abcd'},
+            {'role': 'user', 'content': [{'type': 'text', 'text': 'abcd'}, {'type': 'image_url', 'image_url': {}}]},
+        ]}
+        with mock.patch('copilot.tokens._encoding', return_value=None):
+            self.assertEqual(estimate_request_tokens(request_kwargs, image_sizes=[(100, 100)]), 3 + 2 * 5 + 255)
+
+    def test_usage_headers(self):
+        usage = {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15, 'cached_tokens': 4}
+        headers = usage_headers(usage, estimated=12)
+        self.assertEqual(headers['X-Copilot-Estimated-Prompt-Tokens'], '12')
+        self.assertEqual(headers['X-Copilot-Cached-Tokens'], '4')
+        self.assertEqual(usage_headers(None), {})
+
+
+@override_settings(ASK_INPUT_TOKEN_BUDGET=200, ASK_TOKEN_OVERFLOW='reject', RETRIEVAL_ENABLED=False)
+class TokenBudgetTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(services, '_answer_cache', TieredCache('test'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def plan(self, **data):
+        request = RequestFactory().post('/copilot/ask/')
+        return services.plan_ask(request, {'context': DOCUMENT * 3, 'question': 'Что любят собаки?', **data})
+
+    def test_over_budget_request_is_rejected_before_upstream(self):
+        with self.assertRaises(TokenBudgetException) as raised:
+            self.plan()
+        self.assertEqual(raised.exception.budget, 200)
+        self.assertGreater(raised.exception.estimated_tokens, 200)
+
+    def test_truncate_keeps_request_within_budget(self):
+        plan = self.plan(overflow='truncate')
+        self.assertTrue(plan.truncated)
+        self.assertLessEqual(plan.estimated_tokens, 200)
+        self.assertTrue(plan.chunks)
+
+
+class MetricsTests(SimpleTestCase):
+    def sample(self, name, labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_latency_is_labelled_by_url_name(self):
+        labels = {'view': 'health-check', 'method': 'GET', 'status': '200'}
+        before = self.sample('copilot_request_duration_seconds_count', labels)
+        self.assertEqual(self.client.get(reverse('health-check')).status_code, 200)
+        self.assertEqual(self.sample('copilot_request_duration_seconds_count', labels), before + 1)
+        self.assertEqual(self.sample('copilot_requests_in_flight', {'view': 'health-check'}), 0)
+
+    def test_metrics_endpoint_exposes_prometheus_text(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'copilot_request_duration_seconds', response.content)
+
+    def test_error_status_labels(self):
+        self.assertEqual(error_status(openai.APITimeoutError(request=OPENAI_REQUEST)), 'timeout')
+        self.assertEqual(error_status(openai.APIConnectionError(request=OPENAI_REQUEST)), 'connection')
+        self.assertEqual(error_status(openai_status_error(openai.RateLimitError, 429)), '429')
+
+
+class BenchmarkTests(SimpleTestCase):
+    def start_fake_openai(self, **options):
+        server = benchmark.FakeOpenAIServer(('127.0.0.1', 0), benchmark.FakeOpenAIConfig(latency_ms=0, **options))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        sdk = openai.OpenAI(api_key='x', base_url=f'http://127.0.0.1:{server.server_address[1]}/v1', max_retries=0)
+        self.addCleanup(sdk.close)
+        return server, sdk
+
+    def test_percentiles_and_summary(self):
+        values = [0.1, 0.2, 0.3, 0.4]
+        self.assertEqual((benchmark.percentile(values, 50), benchmark.percentile(values, 99)), (0.2, 0.4))
+        self.assertIsNone(benchmark.percentile([], 50))
+        summary = benchmark.summarize([(0.1, 0.05, 200), (0.3, None, 200), (1.0, None, 503)], window=2)
+        self.assertEqual((summary['requests'], summary['errors'], summary['throughput_rps']), (3, 1, 1.5))
+        self.assertEqual(summary['status_codes'], {'200': 2, '503': 1})
+        self.assertEqual(summary['latency_ms']['p95'], 300.0)
+
+    def test_fake_server_speaks_the_openai_protocol(self):
+        server, sdk = self.start_fake_openai(completion_tokens=5, token_delay_ms=0)
+        messages = [{'role': 'user', 'content': 'Вопрос'}]
+        response = sdk.chat.completions.create(model='fake', messages=messages)
+        self.assertEqual(len(response.choices[0].message.content.split()), 5)
+        self.assertEqual(response.usage.completion_tokens, 5)
+        stream = sdk.chat.completions.create(
+            model='fake', messages=messages, stream=True, stream_options={'include_usage': True}
+        )
+        chunks = list(stream)
+        self.assertEqual(''.join(c.choices[0].delta.content or '' for c in chunks if c.choices).count(' '), 4)
+        self.assertEqual(chunks[-1].usage.completion_tokens, 5)
+        self.assertEqual(server.snapshot(), {'requests': 2, 'completed': 1, 'streamed': 1})
+
+    def test_fake_server_rate_limit(self):
+        server, sdk = self.start_fake_openai(rate_limit_rpm=1)
+        messages = [{'role': 'user', 'content': 'Вопрос'}]
+        sdk.chat.completions.create(model='fake', messages=messages)
+        with self.assertRaises(openai.RateLimitError) as raised:
+            sdk.chat.completions.create(model='fake', messages=messages)
+        self.assertEqual(raised.exception.response.headers['retry-after'], '60')
+        self.assertEqual(server.snapshot()['rate_limited'], 1)
+
+
+@override_settings(
+    OPENAI_RATE_LIMIT_ENABLED=True, OPENAI_RPM_LIMIT=60, OPENAI_TPM_LIMIT=0, OPENAI_QUEUE_TIMEOUT=5,
+    OPENAI_BREAKER_THRESHOLD=2, OPENAI_BREAKER_COOLDOWN=30, OPENAI_READ_TIMEOUT=10,
+)
+class UpstreamGuardTests(SimpleTestCase):
+    def setUp(self):
+        self.guard = UpstreamGuard(MemoryStateStore())
+        self.now = 1000.0
+        patcher = mock.patch('copilot.ratelimit.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bucket_queues_then_rejects(self):
+        with override_settings(OPENAI_RPM_LIMIT=2):
+            self.assertEqual(self.guard.acquire('gpt', 1), 0)
+            self.assertEqual(self.guard.acquire('gpt', 1), 0)
+            # Пополнение 2 запроса в минуту: следующий ждет 30 с, дольше OPENAI_QUEUE_TIMEOUT
+            with self.assertRaises(UpstreamUnavailableException) as raised:
+                self.guard.acquire('gpt', 1)
+        self.assertAlmostEqual(raised.exception.retry_after, 30)
+
+    def test_wait_within_queue_timeout_is_returned(self):
+        for _ in range(60):
+            self.guard.acquire('gpt', 1)
+        self.assertAlmostEqual(self.guard.acquire('gpt', 1), 1.0)
+
+    def test_limits_are_learned_from_headers(self):
+        self.guard.record_success('gpt', {'x-ratelimit-limit-requests': '600', 'x-ratelimit-remaining-requests': '0'})
+        self.assertAlmostEqual(self.guard.acquire('gpt', 1), 0.1)
+        self.assertEqual(self.guard.snapshot()['models']['gpt']['requests']['limit'], 600)
+
+    def test_rate_limit_response_blocks_the_model(self):
+        self.guard.record_failure('gpt', '429', retry_after=3)
+        self.assertAlmostEqual(self.guard.acquire('gpt', 1), 3)
+        self.assertEqual(self.guard.acquire('other', 1), 0)
+
+    def test_breaker_opens_and_lets_one_probe_through(self):
+        self.guard.record_failure('gpt', '502')
+        self.guard.acquire('gpt', 1)
+        self.guard.record_failure('gpt', 'timeout')
+        with self.assertRaises(UpstreamUnavailableException):
+            self.guard.acquire('gpt', 1)
+        self.assertEqual(self.guard.snapshot()['circuit'], 'open')
+
+        self.now += 31
+        self.assertEqual(self.guard.snapshot()['circuit'], 'half_open')
+        self.assertEqual(self.guard.acquire('gpt', 1), 0)
+        with self.assertRaises(UpstreamUnavailableException):
+            self.guard.acquire('gpt', 1)
+        self.guard.record_success('gpt')
+        self.assertEqual(self.guard.snapshot()['circuit'], 'closed')
+        self.assertEqual(self.guard.acquire('gpt', 1), 0)
+
+    def test_failed_probe_opens_the_breaker_again(self):
+        for _ in range(2):
+            self.guard.record_failure('gpt', '500')
+        self.now += 31
+        self.guard.acquire('gpt', 1)
+        self.guard.record_failure('gpt', '500')
+        self.assertEqual(self.guard.snapshot()['circuit'], 'open')
+
+    def test_client_errors_do_not_open_the_breaker(self):
+        for _ in range(5):
+            self.guard.record_failure('gpt', '400')
+        self.assertEqual(self.guard.snapshot()['circuit'], 'closed')
+
+    def test_open_breaker_fails_fast_without_calling_openai(self):
+        for _ in range(2):
+            self.guard.record_failure('gpt', '503')
+        func = mock.Mock()
+        with mock.patch.object(client, 'get_upstream_guard', return_value=self.guard):
+            with self.assertRaises(UpstreamUnavailableException) as raised:
+                client.call_openai(func, model='gpt')
+        func.assert_not_called()
+        self.assertEqual(raised.exception.status_code, 503)
+
+
+@override_settings(
+    ASK_ROUTING_ENABLED=True, ASK_FALLBACK_ENABLED=True, ASK_ROUTE_MIN_SAMPLES=3,
+    ASK_ROUTE_FAST_MODELS='small,large', ASK_ROUTE_FAST_SLO_MS=1000,
+    ASK_ROUTE_SHORT_CONTEXT_CHARS=100, ASK_ROUTE_SHORT_QUESTION_CHARS=50,
+)
+class RoutingTests(SimpleTestCase):
+    def setUp(self):
+        self.stats = routing.RoutingStats()
+        for module in (routing, services):
+            patcher = mock.patch.object(module, 'routing_stats', self.stats)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def record(self, model, seconds, count=3):
+        for _ in range(count):
+            self.stats.record_latency(model, seconds)
+
+    def test_classify(self):
+        self.assertEqual(routing.classify('Короткий текст', 'Когда акция?'), routing.ROUTE_FAST)
+        self.assertEqual(routing.classify('Короткий текст', 'Почему акция закончилась?'), routing.ROUTE_BEST)
+        self.assertEqual(routing.classify('x' * 500, 'Когда акция?'), routing.ROUTE_BALANCED)
+        self.assertEqual(routing.classify('x' * 500, 'Почему?', quality='fast'), routing.ROUTE_FAST)
+        with override_settings(ASK_ROUTING_ENABLED=False):
+            self.assertEqual(routing.classify('Короткий текст', 'Когда акция?'), routing.ROUTE_BEST)
+
+    def test_first_model_within_slo_is_picked(self):
+        self.assertEqual(routing.pick_model(routing.ROUTE_FAST), ('small', 'large'))
+        self.record('small', 2.0)
+        self.assertEqual(routing.pick_model(routing.ROUTE_FAST), ('large', 'small'))
+        self.record('large', 3.0)
+        # Обе не укладываются в SLO — самая быстрая
+        self.assertEqual(routing.pick_model(routing.ROUTE_FAST), ('small', 'large'))
+        with override_settings(ASK_FALLBACK_ENABLED=False):
+            self.assertEqual(routing.pick_model(routing.ROUTE_FAST), ('small', None))
+
+    def test_old_samples_expire(self):
+        self.record('small', 2.0)
+        with override_settings(ASK_ROUTE_LATENCY_TTL=0):
+            time.sleep(0.01)
+            self.assertEqual(routing.pick_model(routing.ROUTE_FAST)[0], 'small')
+
+    def plan(self):
+        route = routing.RouteChoice(routing.ROUTE_FAST, 'small', 'large')
+        return services.AskPlan('key', route, request_kwargs={'messages': []}, estimated_tokens=10)
+
+    def completion(self, primary_error):
+        calls = []
+
+        def completion(**kwargs):
+            calls.append(kwargs['model'])
+            if kwargs['model'] == 'small':
+                raise primary_error
+            return fake_completion('Ответ запасной модели')
+
+        return completion, calls
+
+    def test_timeout_falls_back_and_both_latencies_are_recorded(self):
+        completion, calls = self.completion(OpenAIAPIException('timeout', status_code=504))
+        with mock.patch('copilot.tokens.chat_completion', completion), mock.patch.object(services, 'store_answer'):
+            payload, _ = self.plan().complete()
+        self.assertEqual(calls, ['small', 'large'])
+        self.assertEqual((payload['answer'], payload['model']), ('Ответ запасной модели', 'large'))
+        self.assertEqual(len(self.stats._recent('small')), 1)
+        self.assertEqual(len(self.stats._recent('large')), 1)
+        self.assertEqual(self.stats.snapshot()['fallbacks'], {'small->large': 1})
+
+    def test_breaker_rejection_does_not_fall_back(self):
+        completion, calls = self.completion(UpstreamUnavailableException('AI сервис временно недоступен'))
+        with mock.patch('copilot.tokens.chat_completion', completion):
+            with self.assertRaises(UpstreamUnavailableException):
+                self.plan().complete()
+        self.assertEqual(calls, ['small'])
+
+    def test_stream_falls_back_and_records_latency(self):
+        calls = []
+
+        def completion(**kwargs):
+            calls.append(kwargs['model'])
+            if kwargs['model'] == 'small':
+                raise OpenAIAPIException('AI сервис недоступен', status_code=502)
+            return FakeStream([stream_chunk('Ответ')])
+
+        with mock.patch.object(services, 'chat_completion', completion), mock.patch.object(services, 'store_answer'):
+            events = sse_events(SimpleNamespace(streaming_content=self.plan().stream()))
+        self.assertEqual(calls, ['small', 'large'])
+        self.assertEqual(events[-1][1]['model'], 'large')
+        self.assertEqual(len(self.stats._recent('large')), 1)
+
+
+def moderation_response(content, refusal=None, finish_reason='stop'):
+    message = SimpleNamespace(content=content, refusal=refusal)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason=finish_reason)], usage=None)
+
+
+class ModerationParsingTests(SimpleTestCase):
+    @override_settings(MODERATION_STRUCTURED_OUTPUT=True)
+    def test_schema_answer(self):
+        content = json.dumps({'verdict': 'unsafe', 'tags': ['weapons', 'violence', 'unknown'], 'explanation': 'Драка'})
+        result = services.parse_moderation_response(moderation_response(content))
+        self.assertEqual(result, {'verdict': 'unsafe', 'tags': ['violence', 'weapons'], 'explanation': 'Драка'})
+        verdict = services.parse_moderation_response(moderation_response(content), services.MODE_VERDICT)
+        self.assertEqual(verdict, {'verdict': 'unsafe', 'tags': ['violence', 'weapons']})
+
+    @override_settings(MODERATION_STRUCTURED_OUTPUT=False)
+    def test_free_form_answer_in_code_block(self):
+        content = 'Вот ответ:\n```json\n{"verdict": "safe", "tags": [], "explanation": ""}\n```'
+        self.assertEqual(services.parse_moderation_response(moderation_response(content))['verdict'], 'safe')
+
+    @override_settings(MODERATION_STRUCTURED_OUTPUT=True)
+    def test_unparsed_answers_become_errors(self):
+        cases = [
+            (moderation_response('{"verdict": "sa', finish_reason='length'), 'truncated'),
+            (moderation_response('не JSON'), 'invalid_json'),
+            (moderation_response('{"verdict": "maybe", "tags": []}'), 'schema_mismatch'),
+            (moderation_response(None, refusal='Не могу помочь'), 'refusal'),
+        ]
+        for response, outcome in cases:
+            result = services.parse_moderation_response(response)
+            self.assertEqual((result['verdict'], result['parse_error']), ('error', outcome))
+        self.assertEqual(result['explanation'], 'Не могу помочь')
+
+    def test_schema_is_strict_and_mode_specific(self):
+        with override_settings(MODERATION_STRUCTURED_OUTPUT=True):
+            prepared = SimpleNamespace(data_url='data:image/png;base64,')
+            request_kwargs = services.build_moderation_request(prepared, services.MODE_VERDICT)
+        schema = request_kwargs['response_format']['json_schema']
+        self.assertTrue(schema['strict'])
+        self.assertEqual(schema['schema']['required'], ['verdict', 'tags'])
+        self.assertEqual(request_kwargs['max_tokens'], services.MODERATION_MAX_TOKENS[services.MODE_VERDICT])
+        full = services.MODERATION_SCHEMAS[services.MODE_FULL]['json_schema']['schema']
+        self.assertEqual(full['required'], ['verdict', 'tags', 'explanation'])
+
+
+class ModerationHistoryTests(TestCase):
+    def setUp(self):
+        history.tag_cache.clear()
+        self.addCleanup(history.tag_cache.clear)
+
+    def record(self, verdict='unsafe', tags=('weapons',)):
+        result = {'verdict': verdict, 'tags': list(tags), 'explanation': 'Оружие'}
+        return history.HistoryRecord('image', 'a' * 64, result, 'content/a.png')
+
+    def test_batch_is_written_with_tags(self):
+        history.write_history([self.record(), self.record('maybe', ()), self.record(tags=('weapons', 'blood'))])
+        self.assertEqual(Content.objects.count(), 3)
+        self.assertEqual(
+            sorted(ModerationResult.objects.values_list('verdict', flat=True)), ['error', 'unsafe', 'unsafe']
+        )
+        last = ModerationResult.objects.order_by('id').last()
+        self.assertEqual(sorted(last.detected_tags.values_list('name', flat=True)), ['blood', 'weapons'])
+
+    def test_known_tags_cost_no_queries(self):
+        first = history.tag_cache.ids(['weapons', 'blood'])
+        self.assertEqual(set(first), {'weapons', 'blood'})
+        with self.assertNumQueries(0):
+            self.assertEqual(history.tag_cache.ids(['weapons']), {'weapons': first['weapons']})
+        self.assertEqual(Tag.objects.count(), 2)
+
+    @override_settings(MODERATION_HISTORY_QUEUE_SIZE=2)
+    def test_writer_flushes_queue_and_drops_overflow(self):
+        writer = history.HistoryWriter()
+        # Очередь без фонового потока: пишет flush в тестовой транзакции
+        writer._pid = os.getpid()
+        writer._queue = queue.Queue(maxsize=2)
+        for _ in range(3):
+            writer.submit(self.record())
+        with mock.patch.object(history, 'close_old_connections'):
+            writer.flush()
+        self.assertEqual(ModerationResult.objects.count(), 2)
+
+
+# Загружает URLconf со всеми view и печатает, какие из модулей импортированы
+IMPORTED_MODULES_SCRIPT = """
+import json, sys, django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+print(json.dumps([name for name in sys.argv[1:] if name in sys.modules]))
+"""
+
+
+class StartupProfileTests(SimpleTestCase):
+    heavy_modules = ['openai', 'httpx', 'numpy', 'cv2']
+
+    def imported_modules(self, profile, modules):
+        env = {**os.environ, 'COPILOT_PROFILE': profile, 'DJANGO_SETTINGS_MODULE': 'backend.settings'}
+        for name in ('ADMIN_ENABLED', 'API_DOCS_ENABLED', 'BROWSABLE_API_ENABLED'):
+            env.pop(name, None)
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORTED_MODULES_SCRIPT, *modules],
+            env=env, capture_output=True, text=True, check=True, cwd=settings.BASE_DIR,
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+    def test_heavy_dependencies_load_on_first_use(self):
+        self.assertEqual(self.imported_modules('development', self.heavy_modules), [])
+
+    def test_production_profile_skips_docs(self):
+        self.assertEqual(self.imported_modules('production', self.heavy_modules + ['drf_spectacular']), [])
+
+    def test_warm_up_preloads_deferred_modules(self):
+        with mock.patch.object(startup.gc, 'freeze') as freeze, \
+                mock.patch.object(startup.connections, 'close_all') as close_all, \
+                mock.patch.object(startup.importlib, 'import_module') as import_module:
+            startup.warm_up()
+        imported = [call.args[0] for call in import_module.call_args_list]
+        self.assertEqual(imported, startup.DEFERRED_IMPORTS)
+        close_all.assert_called_once()
+        freeze.assert_called_once()
+
+
+@override_settings(STATELESS_API_PREFIXES=['/copilot/'])
+class StatelessMiddlewareTests(SimpleTestCase):
+    factory = RequestFactory()
+
+    def seen_request(self, middleware_class, path):
+        seen = {}
+
+        def get_response(request):
+            seen['request'] = request
+            return HttpResponse()
+
+        response = middleware_class(get_response)(self.factory.get(path))
+        return seen['request'], response
+
+    def test_api_paths_skip_session_and_auth(self):
+        for middleware_class in (middleware.SessionMiddleware, middleware.AuthenticationMiddleware):
+            request, _ = self.seen_request(middleware_class, '/copilot/health/')
+            self.assertFalse(hasattr(request, 'session') or hasattr(request, 'user'))
+        request, _ = self.seen_request(middleware.SessionMiddleware, '/admin/')
+        self.assertTrue(hasattr(request, 'session'))
+
+    def test_api_paths_skip_frame_options_header(self):
+        _, response = self.seen_request(middleware.XFrameOptionsMiddleware, '/copilot/health/')
+        self.assertNotIn('X-Frame-Options', response)
+        _, response = self.seen_request(middleware.XFrameOptionsMiddleware, '/admin/')
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+
+    def test_csrf_is_checked_outside_api_paths_only(self):
+        def view(request):
+            return HttpResponse()
+
+        csrf = middleware.CsrfViewMiddleware(view)
+        self.assertIsNone(csrf.process_view(self.factory.post('/copilot/ask/'), view, (), {}))
+        self.assertEqual(csrf.process_view(self.factory.post('/admin/login/'), view, (), {}).status_code, 403)
+
+    def test_api_response_sets_no_cookies(self):
+        response = self.client.get(reverse('health-check'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.cookies)
+
+
+@override_settings(CONVERSATION_SUMMARY_THRESHOLD_TOKENS=50, CONVERSATION_KEEP_TURNS=2)
+class ConversationTests(TestCase):
+    def setUp(self):
+        document, _ = conversations.save_document('Текст про кошек.')
+        self.conversation = Conversation.objects.create(document=document)
+        patcher = mock.patch.object(services, '_answer_cache', TieredCache('test'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_turns(self, count, words=5):
+        for number in range(count):
+            conversations.record_turn(
+                self.conversation, f'Вопрос {number}', ' '.join(['ответ'] * words), 'gpt-4o-mini'
+            )
+
+    def test_document_is_stored_once(self):
+        first, created = conversations.save_document('Текст про собак.')
+        second, created_again = conversations.save_document('Текст про собак.')
+        self.assertEqual((first.pk, created, created_again), (second.pk, True, False))
+        self.assertEqual(first.pk, conversations.document_id('Текст про собак.'))
+
+    def test_short_history_is_sent_as_is(self):
+        self.add_turns(2)
+        with mock.patch.object(conversations, 'completion_with_usage') as completion:
+            messages = conversations.conversation_history(self.conversation)
+        completion.assert_not_called()
+        self.assertEqual([message['role'] for message in messages], ['user', 'assistant'] * 2)
+
+    def test_long_history_is_compacted_except_last_turns(self):
+        self.add_turns(5, words=20)
+        with mock.patch.object(
+            conversations, 'completion_with_usage', return_value=(fake_completion('Спрашивали про кошек.'), None)
+        ) as completion:
+            messages = conversations.conversation_history(self.conversation)
+        transcript = completion.call_args.kwargs['messages'][1]['content']
+        self.assertIn('Вопрос 2', transcript)
+        self.assertNotIn('Вопрос 3', transcript)
+        self.assertEqual(messages[0]['role'], 'system')
+        self.assertIn('Спрашивали про кошек.', messages[0]['content'])
+        self.assertEqual([message['content'] for message in messages[1::2]], ['Вопрос 3', 'Вопрос 4'])
+        self.assertEqual(self.conversation.turns.filter(summarized=True).count(), 3)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary, 'Спрашивали про кошек.')
+
+    def test_failed_summary_keeps_full_history(self):
+        self.add_turns(5, words=20)
+        error = OpenAIAPIException('AI сервис недоступен', status_code=502)
+        with mock.patch.object(conversations, 'completion_with_usage', side_effect=error):
+            messages = conversations.conversation_history(self.conversation)
+        self.assertEqual(len(messages), 10)
+        self.assertFalse(self.conversation.turns.filter(summarized=True).exists())
+
+    def test_ask_in_conversation_records_the_turn(self):
+        calls = []
+
+        def completion(**kwargs):
+            calls.append(kwargs)
+            return fake_completion('Про кошек.')
+
+        async def async_completion(**kwargs):
+            return completion(**kwargs)
+
+        self.add_turns(1)
+        with mock.patch('copilot.tokens.chat_completion', completion), \
+                mock.patch('copilot.tokens.async_chat_completion', async_completion):
+            response = self.client.post(
+                reverse('copilot-ask'), {'conversation_id': str(self.conversation.pk), 'question': 'Про кого текст?'},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['conversation_id'], str(self.conversation.pk))
+        messages = calls[0]['messages']
+        self.assertEqual(messages[1]['content'], 'Текст: Текст про кошек.')
+        self.assertEqual([message['content'] for message in messages[2:]][::2], ['Вопрос 0', 'Вопрос: Про кого текст?'])
+        last = ConversationTurn.objects.filter(conversation=self.conversation).last()
+        self.assertEqual((last.question, last.answer), ('Про кого текст?', 'Про кошек.'))
+
+
+class AskBatchTests(SimpleTestCase):
+    """Пакет вопросов по одному тексту через синхронное и асинхронное представление"""
+
+    LONG_CONTEXT = ' '.join([DOCUMENT] * 6)
+
+    def setUp(self):
+        patcher = mock.patch.object(services, '_answer_cache', TieredCache('test'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.events = []
+
+    @staticmethod
+    def question_of(kwargs):
+        return kwargs['messages'][-1]['content'].removeprefix('Вопрос: ')
+
+    def completion(self, failing=()):
+        def completion(**kwargs):
+            question = self.question_of(kwargs)
+            self.events.append(('start', question))
+            time.sleep(0.02)
+            self.events.append(('end', question))
+            if question in failing:
+                raise OpenAIAPIException('AI сервис недоступен', status_code=502)
+            return fake_completion(f'Ответ: {question}')
+        return completion
+
+    def ask_batch(self, context, questions, failing=()):
+        request = RequestFactory().post(
+            '/copilot/ask/batch/', {'context': context, 'questions': questions}, content_type='application/json',
+        )
+        with mock.patch('copilot.tokens.chat_completion', self.completion(failing)):
+            return views.AskBatchView.as_view()(request).data
+
+    def test_long_prefix_is_warmed_by_first_question(self):
+        payload = self.ask_batch(self.LONG_CONTEXT, ['Кто спит днем?', 'Кто любит мяч?', 'Кто живет долго?'])
+        self.assertEqual(self.events[:2], [('start', 'Кто спит днем?'), ('end', 'Кто спит днем?')])
+        self.assertEqual(payload['succeeded'], 3)
+
+    def test_short_prefix_is_not_warmed(self):
+        serializer = views.AskBatchRequestSerializer(data={'context': DOCUMENT, 'questions': ['Кто?', 'Где?']})
+        serializer.is_valid(raise_exception=True)
+        request = RequestFactory().post('/copilot/ask/batch/')
+        self.assertFalse(services.AskBatch(request, serializer.validated_data)._warm_prefix())
+        serializer = views.AskBatchRequestSerializer(data={'context': self.LONG_CONTEXT, 'questions': ['Кто?', 'Где?']})
+        serializer.is_valid(raise_exception=True)
+        self.assertTrue(services.AskBatch(request, serializer.validated_data)._warm_prefix())
+
+    @override_settings(ASK_BATCH_WARM_PREFIX=False)
+    def test_warm_prefix_can_be_disabled(self):
+        serializer = views.AskBatchRequestSerializer(data={'context': self.LONG_CONTEXT, 'questions': ['Кто?', 'Где?']})
+        serializer.is_valid(raise_exception=True)
+        request = RequestFactory().post('/copilot/ask/batch/')
+        self.assertFalse(services.AskBatch(request, serializer.validated_data)._warm_prefix())
+
+    def test_repeated_question_is_sent_once(self):
+        payload = self.ask_batch(DOCUMENT, ['Кто спит днем?', 'Кто любит мяч?', 'Кто спит днем?'])
+        self.assertEqual(sorted(question for name, question in self.events if name == 'start'),
+                         ['Кто любит мяч?', 'Кто спит днем?'])
+        repeated = payload['results'][2]
+        self.assertEqual((repeated['index'], repeated['answer']), (2, 'Ответ: Кто спит днем?'))
+        self.assertTrue(repeated['coalesced'])
+        self.assertIsNone(repeated['usage'])
+
+    def test_failed_question_does_not_cancel_others(self):
+        payload = self.ask_batch(self.LONG_CONTEXT, ['Кто спит днем?', 'Кто любит мяч?'], failing={'Кто спит днем?'})
+        self.assertEqual((payload['succeeded'], payload['failed']), (1, 1))
+        self.assertEqual(payload['results'][0]['status_code'], 502)
+        self.assertEqual(payload['results'][1]['answer'], 'Ответ: Кто любит мяч?')
+
+    def test_async_view_warms_prefix_first(self):
+        completion = self.completion()
+
+        async def async_completion(**kwargs):
+            question = self.question_of(kwargs)
+            self.events.append(('start', question))
+            await asyncio.sleep(0.02)
+            self.events.append(('end', question))
+            return fake_completion(f'Ответ: {question}')
+
+        questions = ['Кто спит днем?', 'Кто любит мяч?', 'Кто живет долго?']
+
+        async def run():
+            request = AsyncRequestFactory().post(
+                '/copilot/ask/batch/', {'context': self.LONG_CONTEXT, 'questions': questions},
+                content_type='application/json',
+            )
+            return await async_views.ask_batch(request)
+
+        with mock.patch('copilot.tokens.chat_completion', completion), \
+                mock.patch('copilot.tokens.async_chat_completion', async_completion):
+            response = asyncio.run(run())
+        self.assertEqual(json.loads(response.content)['succeeded'], 3)
+        self.assertEqual(self.events[:2], [('start', 'Кто спит днем?'), ('end', 'Кто спит днем?')])
+        self.assertEqual([name for name, _ in self.events[2:4]], ['start', 'start'])
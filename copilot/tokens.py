@@ -0,0 +1,179 @@
+"""
+Оценка числа токенов до запроса к OpenAI и учет фактического расхода.
+
+Оценка нужна, чтобы отклонить или сократить слишком длинный запрос до
+похода в сеть. Если установлен tiktoken, текст считается им, иначе —
+приближенно по числу символов (латиница ~4 символа на токен, кириллица
+и другие алфавиты ~2). Фактический usage из ответов копится по эндпоинтам.
+"""
+import logging
+import math
+import threading
+import time
+
+from .client import chat_completion, async_chat_completion
+from .metrics import UPSTREAM_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены на каждое сообщение и на ответ ассистента
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+
+# Стоимость изображения в OpenAI Vision (detail=high): 85 + 170 за каждую плитку 512x512
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+
+# cached_tokens — часть prompt_tokens, которую OpenAI взял из кеша промптов (совпавшее начало промпта)
+USAGE_FIELDS = ('prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens')
+
+_encodings = {}
+
+
+def _encoding(model):
+    """Токенизатор tiktoken для модели или None, если пакет не установлен"""
+    if model not in _encodings:
+        try:
+            import tiktoken
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding('cl100k_base')
+        except ImportError:
+            _encodings[model] = None
+    return _encodings[model]
+
+
+def estimate_text_tokens(text, model=None):
+    encoding = _encoding(model or 'gpt-4')
+    if encoding is not None:
+        return len(encoding.encode(text))
+    ascii_chars = len(text) if text.isascii() else len(text.encode('ascii', 'ignore'))
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars) / 2)
+
+
+def estimate_image_tokens(width, height):
+    """Изображение вписывается в 2048x2048, затем короткая сторона уменьшается до 768"""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+def estimate_request_tokens(request_kwargs, image_sizes=()):
+    """Оценка prompt_tokens для параметров chat.completions.create"""
+    model = request_kwargs.get('model')
+    total = REPLY_OVERHEAD_TOKENS
+    for message in request_kwargs.get('messages', []):
+        total += MESSAGE_OVERHEAD_TOKENS
+        content = message.get('content')
+        if isinstance(content, str):
+            total += estimate_text_tokens(content, model)
+            continue
+        for part in content or []:
+            if part.get('type') == 'text':
+                total += estimate_text_tokens(part['text'], model)
+    for width, height in image_sizes:
+        total += estimate_image_tokens(width, height)
+    return total
+
+
+def usage_from_response(response):
+    """Блок usage ответа OpenAI в виде словаря (None, если его нет)"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return None
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+        'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+        'total_tokens': getattr(usage, 'total_tokens', 0) or 0,
+        'cached_tokens': getattr(details, 'cached_tokens', 0) or 0,
+    }
+
+
+def sum_usage(items):
+    """Складывает несколько блоков usage; None, если ни одного нет"""
+    items = [item for item in items if item]
+    if not items:
+        return None
+    return {field: sum(item.get(field, 0) for item in items) for field in USAGE_FIELDS}
+
+
+def usage_headers(usage, estimated=None):
+    """Заголовки ответа с расходом токенов"""
+    headers = {}
+    if estimated is not None:
+        headers['X-Copilot-Estimated-Prompt-Tokens'] = str(estimated)
+    if usage:
+        headers['X-Copilot-Prompt-Tokens'] = str(usage['prompt_tokens'])
+        headers['X-Copilot-Completion-Tokens'] = str(usage['completion_tokens'])
+        headers['X-Copilot-Total-Tokens'] = str(usage['total_tokens'])
+        headers['X-Copilot-Cached-Tokens'] = str(usage.get('cached_tokens', 0))
+    return headers
+
+
+class UsageStats:
+    """Суммарный расход токенов и время запросов к OpenAI по эндпоинтам (в текущем процессе)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _endpoint(self, endpoint):
+        return self._endpoints.setdefault(endpoint, {
+            'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0, 'cached_tokens': 0,
+            'estimated_prompt_tokens': 0, 'upstream_seconds': 0.0, 'rejected': 0,
+        })
+
+    def record(self, endpoint, usage, estimated=None, elapsed=None):
+        for field in ('prompt_tokens', 'completion_tokens', 'cached_tokens'):
+            if usage and usage.get(field):
+                UPSTREAM_TOKENS.labels(endpoint, field.split('_')[0]).inc(usage[field])
+        with self._lock:
+            stats = self._endpoint(endpoint)
+            stats['calls'] += 1
+            for field in USAGE_FIELDS:
+                stats[field] += (usage or {}).get(field, 0)
+            stats['estimated_prompt_tokens'] += estimated or 0
+            stats['upstream_seconds'] += elapsed or 0.0
+
+    def record_rejected(self, endpoint):
+        """Запрос отклонен до обращения к OpenAI (превышен бюджет токенов)"""
+        with self._lock:
+            self._endpoint(endpoint)['rejected'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for endpoint, stats in self._endpoints.items():
+                calls = stats['calls']
+                result[endpoint] = {
+                    **stats,
+                    'upstream_seconds': round(stats['upstream_seconds'], 3),
+                    'avg_prompt_tokens': round(stats['prompt_tokens'] / calls, 1) if calls else 0.0,
+                    'avg_upstream_ms': round(stats['upstream_seconds'] / calls * 1000, 2) if calls else 0.0,
+                }
+            return result
+
+
+usage_stats = UsageStats()
+
+
+def completion_with_usage(endpoint, estimated=None, **request_kwargs):
+    """chat_completion с учетом usage и времени запроса; возвращает (ответ, usage)"""
+    started = time.perf_counter()
+    response = chat_completion(**request_kwargs)
+    usage = usage_from_response(response)
+    usage_stats.record(endpoint, usage, estimated, time.perf_counter() - started)
+    return response, usage
+
+
+async def acompletion_with_usage(endpoint, estimated=None, **request_kwargs):
+    started = time.perf_counter()
+    response = await async_chat_completion(**request_kwargs)
+    usage = usage_from_response(response)
+    usage_stats.record(endpoint, usage, estimated, time.perf_counter() - started)
+    return response, usage
@@ -0,0 +1,194 @@
+"""
+Ранняя проверка загружаемых файлов.
+
+UploadLimitHandler стоит первым в цепочке обработчиков загрузки Django и
+проверяет файл по мере поступления данных: Content-Length, счетчик байт,
+формат по сигнатуре первых байт (а не по расширению) и размеры изображения
+из заголовка. Слишком большой или чужой файл отклоняется, не дочитывая
+запрос и не декодируя изображение. После загрузки check_image_header
+сверяет число пикселей и кадров по заголовку до полного декодирования в PIL.
+"""
+import io
+import warnings
+
+from PIL import Image
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload, load_handler
+
+from .exceptions import FileValidationException
+
+IMAGE_FORMATS = frozenset({'jpeg', 'png', 'gif', 'bmp', 'webp'})
+VIDEO_FORMATS = frozenset({'mp4', 'mov', 'webm', 'avi', 'wmv', 'flv', 'gif', 'webp'})
+MEDIA_FORMATS = IMAGE_FORMATS | VIDEO_FORMATS
+
+# Сколько байт начала файла нужно для определения формата
+SNIFF_BYTES = 32
+# Запас на границы multipart и текстовые поля формы
+REQUEST_OVERHEAD = 1024 * 1024
+
+ASF_GUID = b'\x30\x26\xb2\x75\x8e\x66\xcf\x11\xa6\xd9\x00\xaa\x00\x62\xce\x6c'
+HEIF_BRANDS = {b'heic', b'heix', b'hevc', b'mif1', b'msf1', b'avif'}
+
+
+def sniff_format(head):
+    """Формат файла по сигнатуре (magic bytes) или None"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    if head[:4] == b'RIFF':
+        return {b'WEBP': 'webp', b'AVI ': 'avi'}.get(head[8:12])
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in HEIF_BRANDS:
+            return None
+        return 'mov' if brand == b'qt  ' else 'mp4'
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'webm'
+    if head.startswith(b'FLV'):
+        return 'flv'
+    if head.startswith(ASF_GUID):
+        return 'wmv'
+    return None
+
+
+def read_head(file, size=SNIFF_BYTES):
+    file.seek(0)
+    try:
+        return file.read(size)
+    finally:
+        file.seek(0)
+
+
+def _format_names(formats):
+    return ', '.join(sorted(formats))
+
+
+def _open_header(data):
+    """Открывает изображение без декодирования пикселей (PIL читает только заголовок)"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+        return Image.open(data)
+
+
+def check_pixels(width, height, file_name=None):
+    limit = settings.UPLOAD_MAX_PIXELS
+    if width * height > limit:
+        raise FileValidationException(
+            f'Изображение {width}x{height} больше допустимых {limit / 1e6:.0f} Мп',
+            file_name=file_name, status_code=413,
+        )
+
+
+def check_image_header(image_file):
+    """
+    Проверяет размеры и число кадров по заголовку, до полного декодирования.
+    Файлы, которые PIL не может открыть, пропускает: их отклонит ImageField.
+    """
+    name = getattr(image_file, 'name', None)
+    image_file.seek(0)
+    try:
+        img = _open_header(image_file)
+        check_pixels(img.width, img.height, name)
+        frames = getattr(img, 'n_frames', 1)
+    except Image.DecompressionBombError:
+        raise FileValidationException('Слишком большое изображение', file_name=name, status_code=413)
+    except FileValidationException:
+        raise
+    except Exception:
+        return
+    finally:
+        image_file.seek(0)
+    if frames > settings.UPLOAD_MAX_FRAMES:
+        raise FileValidationException(
+            f'Слишком много кадров: {frames} (не больше {settings.UPLOAD_MAX_FRAMES})',
+            file_name=name, status_code=413,
+        )
+
+
+class UploadLimitHandler(FileUploadHandler):
+    """
+    Проверяет multipart-загрузку до того, как следующие обработчики запишут файл.
+    Ошибка сохраняется, загрузка прерывается (StopUpload без дочитывания тела),
+    а FileValidationException поднимается в upload_complete.
+    """
+
+    def __init__(self, request=None, formats=IMAGE_FORMATS, max_file_size=None, max_files=1, sniff=True):
+        super().__init__(request)
+        self.formats = formats
+        self.max_file_size = max_file_size or settings.UPLOAD_MAX_IMAGE_SIZE
+        self.max_files = max_files
+        self.sniff = sniff
+        self.files = 0
+        self.error = None
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        limit = self.max_file_size * self.max_files + REQUEST_OVERHEAD
+        if content_length and content_length > limit:
+            raise FileValidationException(
+                f'Размер запроса не должен превышать {limit // (1024 * 1024)} МБ', status_code=413
+            )
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.files += 1
+        if self.files > self.max_files:
+            self._reject(f'Не больше {self.max_files} файлов за один запрос', 413)
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.max_file_size:
+            self._reject(f'Размер файла не должен превышать {self.max_file_size // (1024 * 1024)} МБ', 413)
+        if start == 0 and self.sniff:
+            self._check_head(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+    def upload_complete(self):
+        if self.error is not None:
+            raise self.error
+
+    def _check_head(self, data):
+        file_format = sniff_format(data[:SNIFF_BYTES])
+        if file_format not in self.formats:
+            self._reject(f'Неподдерживаемый формат файла. Разрешены: {_format_names(self.formats)}', 415)
+        if file_format not in IMAGE_FORMATS:
+            return
+        # Размеры почти всегда есть в первом блоке; если нет, их проверит check_image_header
+        try:
+            img = _open_header(io.BytesIO(data))
+        except Image.DecompressionBombError:
+            self._reject('Слишком большое изображение', 413)
+        except Exception:
+            return
+        try:
+            check_pixels(img.width, img.height, self.file_name)
+        except FileValidationException as exc:
+            self._reject(exc.message, exc.status_code)
+
+    def _reject(self, message, status_code):
+        self.error = FileValidationException(message, file_name=self.file_name, status_code=status_code)
+        raise StopUpload(connection_reset=True)
+
+
+def limit_uploads(request, formats=IMAGE_FORMATS, max_file_size=None, max_files=1, sniff=True):
+    """
+    Ставит UploadLimitHandler перед стандартными обработчиками загрузки.
+    Вызывается в представлении до обращения к request.data / request.FILES.
+    sniff=False оставляет только ограничения размера: формат и размеры
+    проверяются после загрузки (в пакете ошибка одного файла не отменяет остальные).
+    """
+    http_request = getattr(request, '_request', request)
+    if hasattr(http_request, '_files'):
+        # Тело уже разобрано (например, при проверке CSRF) — остаются проверки после загрузки
+        return
+    http_request.upload_handlers = [
+        UploadLimitHandler(http_request, formats, max_file_size, max_files, sniff),
+        *(load_handler(handler, http_request) for handler in settings.FILE_UPLOAD_HANDLERS),
+    ]
@@ -1,8 +1,40 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+if settings.COPILOT_ASYNC_VIEWS:
+    # ASGI: нативные async-представления на AsyncOpenAI
+    from . import async_views
+    ask_view = async_views.ask
+    ask_batch_view = async_views.ask_batch
+    moderate_image_view = async_views.moderate_image
+    moderate_image_advice_view = async_views.moderate_image_advice
+    moderate_images_view = async_views.moderate_images
+    moderate_video_view = async_views.moderate_video
+else:
+    ask_view = views.AskView.as_view()
+    ask_batch_view = views.AskBatchView.as_view()
+    moderate_image_view = views.moderate_image
+    moderate_image_advice_view = views.moderate_image_advice
+    moderate_images_view = views.moderate_images
+    moderate_video_view = views.moderate_video
+
 urlpatterns = [
     path("health/", views.HealthCheckView.as_view(), name="health-check"),
-    path("ask/", views.AskView.as_view(), name="copilot-ask"),
-    path("moderate-image/", views.moderate_image, name="moderate-image"),
+    path("stats/", views.StatsView.as_view(), name="stats"),
+    path("metrics/", views.metrics, name="metrics"),
+    path("ask/", ask_view, name="copilot-ask"),
+    path("ask/batch/", ask_batch_view, name="copilot-ask-batch"),
+    path("documents/", views.DocumentView.as_view(), name="copilot-documents"),
+    path("documents/<str:document_id>/", views.DocumentDetailView.as_view(), name="copilot-document"),
+    path("conversations/", views.ConversationView.as_view(), name="copilot-conversations"),
+    path("conversations/<uuid:conversation_id>/", views.ConversationDetailView.as_view(), name="copilot-conversation"),
+    path("moderate-image/", moderate_image_view, name="moderate-image"),
+    path("moderate-image/advice/", moderate_image_advice_view, name="moderate-image-advice"),
+    path("moderate-images/", moderate_images_view, name="moderate-images"),
+    path("moderate-video/", moderate_video_view, name="moderate-video"),
+    path("content/upload/", views.upload_content, name="upload-content"),
+    path("history/", views.ModerationHistoryView.as_view(), name="moderation-history"),
+    path("jobs/", views.ModerationJobListView.as_view(), name="moderation-jobs"),
+    path("jobs/<str:job_id>/", views.ModerationJobView.as_view(), name="moderation-job"),
 ]
@@ -1,41 +1,68 @@
+import ipaddress
+import socket
+from urllib.parse import urlsplit
+
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.core.validators import FileExtensionValidator
 from django.utils.translation import gettext_lazy as _
-import os
+
+from .uploads import IMAGE_FORMATS, VIDEO_FORMATS, read_head, sniff_format
 
 
 def validate_file_size(value):
-    """Валидация размера файла (максимум 10MB)"""
-    limit = 10 * 1024 * 1024  # 10MB
+    """Валидация размера файла (UPLOAD_MAX_IMAGE_SIZE, по умолчанию 10MB)"""
+    limit = settings.UPLOAD_MAX_IMAGE_SIZE
     if value.size > limit:
         raise ValidationError(
             _('Размер файла не должен превышать %(limit)s.'),
-            params={'limit': '10MB'}
+            params={'limit': f'{limit // (1024 * 1024)}MB'}
         )
 
 
-def validate_image_file(value):
-    """Валидация типа файла для изображений"""
-    allowed_extensions = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
-    ext = os.path.splitext(value.name)[1][1:].lower()
-    
-    if ext not in allowed_extensions:
+def _validate_format(value, formats):
+    """Тип файла определяется по сигнатуре содержимого, а не по расширению"""
+    if sniff_format(read_head(value)) not in formats:
         raise ValidationError(
             _('Неподдерживаемый тип файла. Разрешены: %(extensions)s'),
-            params={'extensions': ', '.join(allowed_extensions)}
+            params={'extensions': ', '.join(sorted(formats))}
         )
 
 
+def validate_image_file(value):
+    """Валидация типа файла для изображений"""
+    _validate_format(value, IMAGE_FORMATS)
+
+
 def validate_video_file(value):
     """Валидация типа файла для видео"""
-    allowed_extensions = ['mp4', 'avi', 'mov', 'wmv', 'flv', 'webm']
-    ext = os.path.splitext(value.name)[1][1:].lower()
-    
-    if ext not in allowed_extensions:
-        raise ValidationError(
-            _('Неподдерживаемый тип файла. Разрешены: %(extensions)s'),
-            params={'extensions': ', '.join(allowed_extensions)}
-        )
+    _validate_format(value, VIDEO_FORMATS - IMAGE_FORMATS)
+
+
+def validate_video_or_animation_file(value):
+    """Валидация типа файла для модерации видео (видео или анимированные GIF/WebP)"""
+    _validate_format(value, VIDEO_FORMATS)
+
+
+def validate_callback_url(value):
+    """
+    Адрес webhook: только http/https, и все адреса хоста после DNS-разрешения
+    публичные — не loopback, не частные и не link-local (защита от SSRF
+    к внутренним сервисам и метаданным облака)
+    """
+    parsed = urlsplit(value)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValidationError(_('Разрешены только адреса http:// и https://.'))
+    if settings.JOB_WEBHOOK_ALLOW_PRIVATE:
+        return
+    try:
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        addresses = socket.getaddrinfo(parsed.hostname, port, proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError, ValueError):
+        raise ValidationError(_('Не удалось определить адрес хоста.'))
+    for _family, _type, _proto, _name, sockaddr in addresses:
+        # Зона IPv6 (fe80::1%eth0) не нужна для проверки
+        if not ipaddress.ip_address(sockaddr[0].split('%')[0]).is_global:
+            raise ValidationError(_('Адрес указывает на внутреннюю сеть.'))
 
 
 def validate_openai_response(response_text):
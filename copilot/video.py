@@ -0,0 +1,394 @@
+"""
+Модерация видео и анимированных GIF/WebP.
+
+Кадры выбираются по смене сцены (разница гистограмм яркости) и периодически
+раз в VIDEO_KEYFRAME_INTERVAL секунд, почти одинаковые кадры отбрасываются по
+перцептивному хешу, а оставшиеся (не больше VIDEO_MAX_FRAMES) склеиваются в
+пронумерованные контактные листы. Один лист — один запрос к OpenAI Vision.
+"""
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageSequence
+from django.conf import settings
+
+from .tokens import completion_with_usage, estimate_request_tokens, sum_usage
+from .exceptions import ContentModerationException, FileValidationException
+from .imaging import image_to_data_url
+from .uploads import read_head, sniff_format
+from .services import (
+    DANGEROUS_TAGS, MODE_FULL, MODERATION_MAX_TOKENS, MODERATION_MODEL, detected_tags, get_verdict_cache,
+    image_digest, moderation_schema, parse_verdict_content, unparsed_verdict,
+)
+
+logger = logging.getLogger(__name__)
+
+VIDEO_MODERATION_PROMPT = (
+    "Это контактный лист из кадров видео для краудфандинговой платформы (например, Kickstarter). "
+    "Кадры пронумерованы (#1, #2, ...) в левом верхнем углу, рядом указано время кадра. "
+    "Проанализируй все кадры на наличие опасного контента. Не пиши в ответе каких тегов ты не нашел. "
+    "Верни результат в формате JSON со следующими полями: "
+    "'verdict': safe/potentially_unsafe/unsafe, 'tags': список найденных опасных тегов, 'explanation': краткое объяснение, "
+    "'flagged_frames': список номеров кадров с сомнительным или опасным контентом (пустой, если таких нет). "
+    f"Опасные теги: {', '.join(DANGEROUS_TAGS)}. "
+    "safe — полностью безопасно, potentially_unsafe — есть сомнительные элементы, unsafe — явно опасно."
+)
+
+VIDEO_MODERATION_SCHEMA = moderation_schema('video_moderation', {
+    "explanation": {"type": "string"},
+    "flagged_frames": {"type": "array", "items": {"type": "integer"}},
+})
+
+# Настройки, от которых зависят выбранные кадры и листы
+VIDEO_SAMPLING_SETTINGS = (
+    'VIDEO_SAMPLE_FPS', 'VIDEO_MAX_DURATION', 'VIDEO_SCENE_THRESHOLD', 'VIDEO_KEYFRAME_INTERVAL',
+    'VIDEO_DEDUP_DISTANCE', 'VIDEO_MAX_FRAMES', 'VIDEO_SHEET_COLUMNS', 'VIDEO_SHEET_ROWS',
+    'MODERATION_IMAGE_MAX_DIMENSION', 'MODERATION_STRUCTURED_OUTPUT',
+)
+
+# Версия кеша вердиктов видео: модель, промпт, схема ответа и выбор кадров.
+# При изменении любого из них старые вердикты не используются
+VIDEO_CACHE_VERSION = hashlib.sha256(
+    f"{MODERATION_MODEL}\n{VIDEO_MODERATION_PROMPT}\n{json.dumps(VIDEO_MODERATION_SCHEMA, sort_keys=True)}\n"
+    f"{json.dumps({name: getattr(settings, name) for name in VIDEO_SAMPLING_SETTINGS}, sort_keys=True)}".encode('utf-8')
+).hexdigest()[:12]
+
+VERDICT_SEVERITY = {'safe': 0, 'potentially_unsafe': 1, 'unsafe': 2}
+
+# Форматы, которые разбираются Pillow по кадрам; остальное — видео через OpenCV
+ANIMATION_FORMATS = ('gif', 'webp')
+
+
+class Keyframe:
+    def __init__(self, timestamp, image, histogram, dhash, score):
+        self.timestamp = timestamp
+        self.image = image
+        self.histogram = histogram
+        self.dhash = dhash
+        self.score = score
+
+
+def _signature(image):
+    """Гистограмма яркости (256 бинов) и 64-битный dHash уменьшенного кадра"""
+    gray = image.convert('L')
+    histogram = gray.resize((64, 64)).histogram()
+    pixels = list(gray.resize((9, 8)).getdata())
+    dhash = 0
+    for row in range(8):
+        for col in range(8):
+            dhash = (dhash << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return histogram, dhash
+
+
+def _histogram_distance(first, second):
+    """Доля пикселей, «переехавших» между бинами: 0 — одинаковые кадры, 1 — совсем разные"""
+    return sum(abs(a - b) for a, b in zip(first, second)) / (2 * 64 * 64)
+
+
+class KeyframeSelector:
+    """
+    Потоково отбирает ключевые кадры. В памяти держится не больше
+    VIDEO_MAX_FRAMES уменьшенных кадров: при переполнении вытесняется
+    кадр с наименьшей сменой сцены.
+    """
+
+    def __init__(self):
+        self.cell_size = settings.MODERATION_IMAGE_MAX_DIMENSION // settings.VIDEO_SHEET_COLUMNS
+        self.sampled = 0
+        self.duplicates = 0
+        self._heap = []
+        self._sequence = 0
+        self._last_histogram = None
+        self._last_keyframe_at = None
+
+    def offer(self, timestamp, image):
+        self.sampled += 1
+        histogram, dhash = _signature(image)
+        if self._last_histogram is None:
+            change = 1.0
+        else:
+            change = _histogram_distance(histogram, self._last_histogram)
+        self._last_histogram = histogram
+
+        periodic = (
+            self._last_keyframe_at is None
+            or timestamp - self._last_keyframe_at >= settings.VIDEO_KEYFRAME_INTERVAL
+        )
+        if change < settings.VIDEO_SCENE_THRESHOLD and not periodic:
+            return
+        for _, _, kept in self._heap:
+            # У однотонных кадров dHash совпадает, поэтому сверяем еще и гистограммы
+            if (
+                bin(dhash ^ kept.dhash).count('1') <= settings.VIDEO_DEDUP_DISTANCE
+                and _histogram_distance(histogram, kept.histogram) < settings.VIDEO_SCENE_THRESHOLD
+            ):
+                self.duplicates += 1
+                return
+
+        self._last_keyframe_at = timestamp
+        thumbnail = image.convert('RGB')
+        thumbnail.thumbnail((self.cell_size, self.cell_size))
+        self._sequence += 1
+        heapq.heappush(self._heap, (change, self._sequence, Keyframe(timestamp, thumbnail, histogram, dhash, change)))
+        if len(self._heap) > settings.VIDEO_MAX_FRAMES:
+            heapq.heappop(self._heap)
+
+    def keyframes(self):
+        return sorted((frame for _, _, frame in self._heap), key=lambda frame: frame.timestamp)
+
+
+def _import_cv2():
+    try:
+        import cv2
+    except ImportError:
+        raise ContentModerationException(
+            'Модерация видео недоступна: не установлен пакет opencv-python-headless'
+        )
+    return cv2
+
+
+def _duration_exceeded(duration):
+    return FileValidationException(
+        f'Видео длиннее {settings.VIDEO_MAX_DURATION:.0f} с ({duration:.0f} с) не проверяется', status_code=413
+    )
+
+
+class VideoFrames:
+    """
+    Читает видео кадр за кадром из файла (целиком в память не загружается)
+    и отдает (время в секундах, кадр PIL) с частотой VIDEO_SAMPLE_FPS.
+
+    Видео длиннее VIDEO_MAX_DURATION по заголовку контейнера отклоняется с 413
+    до чтения кадров. Если длительность в заголовке не указана и кадры есть и
+    после предела, чтение останавливается, а truncated становится True.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.truncated = False
+
+    def __iter__(self):
+        cv2 = _import_cv2()
+        capture = cv2.VideoCapture(self.path)
+        if not capture.isOpened():
+            raise ContentModerationException('Не удалось прочитать видеофайл')
+        try:
+            fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+            frame_count = capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+            if frame_count / fps > settings.VIDEO_MAX_DURATION:
+                raise _duration_exceeded(frame_count / fps)
+            step = max(1, round(fps / settings.VIDEO_SAMPLE_FPS))
+            index = 0
+            while True:
+                if index / fps > settings.VIDEO_MAX_DURATION:
+                    self.truncated = capture.grab()
+                    break
+                if index % step:
+                    # grab() не конвертирует кадр, пропуск дешевле полного чтения
+                    if not capture.grab():
+                        break
+                else:
+                    ok, frame = capture.read()
+                    if not ok:
+                        break
+                    yield index / fps, Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                index += 1
+        finally:
+            capture.release()
+
+
+def iter_animation_frames(img):
+    """Кадры анимированного GIF/WebP с учетом длительности каждого кадра"""
+    timestamp = 0.0
+    for frame in ImageSequence.Iterator(img):
+        yield timestamp, frame.convert('RGB')
+        timestamp += frame.info.get('duration', 100) / 1000
+
+
+def _format_timestamp(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes):02d}:{seconds:04.1f}"
+
+
+def build_contact_sheets(keyframes):
+    """Склеивает кадры в сетки VIDEO_SHEET_COLUMNS x VIDEO_SHEET_ROWS с номерами и временем"""
+    columns = settings.VIDEO_SHEET_COLUMNS
+    per_sheet = columns * settings.VIDEO_SHEET_ROWS
+    cell = settings.MODERATION_IMAGE_MAX_DIMENSION // columns
+    sheets = []
+    for start in range(0, len(keyframes), per_sheet):
+        chunk = keyframes[start:start + per_sheet]
+        rows = math.ceil(len(chunk) / columns)
+        sheet = Image.new('RGB', (cell * min(columns, len(chunk)), cell * rows), 'black')
+        draw = ImageDraw.Draw(sheet)
+        numbers = []
+        for position, frame in enumerate(chunk):
+            number = start + position + 1
+            x, y = (position % columns) * cell, (position // columns) * cell
+            sheet.paste(frame.image, (x + (cell - frame.image.width) // 2, y + (cell - frame.image.height) // 2))
+            label = f"#{number} {_format_timestamp(frame.timestamp)}"
+            draw.rectangle([x, y, x + 8 + 7 * len(label), y + 16], fill='black')
+            draw.text((x + 4, y + 3), label, fill='yellow')
+            numbers.append(number)
+        sheets.append((sheet, numbers))
+    return sheets
+
+
+def _moderate_sheet(sheet):
+    """Вердикт по одному листу; возвращает (вердикт, оценка prompt_tokens, usage)"""
+    request_kwargs = dict(
+        model=MODERATION_MODEL,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": VIDEO_MODERATION_PROMPT},
+                    {"type": "image_url", "image_url": {"url": image_to_data_url(sheet)}}
+                ]
+            }
+        ],
+        max_tokens=MODERATION_MAX_TOKENS[MODE_FULL]
+    )
+    if settings.MODERATION_STRUCTURED_OUTPUT:
+        request_kwargs["response_format"] = VIDEO_MODERATION_SCHEMA
+    estimated = estimate_request_tokens(request_kwargs, image_sizes=[sheet.size])
+    response, usage = completion_with_usage('moderate-video', estimated, **request_kwargs)
+    result, outcome = parse_verdict_content(response, 'video')
+    if result is None:
+        return {**unparsed_verdict(response, outcome), "flagged_frames": []}, estimated, usage
+    try:
+        flagged_frames = [int(number) for number in result.get("flagged_frames", [])]
+    except (TypeError, ValueError):
+        flagged_frames = []
+    verdict = {
+        "verdict": result["verdict"],
+        "tags": detected_tags(result),
+        "explanation": result.get("explanation", ""),
+        "flagged_frames": flagged_frames,
+    }
+    return verdict, estimated, usage
+
+
+def moderate_frames(frames):
+    """
+    Отбирает ключевые кадры, проверяет контактные листы и сводит вердикты.
+    Если проверена только часть видео (frames.truncated), вердикт не бывает safe.
+    """
+    timings = {}
+    started = time.perf_counter()
+    selector = KeyframeSelector()
+    for timestamp, image in frames:
+        selector.offer(timestamp, image)
+    keyframes = selector.keyframes()
+    timings['sampling'] = time.perf_counter() - started
+    if not keyframes:
+        raise ContentModerationException('В файле не найдено ни одного кадра')
+
+    started = time.perf_counter()
+    sheets = build_contact_sheets(keyframes)
+    timings['sheets'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    calls = [_moderate_sheet(sheet) for sheet, _ in sheets]
+    timings['upstream'] = time.perf_counter() - started
+    sheet_results = [verdict for verdict, _, _ in calls]
+
+    # Итоговый вердикт — самый строгий из вердиктов по листам
+    verdicts = [item["verdict"] for item in sheet_results]
+    if 'unsafe' in verdicts:
+        verdict = 'unsafe'
+    elif any(item not in VERDICT_SEVERITY for item in verdicts):
+        verdict = 'error'
+    else:
+        verdict = max(verdicts, key=VERDICT_SEVERITY.get)
+
+    explanations = [item["explanation"] for item in sheet_results if item["explanation"]]
+    truncated = getattr(frames, 'truncated', False)
+    if truncated:
+        # Непроверенный хвост может содержать что угодно
+        if verdict == 'safe':
+            verdict = 'potentially_unsafe'
+        explanations.append(
+            f"Проверены только первые {settings.VIDEO_MAX_DURATION:.0f} с видео, остальное не просмотрено."
+        )
+
+    flagged = []
+    for result in sheet_results:
+        for number in result["flagged_frames"]:
+            if 1 <= number <= len(keyframes):
+                flagged.append({"frame": number, "timestamp": round(keyframes[number - 1].timestamp, 2)})
+
+    result = {
+        "verdict": verdict,
+        "tags": [tag for tag in DANGEROUS_TAGS if any(tag in item["tags"] for item in sheet_results)],
+        "explanation": " ".join(explanations),
+        "flagged_timestamps": flagged,
+        "truncated": truncated,
+    }
+    stats = {
+        "frames_sampled": selector.sampled,
+        "duplicates_dropped": selector.duplicates,
+        "keyframes": [round(frame.timestamp, 2) for frame in keyframes],
+        "sheets": len(sheets),
+        "estimated_prompt_tokens": sum(estimated for _, estimated, _ in calls),
+        "usage": sum_usage(usage for _, _, usage in calls),
+        "timings_ms": {stage: round(value * 1000, 2) for stage, value in timings.items()},
+    }
+    logger.info(f"Video moderation: {stats}")
+    return result, stats
+
+
+def moderate_animation(image_file):
+    """Модерация анимированного GIF/WebP по всем кадрам, а не только по первому"""
+    image_file.seek(0)
+    img = Image.open(image_file)
+    return moderate_frames(iter_animation_frames(img))
+
+
+def _video_path(upload, file_format):
+    """
+    Путь к файлу на диске; небольшие загрузки из памяти записываются во временный файл.
+    Расширение — по формату содержимого, а не по имени файла от клиента.
+    """
+    if hasattr(upload, 'temporary_file_path'):
+        return upload.temporary_file_path(), False
+    with tempfile.NamedTemporaryFile(suffix=f'.{file_format}' if file_format else '', delete=False) as tmp:
+        for chunk in upload.chunks():
+            tmp.write(chunk)
+    return tmp.name, True
+
+
+def moderate_video(upload):
+    """
+    Модерация видео или анимированного изображения с кешем вердиктов.
+    Возвращает вердикт, объяснение и время кадров, повлиявших на вердикт.
+    """
+    cache = get_verdict_cache() if settings.MODERATION_CACHE_ENABLED else None
+    key = None
+    if cache is not None:
+        key = f"video:{VIDEO_CACHE_VERSION}:{image_digest(upload)}"
+        result = cache.get(key)
+        if result is not None:
+            return {**result, "cached": True}
+
+    # Формат по сигнатуре, как при проверке загрузки: MP4 с именем v.gif идет в OpenCV, а не в Pillow
+    file_format = sniff_format(read_head(upload))
+    if file_format in ANIMATION_FORMATS:
+        result, stats = moderate_animation(upload)
+    else:
+        path, is_temporary = _video_path(upload, file_format)
+        try:
+            result, stats = moderate_frames(VideoFrames(path))
+        finally:
+            if is_temporary:
+                os.unlink(path)
+
+    if cache is not None and result["verdict"] != "error":
+        cache.set(key, result)
+    return {**result, "cached": False, "preprocessing": stats}
@@ -1,117 +1,260 @@
-
+import os
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.decorators import api_view, parser_classes
 from rest_framework.response import Response
-from .serializers import ImageModerationRequestSerializer, AskRequestSerializer, AskResponseSerializer
-from .services import analyze_image_with_ai
+from .serializers import (
+    ImageModerationRequestSerializer, ImageBatchModerationRequestSerializer, VideoModerationRequestSerializer,
+    ImageAdviceRequestSerializer, ModerationJobSerializer, ModerationHistorySerializer, AskRequestSerializer, AskResponseSerializer,
+    AskBatchRequestSerializer, AskBatchResponseSerializer, DocumentRequestSerializer, DocumentSerializer, ConversationRequestSerializer, ConversationSerializer,
+)
+from .services import (
+    moderation_usage_headers,
+    analyze_image_with_ai, advise_image, image_digest, moderate_image_batch, get_verdict_cache, get_answer_cache, plan_ask,
+    AskBatch,
+)
+from .tokens import usage_stats
+from .video import moderate_video as moderate_video_file
+from .exceptions import OpenAIAPIException
+from .jobs import KIND_BATCH, KIND_IMAGE, get_job_store, job_payload, submit_job, wants_job
+from .models import Conversation, Document, ModerationResult
+from .conversations import save_document
+from .pagination import KeysetPagination, ModerationResultsPagination
+from .history import record_moderation, safety_status as history_safety_status
+from .prefilter import prefilter_stats
+from .coalesce import coalesce_stats
+from .ratelimit import get_upstream_guard
+from .routing import routing_stats
+from .retrieval import retrieval_stats
+from .metrics import CONTENT_TYPE_LATEST, StageTimer, render_metrics
+from .uploads import IMAGE_FORMATS, MEDIA_FORMATS, VIDEO_FORMATS, limit_uploads, read_head, sniff_format
 from rest_framework.views import APIView
 from rest_framework import status
-from drf_spectacular.utils import extend_schema, OpenApiExample
+from rest_framework.exceptions import NotFound
+from rest_framework.settings import api_settings
+from .renderers import EventStreamRenderer
+from .streaming import wants_event_stream, stream_cached_answer, event_stream_response
+from .schema import extend_schema, OpenApiExample
 from django.conf import settings
-import openai
+from django.urls import reverse
+from django.core.files.storage import default_storage
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
 import logging
 
 logger = logging.getLogger(__name__)
-client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
 
 @api_view(["POST"])
 @parser_classes([MultiPartParser, FormParser])
 def moderate_image(request):
     """
-    Принимает изображение, возвращает вердикт от AI (без сохранения в БД)
+    Принимает изображение, возвращает вердикт от AI (без сохранения в БД).
+    С mode=verdict — только вердикт и теги, без объяснения.
+    С ?async=true или callback_url сразу отвечает 202 с id задачи (в том же режиме).
     """
-    serializer = ImageModerationRequestSerializer(data=request.data)
-    if not serializer.is_valid():
+    limit_uploads(request, IMAGE_FORMATS, settings.UPLOAD_MAX_IMAGE_SIZE)
+    with StageTimer('upload_parse'):
+        serializer = ImageModerationRequestSerializer(data=request.data)
+        valid = serializer.is_valid()
+    if not valid:
         return Response(serializer.errors, status=400)
     file = serializer.validated_data["file"]
-    result = analyze_image_with_ai(file)
-    return Response(result)
+    if wants_job(request, serializer.validated_data):
+        return _job_accepted(request, KIND_IMAGE, [file], serializer.validated_data)
+    result = analyze_image_with_ai(file, serializer.validated_data["mode"])
+    return Response(result, headers=moderation_usage_headers([result]))
 
 
-class HealthCheckView(APIView):
+@api_view(["POST"])
+@parser_classes([MultiPartParser, FormParser])
+def moderate_image_advice(request):
     """
-    Health check endpoint для проверки состояния сервиса
+    Советы по улучшению изображения для краудфандинга — отдельным запросом,
+    когда они действительно нужны (moderate-image их не генерирует в режиме verdict).
     """
-    @extend_schema(
-        responses={200: {"description": "Service is healthy"}},
-        tags=["Health"]
+    limit_uploads(request, IMAGE_FORMATS, settings.UPLOAD_MAX_IMAGE_SIZE)
+    serializer = ImageAdviceRequestSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+    result = advise_image(serializer.validated_data["file"])
+    return Response(result, headers=moderation_usage_headers([result]))
+
+
+@api_view(["POST"])
+@parser_classes([MultiPartParser, FormParser])
+def moderate_images(request):
+    """
+    Принимает несколько изображений (поле files), возвращает вердикты в порядке загрузки.
+    Ошибка в одном файле не прерывает обработку остальных.
+    """
+    limit_uploads(
+        request, IMAGE_FORMATS, settings.UPLOAD_MAX_IMAGE_SIZE, settings.MODERATION_BATCH_MAX_FILES, sniff=False
     )
+    serializer = ImageBatchModerationRequestSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+    files = serializer.validated_data["files"]
+    if wants_job(request, serializer.validated_data):
+        return _job_accepted(request, KIND_BATCH, files, serializer.validated_data)
+    result = moderate_image_batch(files, serializer.validated_data["mode"])
+    return Response(result, headers=moderation_usage_headers(result["results"]))
+
+
+@api_view(["POST"])
+@parser_classes([MultiPartParser, FormParser])
+def moderate_video(request):
+    """
+    Принимает видео или анимированный GIF/WebP, проверяет ключевые кадры.
+    В ответе — общий вердикт и время кадров с сомнительным контентом.
+    """
+    limit_uploads(request, VIDEO_FORMATS, settings.VIDEO_MAX_UPLOAD_SIZE)
+    serializer = VideoModerationRequestSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+    result = moderate_video_file(serializer.validated_data["file"])
+    return Response(result, headers=moderation_usage_headers([result]))
+
+
+def _job_accepted(request, kind, files, validated_data):
+    job_id = submit_job(kind, files, validated_data.get("callback_url"), validated_data["mode"])
+    return Response({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": request.build_absolute_uri(reverse("moderation-job", args=[job_id])),
+    }, status=status.HTTP_202_ACCEPTED)
+
+
+class ModerationJobView(APIView):
+    """
+    Статус задачи модерации и ее результаты (постранично)
+    """
+    pagination_class = ModerationResultsPagination
+
+    @extend_schema(responses={200: ModerationJobSerializer}, tags=["Content Moderation"])
+    def get(self, request, job_id):
+        job = get_job_store().get(job_id)
+        if job is None:
+            return Response({"error": "Задача не найдена"}, status=status.HTTP_404_NOT_FOUND)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(job["results"], request, view=self)
+        response = paginator.get_paginated_response(page)
+        response.data = {**job_payload(job), **response.data}
+        return response
+
+
+class ModerationJobListView(APIView):
+    """
+    Список задач модерации от новых к старым (курсорная пагинация, без COUNT(*)).
+    Фильтр: ?status=queued|running|done|failed
+    """
+    pagination_class = KeysetPagination
+
+    @extend_schema(responses={200: ModerationJobSerializer(many=True)}, tags=["Content Moderation"])
     def get(self, request):
-        return Response({
-            "status": "healthy",
-            "message": "Service is running properly"
-        }, status=status.HTTP_200_OK)
+        store = get_job_store()
+        job_status = request.query_params.get('status') or None
 
+        def fetch(after, limit):
+            try:
+                return store.list(limit, after=after, status=job_status)
+            except ValueError:
+                raise NotFound(paginator.invalid_cursor_message)
 
-class AskView(APIView):
+        def estimate():
+            return store.approximate_count(job_status)
+
+        paginator = self.pagination_class()
+        jobs = paginator.paginate(fetch, request, key=lambda job: (job['created_at'], job['id']), estimate=estimate)
+        return paginator.get_paginated_response([job_payload(job) for job in jobs])
+
+
+class ModerationHistoryView(APIView):
     """
-    API для чат-бота и анализа текста
+    История модерации от новых к старым (курсорная пагинация, без COUNT(*)).
+    Фильтры: ?verdict=safe|potentially_unsafe|unsafe|error, ?content_hash=<sha256>
     """
+    pagination_class = KeysetPagination
+
+    @extend_schema(responses={200: ModerationHistorySerializer(many=True)}, tags=["Content Moderation"])
+    def get(self, request):
+        queryset = ModerationResult.objects.select_related('content').prefetch_related('detected_tags')
+        if request.query_params.get('verdict'):
+            queryset = queryset.filter(verdict=request.query_params['verdict'])
+        if request.query_params.get('content_hash'):
+            queryset = queryset.filter(content__content_hash=request.query_params['content_hash'])
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        return paginator.get_paginated_response(ModerationHistorySerializer(page, many=True).data)
+
+
+class DocumentView(APIView):
+    """
+    Загрузка текста для /copilot/ask/. id документа — sha256 текста: тот же текст
+    возвращает тот же document_id (200 вместо 201) без новой записи.
+    """
+
     @extend_schema(
-        request=AskRequestSerializer,
-        responses={200: AskResponseSerializer},
-        tags=["Copilot"],
-        examples=[
-            OpenApiExample(
-                "Пример запроса",
-                value={
-                    "context": "Это текст статьи о машинном обучении...",
-                    "question": "Какие основные алгоритмы упоминаются в тексте?"
-                }
-            )
-        ]
+        request=DocumentRequestSerializer, responses={200: DocumentSerializer, 201: DocumentSerializer}, tags=["Copilot"]
     )
+    def post(self, request):
+        serializer = DocumentRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        document, created = save_document(serializer.validated_data["text"])
+        return Response(
+            DocumentSerializer(document).data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        )
+
 
+class DocumentDetailView(APIView):
+    """Сведения о загруженном документе (без текста)"""
 
+    @extend_schema(responses={200: DocumentSerializer}, tags=["Copilot"])
+    def get(self, request, document_id):
+        document = Document.objects.defer('text').filter(pk=document_id).first()
+        if document is None:
+            return Response({"error": "Документ не найден"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(DocumentSerializer(document).data)
 
 
+class ConversationView(APIView):
+    """
+    Новый диалог. С document_id вопросы диалога задаются по этому документу
+    без context; история хранится на сервере.
+    """
+
+    @extend_schema(
+        request=ConversationRequestSerializer, responses={201: ConversationSerializer}, tags=["Copilot"]
+    )
     def post(self, request):
-        serializer = AskRequestSerializer(data=request.data)
+        serializer = ConversationRequestSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        context = serializer.validated_data["context"]
-        question = serializer.validated_data["question"]
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "Ты ИИ-помощник, анализирующий текст и отвечающий на вопросы."},
-                    {"role": "user", "content": f"Текст: {context}\n\nВопрос: {question}"}
-                ],
-                temperature=0.5,
-                max_tokens=1000,
-            )
-            answer = response.choices[0].message.content.strip()
-            return Response({"answer": answer}, status=status.HTTP_200_OK)
-        except Exception as e:
-            logger.error(f"Error in AskView: {str(e)}")
-            return Response(
-                {"error": "Произошла ошибка при обработке запроса"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+        conversation = Conversation.objects.create(document=serializer.validated_data.get("document_id"))
+        return Response(ConversationSerializer(conversation).data, status=status.HTTP_201_CREATED)
 
-# --- END OF FILE ---
 
-# --- END OF FILE ---
+class ConversationDetailView(APIView):
+    """История диалога: краткое содержание свернутых ходов и все вопросы и ответы"""
 
-# --- END OF FILE ---
+    @extend_schema(responses={200: ConversationSerializer}, tags=["Copilot"])
+    def get(self, request, conversation_id):
+        conversation = Conversation.objects.prefetch_related('turns').filter(pk=conversation_id).first()
+        if conversation is None:
+            return Response({"error": "Диалог не найден"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(ConversationSerializer(conversation).data)
 
-from rest_framework.views import APIView
-from rest_framework.response import Response
-from rest_framework import status
-from drf_spectacular.utils import extend_schema, OpenApiExample
-from .serializers import AskRequestSerializer, AskResponseSerializer
-from django.conf import settings
-import openai
-import logging
-
-logger = logging.getLogger(__name__)
-client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
+    @extend_schema(responses={204: None}, tags=["Copilot"])
+    def delete(self, request, conversation_id):
+        deleted, _ = Conversation.objects.filter(pk=conversation_id).delete()
+        if not deleted:
+            return Response({"error": "Диалог не найден"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 class HealthCheckView(APIView):
     """
-    Health check endpoint для проверки состояния сервиса
+    Health check endpoint для проверки состояния сервиса.
+    Статический ответ без БД и статистики: проба liveness не должна зависеть от SQLite
     """
     @extend_schema(
         responses={200: {"description": "Service is healthy"}},
@@ -120,14 +263,43 @@ class HealthCheckView(APIView):
     def get(self, request):
         return Response({
             "status": "healthy",
-            "message": "Service is running properly"
+            "message": "Service is running properly",
         }, status=status.HTTP_200_OK)
 
 
+class StatsView(APIView):
+    """
+    Диагностика процесса: кеши, очередь задач (запрос к SQLite), лимиты OpenAI,
+    расход токенов, маршрутизация. Для людей и дашбордов, не для проб liveness
+    """
+    @extend_schema(responses={200: {"description": "Service statistics"}}, tags=["Health"])
+    def get(self, request):
+        return Response({
+            "moderation_cache": get_verdict_cache().stats(),
+            "ask_cache": get_answer_cache().stats(),
+            "ask_retrieval": retrieval_stats.snapshot(),
+            "moderation_jobs": get_job_store().stats(),
+            "moderation_prefilter": prefilter_stats.snapshot(),
+            "token_usage": usage_stats.snapshot(),
+            "coalescing": coalesce_stats.snapshot(),
+            "openai_limits": get_upstream_guard().snapshot(),
+            "ask_routing": routing_stats.snapshot(),
+        }, status=status.HTTP_200_OK)
+
+
+def metrics(request):
+    """Метрики в формате Prometheus (со всех воркеров gunicorn при PROMETHEUS_MULTIPROC_DIR)"""
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
+
 class AskView(APIView):
     """
-    API для чат-бота и анализа текста
+    API для чат-бота и анализа текста.
+    С ?stream=true или Accept: text/event-stream ответ отдается токенами через SSE.
+    Повторные вопросы по тому же тексту отдаются из кеша (Cache-Control: no-cache — мимо кеша).
     """
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [EventStreamRenderer]
+
     @extend_schema(
         request=AskRequestSerializer,
         responses={200: AskResponseSerializer},
@@ -139,28 +311,54 @@ class AskView(APIView):
                     "context": "Это текст статьи о машинном обучении...",
                     "question": "Какие основные алгоритмы упоминаются в тексте?"
                 }
+            ),
+            OpenApiExample(
+                "Длинный документ: только релевантные фрагменты",
+                value={
+                    "context": "Полное описание кампании на 200 страниц...",
+                    "question": "Когда планируется доставка?",
+                    "retrieval": True,
+                    "top_k": 4
+                }
+            ),
+            OpenApiExample(
+                "Вопрос в диалоге по загруженному документу",
+                value={
+                    "conversation_id": "3f2b8c1e-5d4a-4b6e-9c7f-1a2b3c4d5e6f",
+                    "question": "А что будет, если доставка задержится?"
+                }
+            ),
+            OpenApiExample(
+                "Самая сильная модель",
+                value={
+                    "context": "Описание двух вариантов вознаграждений...",
+                    "question": "Какой вариант выгоднее для бекеров?",
+                    "quality": "best"
+                }
             )
         ]
     )
 
+
+
+
     def post(self, request):
         serializer = AskRequestSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        context = serializer.validated_data["context"]
-        question = serializer.validated_data["question"]
+        plan = plan_ask(request, serializer.validated_data)
+        if wants_event_stream(request):
+            if plan.cached is not None:
+                return event_stream_response(stream_cached_answer(plan.cached["answer"], plan.meta()))
+            return event_stream_response(plan.stream())
+        if plan.cached is not None:
+            return Response(plan.payload(plan.cached["answer"], cached=True), status=status.HTTP_200_OK)
         try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "Ты ИИ-помощник, анализирующий текст и отвечающий на вопросы."},
-                    {"role": "user", "content": f"Текст: {context}\n\nВопрос: {question}"}
-                ],
-                temperature=0.5,
-                max_tokens=1000,
-            )
-            answer = response.choices[0].message.content.strip()
-            return Response({"answer": answer}, status=status.HTTP_200_OK)
+            payload, headers = plan.complete()
+            return Response(payload, status=status.HTTP_200_OK, headers=headers)
+        except OpenAIAPIException:
+            # Обрабатывается custom_exception_handler
+            raise
         except Exception as e:
             logger.error(f"Error in AskView: {str(e)}")
             return Response(
@@ -169,21 +367,41 @@ class AskView(APIView):
             )
 
 
+class AskBatchView(APIView):
+    """
+    Несколько вопросов по одному тексту (context или document_id) за один запрос.
+    Вопросы идут к модели параллельно с общим началом промпта, которое OpenAI
+    берет из кеша промптов; в ответе — ответ, usage и cached_tokens по каждому вопросу.
+    """
 
+    @extend_schema(
+        request=AskBatchRequestSerializer,
+        responses={200: AskBatchResponseSerializer},
+        tags=["Copilot"],
+        examples=[
+            OpenApiExample(
+                "Анализ кампании",
+                value={
+                    "document_id": "4632c23d1c6d34c187e9f99cb4b91142987776954c62ff88ed56913c24481f4c",
+                    "questions": ["Какие риски у проекта?", "Какие есть вознаграждения?", "Когда доставка?"]
+                }
+            )
+        ]
+    )
+    def post(self, request):
+        serializer = AskBatchRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        payload, headers = AskBatch(request, serializer.validated_data).run()
+        return Response(payload, status=status.HTTP_200_OK, headers=headers)
 
 
-import json
-import os   
-import re
-from rest_framework import status
-from rest_framework.decorators import api_view, parser_classes
-from rest_framework.parsers import MultiPartParser, FormParser
-from rest_framework.response import Response
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
-
-from django.views.decorators.csrf import csrf_exempt
-
+UPLOAD_MESSAGES = {
+    'safe': 'Ваш контент прошел проверку на безопасность :)',
+    'potentially_unsafe': 'Контент отправлен на дополнительную проверку модератором',
+    'unsafe': 'Контент не прошел проверку на безопасность',
+    'error': 'Не удалось проверить контент, попробуйте позже',
+}
 
 
 @csrf_exempt
@@ -210,11 +428,12 @@ from django.views.decorators.csrf import csrf_exempt
                 'application/json': {
                     'example': {
                         'content': {
-                            'id': 1,
                             'file': '/media/content/example.jpg',
                             'file_type': 'image',
+                            'content_hash': '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08',
                             'safety_status': 'safe'
                         },
+                        'moderation': {'verdict': 'safe', 'tags': [], 'explanation': '...', 'cached': False},
                         'message': 'Ваш контент прошел проверку на безопасность :)'
                     }
                 }
@@ -226,8 +445,11 @@ from django.views.decorators.csrf import csrf_exempt
 def upload_content(request):
     """
     API endpoint для загрузки контента (изображений и видео)
-    Автоматически анализирует контент с помощью OpenAI
+    Автоматически анализирует контент с помощью OpenAI и сохраняет результат в историю модерации.
+    Файл сохраняется до ответа, а записи в БД делает фоновый поток пачками (copilot.history).
     """
+    # Размер и формат проверяются по мере загрузки, до записи файла целиком
+    limit_uploads(request, MEDIA_FORMATS, settings.UPLOAD_MAX_IMAGE_SIZE)
     if 'file' not in request.FILES:
         return Response(
             {'error': 'Файл не предоставлен'}, 
@@ -236,72 +458,43 @@ def upload_content(request):
     
     file = request.FILES['file']
     
-    # Проверяем размер файла (максимум 10MB)
-    if file.size > 10 * 1024 * 1024:
-        return Response(
-            {'error': 'Размер файла не должен превышать 10MB'}, 
-            status=status.HTTP_400_BAD_REQUEST
-        )
-    
-    file_extension = file.name.split('.')[-1].lower()
+    # Тип файла определяется по сигнатуре содержимого, а не по расширению
+    file_format = sniff_format(read_head(file))
     
-    # Определяем тип файла
-    image_extensions = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
-    video_extensions = ['mp4', 'avi', 'mov', 'wmv', 'flv', 'webm']
-    
-    if file_extension in image_extensions:
+    if file_format in IMAGE_FORMATS:
         file_type = 'image'
-    elif file_extension in video_extensions:
+        serializer = ImageModerationRequestSerializer(data={'file': file})
+    elif file_format in VIDEO_FORMATS:
         file_type = 'video'
+        serializer = VideoModerationRequestSerializer(data={'file': file})
     else:
         return Response(
-            {'error': f'Неподдерживаемый тип файла: {file_extension}'}, 
+            {'error': 'Неподдерживаемый тип файла'}, 
             status=status.HTTP_400_BAD_REQUEST
         )
-    
-    # Создаем объект Content
-    
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    file = serializer.validated_data['file']
+
     # Анализируем контент с помощью AI
-    # Здесь должна быть только логика для stateless AI moderation (пример):
-    # result = analyze_image_with_ai(uploaded_file)
-    # return Response(result)
-        # try:
-        #     ai_data = json.loads(ai_result)
-        #     detected_tag_names = ai_data.get('detected_tags', [])
-        #     safety_level = ai_data.get('safety_level', 'safe')
-        # except json.JSONDecodeError:
-        #     # Если AI вернул не JSON, используем значения по умолчанию
-        #     detected_tag_names = []
-        #     safety_level = 'safe'
-        #     ai_data = {'explanation': ai_result}
-        # Предполагаем, что ai_result — это str
-        cleaned_result = re.sub(r'^```json\s*|\s*```$', '', ai_result.strip(), flags=re.MULTILINE)
+    if file_type == 'image':
+        result = analyze_image_with_ai(file)
+    else:
+        result = moderate_video_file(file)
+
+    content_hash = image_digest(file)
+    path = default_storage.save(f'content/{os.path.basename(file.name)}', file)
+    safety_status = history_safety_status(result)
+    record_moderation(file_type, content_hash, result, file_name=path)
+
+    return Response({
+        'content': {
+            'file': default_storage.url(path),
+            'file_type': file_type,
+            'content_hash': content_hash,
+            'safety_status': safety_status,
+        },
+        'moderation': result,
+        'message': UPLOAD_MESSAGES.get(safety_status, UPLOAD_MESSAGES['error']),
+    }, status=status.HTTP_201_CREATED, headers=moderation_usage_headers([result]))
 
-        try:
-            ai_data = json.loads(cleaned_result)
-            detected_tag_names = ai_data.get('detected_tags', [])
-            safety_level = ai_data.get('safety_level', 'safe')
-        except json.JSONDecodeError:
-        # Если не удалось распарсить, fallback
-            detected_tag_names = []
-            safety_level = 'safe'
-            ai_data = {'explanation': ai_result}
-        
-        # Обновляем статус безопасности контента
-        content.safety_status = safety_level
-        content.save()
-        
-        # Создаем результат модерации
-        moderation_result = ModerationResult.objects.create(
-            content=content,
-            ai_analysis_raw=cleaned_result
-        )
-        
-        # Добавляем обнаруженные теги
-        for tag_name in detected_tag_names:
-            tag, created = Tag.objects.get_or_create(name=tag_name)
-            moderation_result.detected_tags.add(tag)
-        
-        # Формируем ответ
-        content_serializer = ContentSerializer(content)
-        moderation_serializer = ModerationResultSerializer(moderation_result)
@@ -0,0 +1,39 @@
+"""
+Настройки gunicorn, которые нельзя передать флагами командной строки.
+Файл подхватывается автоматически при запуске из корня проекта.
+"""
+import os
+import shutil
+
+# С --preload приложение (и файлы метрик мастера) загружается раньше on_starting — каталог нужен заранее.
+# Воркеры после fork открывают свои файлы заново, поэтому очистка в on_starting им не мешает
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+
+def on_starting(server):
+    # Метрики Prometheus прошлого запуска не должны попасть в новые значения
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def when_ready(server):
+    # --preload: приложение уже загружено мастером; догружаем отложенные модули до fork воркеров
+    if server.cfg.preload_app:
+        from copilot.startup import warm_up
+        warm_up()
+
+
+def post_worker_init(worker):
+    # Потоки очереди модерации стартуют вместе с воркером: задачи, оставшиеся в очереди после
+    # перезапуска или с истекшей арендой, не ждут, пока в этот воркер поставят новую задачу
+    from copilot.jobs import get_worker_pool
+    get_worker_pool().ensure_started()
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)